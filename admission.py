@@ -0,0 +1,235 @@
+"""上游请求准入控制：全局并发上限 + 按 IP / 会话的令牌桶限速 + 按会话加权轮询的公平排队
+
+并发已满时请求进入等待队列，各会话按权重轮流出队（同一会话连续发送的请求排在自己的队列里，
+不会挤占其他会话），排队期间通过 on_queued 回调通知当前位置（1 表示下一个）。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+from metrics import ADMISSION_REJECTED, ADMISSION_WAIT
+from provider_router import StreamCancelled
+
+MAX_CONCURRENT = int(os.getenv('WEBCHAT_MAX_CONCURRENT', '64'))  # 同时进行的上游请求上限（0 不限）
+QUEUE_MAX = int(os.getenv('WEBCHAT_ADMISSION_QUEUE_MAX', '256'))  # 排队请求数上限，超过直接拒绝
+QUEUE_TIMEOUT = float(os.getenv('WEBCHAT_ADMISSION_QUEUE_TIMEOUT', '60'))  # 最长排队时间（秒）
+# 令牌桶：rate 为每秒补充的请求数（0 不限），burst 为桶容量（允许的突发请求数）
+IP_RATE = float(os.getenv('WEBCHAT_IP_RATE', '1'))
+IP_BURST = float(os.getenv('WEBCHAT_IP_BURST', '10'))
+# 会话桶：正常对话连发 10 条不受限，之后平均每 2 秒一条
+SESSION_RATE = float(os.getenv('WEBCHAT_SESSION_RATE', '0.5'))
+SESSION_BURST = float(os.getenv('WEBCHAT_SESSION_BURST', '10'))
+BUCKET_PRUNE_SECONDS = 60  # 清理已回满（长时间空闲）令牌桶的间隔
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入（reason: rate_limited / queue_full / queue_timeout）"""
+
+    def __init__(self, reason, retry_after=None):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        """距离有一个可用令牌还需等待的秒数（调用前先 refill）"""
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class _Waiter:
+    __slots__ = ('session_id', 'event', 'granted', 'position', 'on_queued')
+
+    def __init__(self, session_id, on_queued):
+        self.session_id = session_id
+        self.event = threading.Event()
+        self.granted = False
+        self.position = None
+        self.on_queued = on_queued
+
+
+class AdmissionController:
+    def __init__(self, max_concurrent=MAX_CONCURRENT, queue_max=QUEUE_MAX, queue_timeout=QUEUE_TIMEOUT,
+                 ip_rate=IP_RATE, ip_burst=IP_BURST, session_rate=SESSION_RATE, session_burst=SESSION_BURST):
+        self.max_concurrent = max_concurrent
+        self.queue_max = queue_max
+        self.queue_timeout = queue_timeout
+        self._limits = {'ip': (ip_rate, ip_burst), 'session': (session_rate, session_burst)}
+        self._buckets = {'ip': {}, 'session': {}}
+        self._last_prune = time.monotonic()
+        self._lock = threading.Lock()
+        self.active = 0
+        self.queued = 0
+        # 会话 -> 排队请求；顺序即轮询顺序，队首会话本轮还可出队 _credits[会话] 个请求
+        self._queues = OrderedDict()
+        self._weights = {}
+        self._credits = {}
+
+    # ---- 令牌桶 ----
+
+    def _check_rate_locked(self, keys):
+        now = time.monotonic()
+        buckets = []
+        retry_after = 0.0
+        for kind, key in keys:
+            rate, burst = self._limits[kind]
+            if key is None or rate <= 0:
+                continue
+            bucket = self._buckets[kind].get(key)
+            if bucket is None:
+                bucket = self._buckets[kind][key] = TokenBucket(rate, burst)
+            bucket.refill(now)
+            buckets.append(bucket)
+            retry_after = max(retry_after, bucket.wait_time())
+        if retry_after > 0:
+            # 任一桶不足时都不扣减，避免被拒绝的请求消耗另一个桶的令牌
+            raise AdmissionRejected('rate_limited', retry_after)
+        for bucket in buckets:
+            bucket.tokens -= 1
+        if now - self._last_prune > BUCKET_PRUNE_SECONDS:
+            self._prune_locked(now)
+
+    def _prune_locked(self, now):
+        for buckets in self._buckets.values():
+            for key in [key for key, bucket in buckets.items()
+                        if bucket.tokens + (now - bucket.updated) * bucket.rate >= bucket.burst]:
+                del buckets[key]
+        self._last_prune = now
+
+    # ---- 公平队列 ----
+
+    def _pop_next_locked(self):
+        """按加权轮询取出下一个排队请求"""
+        session_id, waiters = next(iter(self._queues.items()))
+        waiter = waiters.popleft()
+        self._credits[session_id] -= 1
+        if not waiters:
+            del self._queues[session_id], self._credits[session_id], self._weights[session_id]
+        elif self._credits[session_id] <= 0:
+            self._queues.move_to_end(session_id)
+            self._credits[session_id] = self._weights[session_id]
+        self.queued -= 1
+        return waiter
+
+    def _remove_locked(self, waiter):
+        waiters = self._queues[waiter.session_id]
+        waiters.remove(waiter)
+        if not waiters:
+            del self._queues[waiter.session_id], self._credits[waiter.session_id], self._weights[waiter.session_id]
+        self.queued -= 1
+
+    def _positions_locked(self):
+        """按出队顺序模拟一遍轮询，返回位置有变化的 [(回调, 位置)]"""
+        notices = []
+        order = [(session_id, list(waiters)) for session_id, waiters in self._queues.items()]
+        credits = dict(self._credits)
+        offsets = dict.fromkeys(self._queues, 0)
+        position = 0
+        while order:
+            session_id, waiters = order[0]
+            waiter = waiters[offsets[session_id]]
+            offsets[session_id] += 1
+            credits[session_id] -= 1
+            position += 1
+            if waiter.position != position:
+                waiter.position = position
+                if waiter.on_queued is not None:
+                    notices.append((waiter.on_queued, position))
+            if offsets[session_id] == len(waiters):
+                order.pop(0)
+            elif credits[session_id] <= 0:
+                order.append(order.pop(0))
+                credits[session_id] = self._weights[session_id]
+        return notices
+
+    def _grant_locked(self):
+        while self.queued and (self.max_concurrent <= 0 or self.active < self.max_concurrent):
+            waiter = self._pop_next_locked()
+            waiter.granted = True
+            self.active += 1
+            waiter.event.set()
+        return self._positions_locked()
+
+    @staticmethod
+    def _notify(notices):
+        # 回调（emit）在锁外执行，避免慢客户端阻塞准入
+        for callback, position in notices:
+            try:
+                callback(position)
+            except Exception:
+                pass
+
+    # ---- 对外接口 ----
+
+    def acquire(self, session_id, client_ip=None, on_queued=None, weight=1, cancel=None):
+        """获取一个上游请求名额，必要时排队；未被准入时抛出 AdmissionRejected
+
+        传入 cancel（CancelToken）时，排队期间被取消会立即离开队列并抛出 StreamCancelled。
+        """
+        with self._lock:
+            try:
+                self._check_rate_locked((('ip', client_ip), ('session', session_id)))
+            except AdmissionRejected:
+                ADMISSION_REJECTED.inc(reason='rate_limited')
+                raise
+            if self.max_concurrent <= 0 or (self.active < self.max_concurrent and not self.queued):
+                self.active += 1
+                return
+            if self.queued >= self.queue_max:
+                ADMISSION_REJECTED.inc(reason='queue_full')
+                raise AdmissionRejected('queue_full')
+            waiter = _Waiter(session_id, on_queued)
+            if session_id not in self._queues:
+                self._queues[session_id] = deque()
+                self._credits[session_id] = self._weights[session_id] = max(1, int(weight))
+            self._queues[session_id].append(waiter)
+            self.queued += 1
+            notices = self._positions_locked()
+        self._notify(notices)
+
+        started = time.monotonic()
+        if cancel is not None:
+            cancel.on_cancel(waiter.event.set)
+        waiter.event.wait(self.queue_timeout)
+        with self._lock:
+            granted = waiter.granted
+            if not granted:
+                self._remove_locked(waiter)
+                notices = self._positions_locked()
+        ADMISSION_WAIT.observe(time.monotonic() - started)
+        if not granted:
+            self._notify(notices)
+            if cancel is not None:
+                cancel.check()
+            ADMISSION_REJECTED.inc(reason='queue_timeout')
+            raise AdmissionRejected('queue_timeout')
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+            notices = self._grant_locked()
+        self._notify(notices)
+
+    @contextmanager
+    def admit(self, session_id, client_ip=None, on_queued=None, weight=1, cancel=None):
+        self.acquire(session_id, client_ip, on_queued, weight, cancel)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        with self._lock:
+            return {'active': self.active, 'queued': self.queued, 'sessions_queued': len(self._queues)}
@@ -1,108 +1,795 @@
-from flask import Flask, render_template
+import os
+
+# 异步模式：threading（默认，每个流占用一个线程）/ gevent / eventlet（协程，单进程可承载数千并发流）
+# 协程模式必须在导入其他模块前完成 monkey patch，使上游 HTTP 流读取与 emit 变为非阻塞
+ASYNC_MODE = os.getenv('WEBCHAT_ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+elif ASYNC_MODE == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+
+from flask import Flask, Response, render_template
 from flask_socketio import SocketIO, emit
-from deepseek_api import deepseek1
+from openai import BadRequestError
+from deepseek_api import (DEEPSEEK_MODEL, CancelToken, StreamCancelled, UpstreamUnavailable, deepseek1,
+                          get_pool_stats)
+from chat_logging import get_logger, log_event, log_transcript
+from admission import AdmissionController, AdmissionRejected
+from replay_buffer import ReplayStore
+from conversation_store import STORE_PATH, STORE_RETENTION_DAYS, ConversationStore
+from cluster import queue_options
+from metrics import (CACHE_REQUESTS, CHAT_ACTIVE_STREAMS, CHAT_CANCELLED, CHAT_COMPLETION_TOKENS, CHAT_DURATION,
+                     CHAT_PROMPT_CACHE_HIT_TOKENS, CHAT_PROMPT_TOKENS, CHAT_TOKENS_PER_SECOND, CHAT_TTFT,
+                     CHAT_UPSTREAM_ERRORS, CHAT_WASTED_TOKENS, TOOL_CALLS, TOOL_ITERATIONS, CallbackMetric,
+                     render_metrics)
+from response_cache import CACHE_ENABLED, ResponseCache
+from workspace_index import WorkspaceIndex
 from datetime import datetime
 import uuid
 from flask import request
-import os
 import argparse
+import contextlib
+import fnmatch
 import json
+import logging
+import mmap
 import re
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'your-secret-key'
 # app.config['SECRET_KEY'] =  os.getenv('FLASK_SECRET', 'dev-secret-key')
+# 多 worker 部署时通过消息队列转发跨进程的 emit（见 cluster.py）
+MESSAGE_QUEUE = os.getenv('WEBCHAT_MESSAGE_QUEUE')
 
 socketio = SocketIO(app, 
                    cors_allowed_origins="*",
-                   async_mode='threading',
+                   async_mode=ASYNC_MODE,
                    logger=False,
                    engineio_logger=False,
-                   log_output=True)
+                   log_output=True,
+                   **queue_options(MESSAGE_QUEUE))
+if os.getenv('WEBCHAT_TRUST_PROXY', '0') == '1':
+    # 部署在负载均衡器或 cluster.py 代理之后时从 X-Forwarded-For 取客户端 IP
+    # 必须包在 SocketIO 中间件之外，否则 /socket.io 请求不经过 ProxyFix
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1)
 
 
 @app.route('/')
 def index():
     return render_template('index.html')
 
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus 指标"""
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+
+def stream_completion(messages, mode, tools=None, usage=None, cancel=None):
+    """包装 deepseek1 流式输出，记录活跃流、首 token 延迟、吞吐、前缀缓存命中与上游错误指标
+
+    传入 usage 字典时，上游返回的 token 用量会累加到其中（一轮工具循环的多次请求可共用一个）；
+    传入 cancel（CancelToken）时，取消后关闭上游连接并抛出 StreamCancelled，计入取消与浪费 token 指标
+    """
+    started = time.perf_counter()
+    first_token_time = None
+    parts = []
+
+    def record_usage(reported):
+        CHAT_PROMPT_TOKENS.inc(reported['prompt_tokens'], model=DEEPSEEK_MODEL, mode=mode)
+        CHAT_PROMPT_CACHE_HIT_TOKENS.inc(reported['prompt_cache_hit_tokens'], model=DEEPSEEK_MODEL, mode=mode)
+        if usage is not None:
+            for key, value in reported.items():
+                usage[key] = usage.get(key, 0) + value
+
+    CHAT_ACTIVE_STREAMS.inc(mode=mode)
+    try:
+        for chunk in deepseek1(messages, tools=tools, on_usage=record_usage, cancel=cancel):
+            if chunk and first_token_time is None:
+                first_token_time = time.perf_counter()
+            # 工具调用以字典形式返回，吞吐只统计文本
+            if isinstance(chunk, str):
+                parts.append(chunk)
+            yield chunk
+    except StreamCancelled as e:
+        CHAT_CANCELLED.inc(mode=mode, reason=e.reason)
+        CHAT_WASTED_TOKENS.inc(estimate_tokens(''.join(parts)), mode=mode, reason=e.reason)
+        raise
+    except Exception:
+        CHAT_UPSTREAM_ERRORS.inc(model=DEEPSEEK_MODEL, mode=mode)
+        raise
+    finally:
+        CHAT_ACTIVE_STREAMS.dec(mode=mode)
+
+    now = time.perf_counter()
+    completion_tokens = estimate_tokens(''.join(parts))
+    CHAT_DURATION.observe(now - started, model=DEEPSEEK_MODEL, mode=mode)
+    CHAT_COMPLETION_TOKENS.inc(completion_tokens, model=DEEPSEEK_MODEL, mode=mode)
+    if first_token_time is not None:
+        CHAT_TTFT.observe(first_token_time - started, model=DEEPSEEK_MODEL, mode=mode)
+        if now > first_token_time:
+            CHAT_TOKENS_PER_SECOND.observe(completion_tokens / (now - first_token_time),
+                                           model=DEEPSEEK_MODEL, mode=mode)
+
+
+# 流式输出合并配置：按时间窗口或字节阈值合并上游增量后再发送
+STREAM_FLUSH_INTERVAL = float(os.getenv('WEBCHAT_STREAM_FLUSH_MS', '40')) / 1000
+STREAM_FLUSH_BYTES = int(os.getenv('WEBCHAT_STREAM_FLUSH_BYTES', '2048'))
+# 客户端待发送包数超过该值时暂停发送（继续合并），持续超过慢消费者超时则断开
+STREAM_QUEUE_HIGH_WATER = int(os.getenv('WEBCHAT_STREAM_QUEUE_HIGH', '64'))
+STREAM_SLOW_CONSUMER_SECONDS = float(os.getenv('WEBCHAT_SLOW_CONSUMER_SECONDS', '30'))
+
+
+class EmitStats:
+    """流式发送统计（帧数/字节数/上游增量数/断开的慢消费者数）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.chunks_received = 0
+        self.slow_consumers_dropped = 0
+
+    def record_frame(self, n_bytes, n_chunks):
+        with self._lock:
+            self.frames_sent += 1
+            self.bytes_sent += n_bytes
+            self.chunks_received += n_chunks
+
+    def record_dropped(self):
+        with self._lock:
+            self.slow_consumers_dropped += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'frames_sent': self.frames_sent,
+                'bytes_sent': self.bytes_sent,
+                'chunks_received': self.chunks_received,
+                'avg_frame_bytes': self.bytes_sent / self.frames_sent if self.frames_sent else 0.0,
+                'slow_consumers_dropped': self.slow_consumers_dropped,
+            }
+
+
+emit_stats = EmitStats()
+
+
+class DeferredFlusher:
+    """所有 StreamEmitter 共用的后台任务：时间窗口结束时缓存仍未发送（上游暂停、没有新增量触发）则由它发送
+
+    只在有待发送的缓存时运行，空闲后退出，下次 schedule 时重新启动。
+    """
+
+    def __init__(self, tick=None):
+        self.tick = tick or max(STREAM_FLUSH_INTERVAL / 4, 0.005)
+        self._lock = threading.Lock()
+        self._pending = {}  # emitter -> 到期时间（monotonic）
+        self._running = False
+
+    def schedule(self, emitter, deadline):
+        with self._lock:
+            if emitter in self._pending:
+                return
+            self._pending[emitter] = deadline
+            if self._running:
+                return
+            self._running = True
+        socketio.start_background_task(self._run)
+
+    def _run(self):
+        while True:
+            socketio.sleep(self.tick)
+            now = time.monotonic()
+            with self._lock:
+                due = [emitter for emitter, deadline in self._pending.items() if deadline <= now]
+                for emitter in due:
+                    del self._pending[emitter]
+                if not due and not self._pending:
+                    self._running = False
+                    return
+            for emitter in due:
+                emitter.flush_due()
+
+
+class StreamEmitter:
+    """合并上游增量后经回复的续传缓冲（ReplayBuffer）发送 stream 事件，并对慢消费者施加背压
+
+    push 在流式线程中调用，时间窗口到期的发送由 deferred_flusher 在后台完成，两者通过 _lock 串行。
+    """
+
+    def __init__(self, reply, namespace='/'):
+        self.reply = reply
+        self.session_id = reply.session_id
+        self.namespace = namespace
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.last_flush = 0.0  # 首个增量立即发送，保证首 token 延迟
+        self.congested_since = None
+        self.dropped = False
+        self._lock = threading.Lock()
+
+    def _pending_packets(self):
+        """客户端 Engine.IO 队列中尚未发出的包数"""
+        try:
+            eio_sid = socketio.server.manager.eio_sid_from_sid(self.reply.sid, self.namespace)
+            return socketio.server.eio.sockets[eio_sid].queue.qsize()
+        except (KeyError, AttributeError, TypeError):
+            return 0
+
+    def push(self, chunk):
+        """缓存一个上游增量，必要时发送；返回 False 表示慢消费者已被断开"""
+        with self._lock:
+            self.buffer.append(chunk)
+            self.buffer_bytes += len(chunk.encode('utf-8'))
+            return self._drain_locked(time.monotonic())
+
+    def flush_due(self):
+        """时间窗口到期（由 deferred_flusher 调用）"""
+        with self._lock:
+            self._drain_locked(time.monotonic())
+
+    def _drain_locked(self, now):
+        if not self.buffer or self.dropped:
+            return not self.dropped
+        if self.buffer_bytes < STREAM_FLUSH_BYTES and now - self.last_flush < STREAM_FLUSH_INTERVAL:
+            # 窗口未到：到期时若仍没有新增量触发发送，由后台任务发送
+            deferred_flusher.schedule(self, self.last_flush + STREAM_FLUSH_INTERVAL)
+            return True
+
+        # 背压：客户端消费不过来时继续合并，超时仍未恢复则断开
+        if self._pending_packets() > STREAM_QUEUE_HIGH_WATER:
+            if self.congested_since is None:
+                self.congested_since = now
+            elif now - self.congested_since > STREAM_SLOW_CONSUMER_SECONDS:
+                log_event('slow_consumer_dropped', level=logging.WARNING, session_id=self.session_id)
+                emit_stats.record_dropped()
+                self.dropped = True
+                if self.reply.sid is not None:
+                    socketio.server.disconnect(self.reply.sid, namespace=self.namespace)
+                return False
+            deferred_flusher.schedule(self, now + STREAM_FLUSH_INTERVAL)
+            return True
+        self.congested_since = None
+        self._flush_locked()
+        return True
+
+    def flush(self):
+        """发送缓存的全部内容"""
+        with self._lock:
+            self._flush_locked()
+
+    def _flush_locked(self):
+        if not self.buffer or self.dropped:
+            return
+        self.reply.send_stream(''.join(self.buffer), self.buffer_bytes)
+        emit_stats.record_frame(self.buffer_bytes, len(self.buffer))
+        self.buffer = []
+        self.buffer_bytes = 0
+        self.last_flush = time.monotonic()
+
+
+deferred_flusher = DeferredFlusher()
+
+
+SUPERSEDE_WAIT_SECONDS = 5  # 同一会话的新消息等待上一条回复结束的最长时间
+
+
+class ActiveStream:
+    """一条进行中的回复：所属连接与会话、message_id、取消令牌、结束事件与续传缓冲"""
+
+    def __init__(self, sid, session_id):
+        self.sid = sid  # 客户端断开后为 None，续传后为新连接
+        self.session_id = session_id
+        self.message_id = str(uuid.uuid4())
+        self.cancel = CancelToken()
+        self.done = threading.Event()
+        self.reply = None  # ReplayBuffer
+
+
+class ActiveStreams:
+    """按客户端连接（sid）与会话登记进行中的回复，供 cancel 事件、断开连接与续传时查找"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._streams = {}  # sid -> {session_id: ActiveStream}
+        self._by_message = {}  # message_id -> ActiveStream
+
+    def start(self, sid, session_id):
+        """登记新的回复；同一会话上一条回复仍在进行时先取消并等待其结束（保证事件与历史顺序）"""
+        stream = ActiveStream(sid, session_id)
+        with self._lock:
+            sessions = self._streams.setdefault(sid, {})
+            previous = sessions.get(session_id)
+            sessions[session_id] = stream
+            self._by_message[stream.message_id] = stream
+        if previous is not None:
+            previous.cancel.cancel('superseded')
+            previous.done.wait(SUPERSEDE_WAIT_SECONDS)
+        return stream
+
+    def _unregister_locked(self, stream):
+        sessions = self._streams.get(stream.sid, {})
+        if sessions.get(stream.session_id) is stream:
+            del sessions[stream.session_id]
+            if not sessions:
+                del self._streams[stream.sid]
+
+    def finish(self, stream):
+        with self._lock:
+            self._unregister_locked(stream)
+            self._by_message.pop(stream.message_id, None)
+        stream.done.set()
+
+    def detach(self, sid):
+        """连接断开：返回该连接上的回复，等待客户端重连续传"""
+        with self._lock:
+            streams = list(self._streams.pop(sid, {}).values())
+            for stream in streams:
+                stream.sid = None
+        return streams
+
+    def reattach(self, message_id, sid):
+        """续传：把仍在进行的回复转到新连接，返回该回复（已结束时为 None）"""
+        with self._lock:
+            stream = self._by_message.get(message_id)
+            if stream is not None:
+                self._unregister_locked(stream)
+                stream.sid = sid
+                self._streams.setdefault(sid, {})[stream.session_id] = stream
+        return stream
+
+    def cancel(self, sid, session_id=None, reason='client'):
+        """取消该连接上的回复（session_id 为空时取消全部），返回取消的数量"""
+        with self._lock:
+            sessions = self._streams.get(sid, {})
+            streams = [stream for key, stream in sessions.items() if session_id is None or key == session_id]
+        return sum(stream.cancel.cancel(reason) for stream in streams)
+
+
+active_streams = ActiveStreams()
+
+
+@socketio.on('cancel')
+def handle_cancel(data=None):
+    """客户端点击停止：取消该连接上正在进行的回复（可按 session_id 指定）"""
+    session_id = (data or {}).get('session_id')
+    cancelled = active_streams.cancel(request.sid, session_id)
+    log_event('cancel_requested', session_id=session_id, client_ip=request.remote_addr, cancelled=cancelled)
+
+
+def _cancel_if_not_resumed(stream):
+    socketio.sleep(RESUME_GRACE_SECONDS)
+    if stream.sid is None:
+        # 宽限期内客户端没有重连续传，没有人会看到回复，关闭上游连接
+        stream.cancel.cancel('disconnect')
+
+
+@socketio.on('disconnect')
+def handle_disconnect(*args):
+    # 断线后回复继续写入续传缓冲，客户端在宽限期内重连可以补齐缺失的内容
+    for stream in active_streams.detach(request.sid):
+        if stream.reply is not None:
+            stream.reply.detach(request.sid)
+        if RESUME_GRACE_SECONDS > 0:
+            socketio.start_background_task(_cancel_if_not_resumed, stream)
+        else:
+            stream.cancel.cancel('disconnect')
+
+
+@socketio.on('resume')
+def handle_resume(data):
+    """客户端重连后续传：补发 offset 之后的内容，之后的实时内容发到新连接"""
+    message_id = (data or {}).get('message_id')
+    offset = (data or {}).get('offset', 0)
+    reply = replay_store.get(message_id) if message_id else None
+    if reply is None or not isinstance(offset, int) or not reply.resume(offset, request.sid):
+        log_event('resume_failed', message_id=message_id, offset=offset)
+        emit('message', {'type': 'resume_failed', 'content': '', 'message_id': message_id,
+                         'session_id': reply.session_id if reply is not None else None})
+        return
+    active_streams.reattach(message_id, request.sid)
+    log_event('resumed', session_id=reply.session_id, message_id=message_id, offset=offset,
+              missed_chars=reply.end - offset)
+
+
 @socketio.on('message')
 def handle_message(data):
     # 获取客户端会话ID，如果没有则生成一个
     session_id = data.get('session_id', str(uuid.uuid4()))
-    client_ip = request.remote_addr
+    stream = active_streams.start(request.sid, session_id)
+    try:
+        process_message(data, session_id, stream)
+    finally:
+        active_streams.finish(stream)
+        if stream.reply is not None:
+            if stream.reply.final_events:
+                replay_store.finish(stream.reply)
+            else:
+                # 没有正常结束（断线取消、慢消费者被断开），不再提供续传
+                replay_store.discard(stream.reply)
 
-    # 获取当前时间并格式化
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+def process_message(data, session_id, stream):
+    cancel = stream.cancel
+    client_ip = request.remote_addr
+    started = time.perf_counter()
     
-    # 打印带会话信息的用户消息
+    # 记录带会话信息的用户消息
     user_message = data.get('content', '')
     if user_message:
-        print(f"\n[{current_time}] [会话ID: {session_id}] [客户端IP: {client_ip}] [用户消息] {user_message}\n")
-    
-    api_messages = data.get('context', [])
+        log_event('user_message', session_id=session_id, client_ip=client_ip, bodies={'content': user_message})
     
-    # 发送开始标记（包含会话ID）
-    emit('message', {'type': 'start', 'content': '', 'session_id': session_id})
+    # 服务端维护会话历史，客户端只发送新消息
+    history = session_store.get(session_id)
+    if 'context' in data:
+        # 客户端显式同步完整上下文（旧版客户端或服务端丢失会话后的重新同步）
+        history = ConversationHistory.from_messages(session_id, data['context'])
+    elif history is None:
+        if data.get('history_length', 0) > 0:
+            # 服务端没有该会话（重启或已被淘汰），请求客户端重新发送完整上下文
+            emit('message', {'type': 'sync', 'content': user_message, 'session_id': session_id})
+            return
+        history = ConversationHistory(session_id)
+        history.add_user_message(user_message)
+    else:
+        history.add_user_message(user_message)
+    session_store.put(history)
     
+    # 发送开始标记（包含会话ID与用于续传的 message_id），之后的事件都经续传缓冲发送
+    reply = stream.reply = replay_store.create(stream.message_id, session_id, request.sid)
+    emit('message', {'type': 'start', 'content': '', 'session_id': session_id, 'message_id': stream.message_id})
+
+    emitter = StreamEmitter(reply)
     full_response = ""
+    first_token_time = None
+    upstream_failed = False
+    upstream_usage = {}
+    # 回复缓存（需开启 WEBCHAT_RESPONSE_CACHE；请求带 no_cache 时跳过）
+    use_cache = response_cache is not None and not data.get('no_cache')
+    if response_cache is not None and not use_cache:
+        CACHE_REQUESTS.inc(result='bypass', tier='')
+    api_messages = cached = None
+
+    def on_queued(position):
+        # 并发已满，通知客户端当前排队位置
+        if reply.sid is not None:
+            socketio.emit('message', {'type': 'queued', 'position': position, 'session_id': session_id,
+                                      'message_id': reply.message_id}, to=reply.sid)
+
+    # 准入名额：本轮首次请求上游（摘要或回复）时获取，之后共用，本轮结束时释放；命中缓存不占名额
+    slot = contextlib.ExitStack()
+    admitted = False
+
+    def admit():
+        nonlocal admitted
+        if not admitted:
+            slot.enter_context(admission.admit(session_id, client_ip, on_queued, cancel=cancel))
+            admitted = True
+
+    def summarize(messages, previous_summary):
+        # 摘要调用同样受准入控制，停止生成或断开时一起取消
+        admit()
+        return summarize_messages(messages, previous_summary, cancel=cancel)
+
     try:
-        for chunk in deepseek1(api_messages):
-            if chunk:
-                full_response += chunk
-                # 实时发送到前端（包含会话ID）
-                emit('message', {
-                    'type': 'stream',
-                    'content': chunk.replace('\n', '\n'),
-                    'session_id': session_id
-                })
-                
+        if CONTEXT_SUMMARY:
+            history.compact(summarize)
+        api_messages = history.get_context()
+        cached = response_cache.get(DEEPSEEK_MODEL, api_messages) if use_cache else None
+        if cached is not None:
+            # 命中缓存：按同样的 stream 事件回放
+            first_token_time = time.perf_counter()
+            full_response = cached
+            for offset in range(0, len(cached), CACHE_REPLAY_CHUNK_CHARS):
+                cancel.check()
+                if not emitter.push(cached[offset:offset + CACHE_REPLAY_CHUNK_CHARS]):
+                    return
+                socketio.sleep(0)
+        else:
+            admit()
+            for chunk in stream_completion(api_messages, 'web', usage=upstream_usage, cancel=cancel):
+                if chunk:
+                    if first_token_time is None:
+                        first_token_time = time.perf_counter()
+                    full_response += chunk
+                    # 合并后发送到前端（包含会话ID）
+                    if not emitter.push(chunk):
+                        # 慢消费者已被断开，不再读取上游
+                        return
+                    # 让出执行权，协程模式下保证其他流的 emit 能及时发出
+                    socketio.sleep(0)
+        emitter.flush()
+
+    except StreamCancelled as e:
+        upstream_failed = True  # 不完整的回复不写入缓存
+        log_event('chat_cancelled', session_id=session_id, client_ip=client_ip, reason=e.reason,
+                  completion_tokens=estimate_tokens(full_response))
+        if e.reason == 'disconnect':
+            # 客户端已离开：不再发送事件，也不保存不完整的回复
+            return
+        # 停止生成：已收到的内容照常发送并保存
+        emitter.flush()
+    except AdmissionRejected as e:
+        upstream_failed = True
+        log_event('admission_rejected', level=logging.WARNING, session_id=session_id, client_ip=client_ip,
+                  reason=e.reason, retry_after=e.retry_after)
+        # 撤回未被处理的用户消息，否则重试后历史中会出现两条连续的用户消息
+        if history.messages and history.messages[-1]['role'] == 'user':
+            history.pop_message()
+            session_store.put(history)
+        if e.reason == 'rate_limited':
+            content = f"请求过于频繁，请 {max(1, round(e.retry_after))} 秒后重试"
+        else:
+            content = "服务繁忙，请稍后重试"
+        reply.send_final({'type': 'error', 'content': content, 'reason': e.reason,
+                          'retry_after': e.retry_after, 'session_id': session_id})
     except Exception as e:
-        print(f"\n[{current_time}] [会话ID: {session_id}] [错误] {str(e)}\n")
-        emit('message', {
+        upstream_failed = True
+        emitter.flush()
+        log_event('upstream_error', level=logging.ERROR, session_id=session_id, client_ip=client_ip,
+                  error=str(e), error_type=type(e).__name__)
+        reply.send_final({
             'type': 'error',
-            'content': f"处理出错: {str(e)}",
+            # 熔断时快速失败，提示用户稍后重试
+            'content': "上游服务暂时不可用，请稍后重试" if isinstance(e, UpstreamUnavailable) else f"处理出错: {str(e)}",
             'session_id': session_id
         })
+    finally:
+        slot.close()
     
     # 发送结束标记（包含会话ID）
-    emit('message', {'type': 'end', 'content': '', 'session_id': session_id})
+    reply.send_final({'type': 'end', 'content': '', 'session_id': session_id})
     
-    # 打印带会话信息的完整AI响应
     if full_response:
-        print(f"\n[{current_time}] [会话ID: {session_id}] [AI完整响应]")
-        print("-"*50)
-        print(full_response)
-        print("-"*50 + "\n")
+        history.add_assistant_message(full_response)
+        session_store.put(history)
+        if use_cache and cached is None and not upstream_failed:
+            response_cache.put(DEEPSEEK_MODEL, api_messages, full_response)
+
+    # 记录带会话信息的完整AI响应
+    log_event('chat_completed',
+              session_id=session_id,
+              client_ip=client_ip,
+              mode='web',
+              latency_ms=round((time.perf_counter() - started) * 1000, 1),
+              ttft_ms=round((first_token_time - started) * 1000, 1) if first_token_time else None,
+              prompt_tokens=history.last_context_tokens,
+              completion_tokens=estimate_tokens(full_response),
+              cache_hit=cached is not None,
+              upstream_prompt_tokens=upstream_usage.get('prompt_tokens'),
+              prompt_cache_hit_tokens=upstream_usage.get('prompt_cache_hit_tokens'),
+              bodies={'response': full_response})
     
     # 保存完整响应（包含会话ID）
-    emit('message', {
+    reply.send_final({
         'type': 'full',
         'content': full_response,
         'session_id': session_id
     })
 
+# 上下文 token 预算（需为模型输出预留空间）
+CONTEXT_MAX_TOKENS = int(os.getenv('WEBCHAT_CONTEXT_TOKENS', '24000'))
+# 超出预算时是否将被截断的历史压缩为摘要（需要额外一次上游调用）
+CONTEXT_SUMMARY = os.getenv('WEBCHAT_CONTEXT_SUMMARY', '0') == '1'
+MESSAGE_OVERHEAD_TOKENS = 4  # 每条消息的角色/分隔符开销
+_CJK_PATTERN = re.compile(r'[\u2e80-\u9fff\uac00-\ud7af\uff00-\uffef]')
+
+
+def estimate_tokens(text):
+    """估算文本的 token 数（CJK 字符约 1 token/字，其余约 4 字符/token）"""
+    if not text:
+        return 0
+    non_cjk = len(_CJK_PATTERN.sub('', text))
+    return (len(text) - non_cjk) + (non_cjk + 3) // 4
+
+
+def _message_text(msg):
+    """消息中计入内存与 token 预算的文本（内容 + 工具调用参数）"""
+    text = msg.get('content') or ''
+    for call in msg.get('tool_calls') or ():
+        text += call['function']['name'] + call['function']['arguments']
+    return text
+
+
+def summarize_messages(messages, previous_summary=None, cancel=None):
+    """调用模型将被截断的历史对话压缩为摘要（经 stream_completion，与回复共用路由、熔断与指标）"""
+    transcript = "\n".join(f"{msg['role']}: {_message_text(msg)}" for msg in messages)
+    if previous_summary:
+        transcript = f"[此前的摘要]\n{previous_summary}\n\n[新增对话]\n{transcript}"
+    prompt = [
+        {"role": "system", "content": "将以下对话压缩为简洁的摘要，保留用户目标、已确定的事实、文件路径和未完成的任务，不要添加新内容。"},
+        {"role": "user", "content": transcript},
+    ]
+    return ''.join(stream_completion(prompt, 'summary', cancel=cancel))
+
+
 # 新增对话历史管理类
 class ConversationHistory:
     def __init__(self, session_id=None):
         self.session_id = session_id or str(uuid.uuid4())
         self.messages = []
         self.last_modified = datetime.now()
+        self.size_bytes = 0  # 消息内容占用的字节数（增量维护，用于内存预算）
+        self.token_counts = []  # 与 messages 一一对应的 token 估算值（增量维护）
+        self.system_prompt = None  # 每次请求都固定放在最前面的系统提示
+        self.summary = None  # messages[:summary_upto] 的摘要
+        self.summary_upto = 0
+        # 上下文窗口起点：只在超出预算时一次性前移（检查点），其余请求的前缀保持不变以命中上游前缀缓存
+        self.window_start = 0
+        self.last_context_tokens = 0  # 最近一次 get_context 返回的上下文 token 估算
+        self.store = None  # 持久化存储（ConversationStore），设置后新消息逐条追加写入
+        self.store_version = None  # 最近一次写入/加载时存储中的会话版本（多 worker 共享时判断是否过期）
+    
+    @classmethod
+    def from_messages(cls, session_id, messages):
+        """从客户端上传的消息列表构建对话历史"""
+        history = cls(session_id)
+        for msg in messages:
+            history.add_message(msg.get('role', 'user'), msg.get('content', ''))
+        return history
+    
+    def add_message(self, role, content, **extra):
+        """添加任意角色的消息（extra 为 tool_calls、tool_call_id 等附加字段）"""
+        msg = {"role": role, "content": content, **extra}
+        self.messages.append(msg)
+        text = _message_text(msg)
+        self.size_bytes += len(text.encode('utf-8'))
+        self.token_counts.append(estimate_tokens(text) + MESSAGE_OVERHEAD_TOKENS)
+        self.last_modified = datetime.now()
+        if self.store is not None:
+            self._persist(self.store.append, len(self.messages) - 1, msg)
     
+    def pop_message(self):
+        """移除最后一条消息（请求未被处理时撤回用户消息）"""
+        msg = self.messages.pop()
+        self.token_counts.pop()
+        self.size_bytes -= len(_message_text(msg).encode('utf-8'))
+        self.window_start = min(self.window_start, len(self.messages))
+        self.summary_upto = min(self.summary_upto, len(self.messages))
+        self.last_modified = datetime.now()
+        if self.store is not None:
+            self._persist(self.store.truncate, len(self.messages))
+        return msg
+
     def add_user_message(self, content):
         """添加用户消息"""
-        self.messages.append({"role": "user", "content": content})
-        self.last_modified = datetime.now()
+        self.add_message("user", content)
     
     def add_assistant_message(self, content):
         """添加AI回复"""
-        self.messages.append({"role": "assistant", "content": content})
-        self.last_modified = datetime.now()
+        self.add_message("assistant", content)
     
+    def _head_messages(self):
+        """固定保留的前缀：系统提示、历史开头的系统消息、摘要，返回 (消息列表, 历史中的前缀条数, token 数)"""
+        head = []
+        head_tokens = 0
+        if self.system_prompt:
+            head.append({"role": "system", "content": self.system_prompt})
+            head_tokens += estimate_tokens(self.system_prompt) + MESSAGE_OVERHEAD_TOKENS
+        pinned = 0
+        while pinned < len(self.messages) and self.messages[pinned]['role'] == 'system':
+            head.append(self.messages[pinned])
+            head_tokens += self.token_counts[pinned]
+            pinned += 1
+        if self.summary:
+            summary_content = f"[对话摘要] {self.summary}"
+            head.append({"role": "system", "content": summary_content})
+            head_tokens += estimate_tokens(summary_content) + MESSAGE_OVERHEAD_TOKENS
+        return head, pinned, head_tokens
+
+    def _window_start(self, max_tokens):
+        """计算预算内可保留的最早消息下标（最近一条用户消息及其后的工具结果始终保留）"""
+        head, pinned, head_tokens = self._head_messages()
+        budget = max_tokens - head_tokens
+        start = max(self.window_start, self.summary_upto, pinned)
+
+        # 从最近一条用户消息开始的尾部必须保留
+        keep_from = len(self.messages)
+        for index in range(len(self.messages) - 1, start - 1, -1):
+            keep_from = index
+            if self.messages[index]['role'] == 'user':
+                break
+        budget -= sum(self.token_counts[keep_from:])
+
+        # 向前追加更早的消息，直到超出预算
+        while keep_from > start and budget >= self.token_counts[keep_from - 1]:
+            keep_from -= 1
+            budget -= self.token_counts[keep_from]
+        # 工具结果不能脱离发起调用的 assistant 消息单独出现
+        while keep_from < len(self.messages) and self.messages[keep_from]['role'] == 'tool':
+            keep_from += 1
+        return head, keep_from
+
     def get_context(self, max_tokens=None):
-        """获取对话上下文（自动截断过长的历史）"""
-        # TODO: max_tokens 参数暂未使用，可以基于 token 数量截断
-        # 简单实现：保留最近的N条消息
-        return self.messages[-10:]  # 保留最近10轮对话
+        """获取对话上下文（按 token 预算截断过长的历史，始终保留系统提示与最新的工具结果）
+
+        上下文是只追加的：系统提示与摘要固定在最前，窗口起点只在超出预算时前移到预算的一半，
+        因此同一会话连续的请求（包括工具循环的每次迭代）共享尽可能长的相同前缀。
+        """
+        max_tokens = max_tokens or CONTEXT_MAX_TOKENS
+        head, pinned, head_tokens = self._head_messages()
+        keep_from = max(self.window_start, self.summary_upto, pinned)
+        context_tokens = head_tokens + sum(self.token_counts[keep_from:])
+        if context_tokens > max_tokens:
+            # 检查点：窗口一次前移到半个预算，之后多轮请求前缀不变
+            _, keep_from = self._window_start(max_tokens // 2)
+            self.window_start = keep_from
+            self._save_meta()
+            context_tokens = head_tokens + sum(self.token_counts[keep_from:])
+        self.last_context_tokens = context_tokens
+        return head + self.messages[keep_from:]
+
+    def compact(self, summarizer=summarize_messages, max_tokens=None):
+        """将超出预算的早期对话压缩为摘要，返回是否进行了压缩
+
+        压缩到预算的一半，避免之后每轮都触发摘要调用
+        """
+        max_tokens = max_tokens or CONTEXT_MAX_TOKENS
+        _, pinned, _ = self._head_messages()
+        start = max(self.summary_upto, pinned)
+        _, keep_from = self._window_start(max_tokens)
+        if keep_from <= start:
+            return False
+        _, keep_from = self._window_start(max_tokens // 2)
+        dropped = self.messages[start:keep_from]
+        if not dropped:
+            return False
+        self.summary = summarizer(dropped, self.summary)
+        self.summary_upto = keep_from
+        self._save_meta()
+        return True
+
+    def _meta(self):
+        return {"summary": self.summary, "summary_upto": self.summary_upto, "window_start": self.window_start}
+
+    def _persist(self, write, *args):
+        """写入持久化存储，失败只记录日志，不影响对话"""
+        try:
+            self.store_version = write(self.session_id, *args)
+        except sqlite3.Error as e:
+            log_event('session_write_failed', level=logging.WARNING, session_id=self.session_id, error=str(e))
+
+    def _save_meta(self):
+        if self.store is not None:
+            self._persist(self.store.update_meta, self._meta())
+
+    def persist_to(self, store):
+        """开始持久化到 store：写入当前全部消息，之后的新消息逐条追加"""
+        self.store = store
+        self._persist(store.replace, self.messages, self._meta())
+
+    @classmethod
+    def _restore(cls, session_id, messages, meta):
+        history = cls(session_id)
+        history.messages = messages
+        history.size_bytes = sum(len(_message_text(msg).encode('utf-8')) for msg in messages)
+        history.token_counts = [estimate_tokens(_message_text(msg)) + MESSAGE_OVERHEAD_TOKENS for msg in messages]
+        history.summary = meta.get("summary")
+        history.summary_upto = meta.get("summary_upto", 0)
+        history.window_start = meta.get("window_start", 0)
+        return history
+
+    @classmethod
+    def load_from_store(cls, store, session_id):
+        """从持久化存储加载对话历史（之后的新消息继续追加到该存储），不存在返回 None"""
+        record = store.load(session_id)
+        if record is None:
+            return None
+        messages, meta, version, updated = record
+        history = cls._restore(session_id, messages, meta)
+        history.last_modified = datetime.fromtimestamp(updated)
+        history.store = store
+        history.store_version = version
+        return history
     
     def save(self, file_path):
         """保存对话历史到文件"""
@@ -110,6 +797,9 @@ class ConversationHistory:
             json.dump({
                 "session_id": self.session_id,
                 "messages": self.messages,
+                "summary": self.summary,
+                "summary_upto": self.summary_upto,
+                "window_start": self.window_start,
                 "last_modified": self.last_modified.isoformat()
             }, f, ensure_ascii=False, indent=2)
     
@@ -119,13 +809,233 @@ class ConversationHistory:
         try:
             with open(file_path, 'r', encoding='utf-8') as f:
                 data = json.load(f)
-                history = cls(data.get("session_id"))
-                history.messages = data.get("messages", [])
+                history = cls._restore(data.get("session_id"), data.get("messages", []), data)
                 history.last_modified = datetime.fromisoformat(data["last_modified"])
                 return history
         except (FileNotFoundError, json.JSONDecodeError):
             return None
-        
+
+
+# 服务端会话存储配置
+MAX_SESSIONS = int(os.getenv('WEBCHAT_MAX_SESSIONS', '1000'))
+SESSION_MEMORY_BUDGET = int(os.getenv('WEBCHAT_SESSION_MEMORY_MB', '64')) * 1024 * 1024
+SESSION_SPILL_DIR = os.getenv('WEBCHAT_SESSION_SPILL_DIR')  # 未启用会话存储时使用，为空则淘汰的会话直接丢弃
+SESSION_IDLE_SECONDS = int(os.getenv('WEBCHAT_SESSION_IDLE_SECONDS', '1800'))
+# 多 worker 共享会话：共享会话存储（或落盘目录），其他 worker 发现会话更新后重新加载
+SESSION_SHARED = os.getenv('WEBCHAT_SESSION_SHARED', '0') == '1'
+
+
+class SessionStore:
+    """服务端会话存储：按 session_id 缓存 ConversationHistory，LRU 淘汰并受内存预算限制
+
+    设置 store（ConversationStore）时每条消息都已追加写入存储，淘汰/空闲的会话直接从内存移除，
+    再次访问时从存储加载；否则可选将空闲/被淘汰的会话整体落盘到 spill_dir。
+
+    shared 为 True 时存储（或落盘目录）由多个 worker 共享：读取时存储中的版本比内存中的新则重新加载。
+    """
+
+    def __init__(self, max_sessions=MAX_SESSIONS, memory_budget=SESSION_MEMORY_BUDGET,
+                 spill_dir=SESSION_SPILL_DIR, idle_seconds=SESSION_IDLE_SECONDS, shared=SESSION_SHARED, store=None):
+        if shared and not (store or spill_dir):
+            raise ValueError('WEBCHAT_SESSION_SHARED requires WEBCHAT_STORE_PATH or WEBCHAT_SESSION_SPILL_DIR')
+        self.max_sessions = max_sessions
+        self.memory_budget = memory_budget
+        self.store = store
+        self.spill_dir = None if store else spill_dir
+        self.idle_seconds = idle_seconds
+        self.shared = shared
+        self._sessions = OrderedDict()  # session_id -> ConversationHistory（按最近使用排序）
+        self._sizes = {}  # session_id -> 计入预算的字节数
+        self._versions = {}  # session_id -> 共享文件的 mtime_ns（shared 模式）
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self._last_idle_check = time.monotonic()
+        if self.spill_dir:
+            os.makedirs(self.spill_dir, exist_ok=True)
+
+    def _spill_path(self, session_id):
+        # session_id 来自客户端，只保留安全字符作为文件名
+        safe_id = re.sub(r'[^A-Za-z0-9_-]', '_', session_id)
+        return os.path.join(self.spill_dir, f"{safe_id}.json")
+
+    def get(self, session_id):
+        """获取会话历史（内存未命中时尝试从存储或磁盘加载），不存在返回 None"""
+        with self._lock:
+            history = self._sessions.get(session_id)
+            if history is not None:
+                self._sessions.move_to_end(session_id)
+                if not self.shared:
+                    return history
+        if self.store is not None:
+            return self._get_stored(session_id, history)
+        if not self.spill_dir:
+            return None
+        spill_path = self._spill_path(session_id)
+        if self.shared:
+            return self._get_shared(session_id, spill_path, history)
+        history = ConversationHistory.load(spill_path)
+        if history is not None:
+            try:
+                os.remove(spill_path)
+            except OSError:
+                pass
+            self.put(history)
+        return history
+
+    def _get_stored(self, session_id, history):
+        """从会话存储加载（shared 模式下内存中的会话已被其他 worker 更新时重新加载）"""
+        try:
+            if history is not None and self.store.version(session_id) == history.store_version:
+                return history
+            loaded = ConversationHistory.load_from_store(self.store, session_id)
+        except sqlite3.Error as e:
+            log_event('session_load_failed', level=logging.WARNING, session_id=session_id, error=str(e))
+            return history
+        if loaded is None:
+            return history
+        self._cache(loaded)
+        return loaded
+
+    def _get_shared(self, session_id, spill_path, history):
+        """共享目录中的版本比内存中的新（被其他 worker 更新过）时重新加载"""
+        try:
+            version = os.stat(spill_path).st_mtime_ns
+        except OSError:
+            return history
+        if history is not None and self._versions.get(session_id) == version:
+            return history
+        loaded = ConversationHistory.load(spill_path)
+        if loaded is None:
+            return history
+        self._cache(loaded)
+        self._versions[session_id] = version
+        return loaded
+
+    def put(self, history):
+        """保存/更新会话（消息变化后调用以重新计算内存占用；新建的会话此时写入会话存储）"""
+        if self.store is not None and history.store is not self.store:
+            history.persist_to(self.store)
+        self._cache(history)
+        if self.shared and self.store is None:
+            self._write_shared(history)
+
+    def _write_shared(self, history):
+        """写入共享目录（临时文件 + rename，其他 worker 不会读到写了一半的文件）"""
+        spill_path = self._spill_path(history.session_id)
+        temp_path = f"{spill_path}.{os.getpid()}.tmp"
+        try:
+            history.save(temp_path)
+            os.replace(temp_path, spill_path)
+            self._versions[history.session_id] = os.stat(spill_path).st_mtime_ns
+        except OSError as e:
+            log_event('session_write_failed', level=logging.WARNING, session_id=history.session_id, error=str(e))
+
+    def _cache(self, history):
+        with self._lock:
+            session_id = history.session_id
+            self.total_bytes += history.size_bytes - self._sizes.get(session_id, 0)
+            self._sizes[session_id] = history.size_bytes
+            self._sessions[session_id] = history
+            self._sessions.move_to_end(session_id)
+            evicted = self._evict_locked()
+        self._spill(evicted)
+        self._spill(self._collect_idle())
+
+    def _evict_locked(self):
+        """按 LRU 淘汰超出会话数量或内存预算的会话（保留最近使用的一个）"""
+        evicted = []
+        while len(self._sessions) > 1 and (len(self._sessions) > self.max_sessions
+                                            or self.total_bytes > self.memory_budget):
+            evicted.append(self._pop_locked(next(iter(self._sessions))))
+        return evicted
+
+    def _pop_locked(self, session_id):
+        history = self._sessions.pop(session_id)
+        self.total_bytes -= self._sizes.pop(session_id)
+        self._versions.pop(session_id, None)
+        return history
+
+    def _collect_idle(self):
+        """移出空闲超时的会话（最多每分钟检查一次）"""
+        if not (self.spill_dir or self.store) or time.monotonic() - self._last_idle_check < 60:
+            return []
+        with self._lock:
+            self._last_idle_check = time.monotonic()
+            now = datetime.now()
+            idle_ids = [sid for sid, history in self._sessions.items()
+                        if (now - history.last_modified).total_seconds() > self.idle_seconds]
+            return [self._pop_locked(sid) for sid in idle_ids]
+
+    def _spill(self, histories):
+        if not self.spill_dir or self.shared:
+            # 会话存储与 shared 模式下每次更新都已写入，淘汰时无需再写
+            return
+        for history in histories:
+            try:
+                history.save(self._spill_path(history.session_id))
+            except OSError as e:
+                log_event('session_spill_failed', level=logging.WARNING, session_id=history.session_id, error=str(e))
+
+    def stats(self):
+        with self._lock:
+            return {'sessions': len(self._sessions), 'bytes': self.total_bytes}
+
+
+# 会话持久化存储（WEBCHAT_STORE_PATH 为空时不启用），Web 与本地模式共用；启动时由 init_session_store() 打开
+conversation_store = None
+session_store = None
+
+
+def init_session_store(path=STORE_PATH, maintenance=True):
+    """打开会话存储并创建 session_store（导入 app 不会创建数据库文件）
+
+    maintenance 为 False 时（cluster.py 启动的 worker）跳过启动时的 VACUUM 与过期清理，由主进程统一执行一次，
+    避免所有 worker 同时启动时争用数据库锁。
+    """
+    global conversation_store, session_store
+    conversation_store = ConversationStore(path, vacuum=maintenance) if path else None
+    if conversation_store is not None and maintenance and STORE_RETENTION_DAYS > 0:
+        conversation_store.compact()
+    session_store = SessionStore(store=conversation_store)
+    return session_store
+
+admission = AdmissionController()
+
+CACHE_REPLAY_CHUNK_CHARS = 64  # 缓存命中时每个回放增量的字符数
+response_cache = ResponseCache() if CACHE_ENABLED else None
+
+# 断线后回复继续生成并写入续传缓冲的宽限时间（秒），0 表示断线立即取消
+RESUME_GRACE_SECONDS = float(os.getenv('WEBCHAT_RESUME_GRACE_SECONDS', '30'))
+replay_store = ReplayStore(lambda payload, sid: socketio.emit('message', payload, to=sid))
+
+# 导出已有的统计快照
+CallbackMetric('webchat_upstream_pool_hits_total', 'Upstream requests served by a pooled connection',
+               lambda: get_pool_stats()['hits'], 'counter')
+CallbackMetric('webchat_upstream_pool_misses_total', 'Upstream requests that opened a new connection',
+               lambda: get_pool_stats()['misses'], 'counter')
+CallbackMetric('webchat_upstream_connect_seconds_avg', 'Average upstream TCP+TLS connect time',
+               lambda: get_pool_stats()['connect_time_avg'])
+CallbackMetric('webchat_stream_frames_total', 'Coalesced stream frames emitted',
+               lambda: emit_stats.snapshot()['frames_sent'], 'counter')
+CallbackMetric('webchat_stream_bytes_total', 'Stream bytes emitted',
+               lambda: emit_stats.snapshot()['bytes_sent'], 'counter')
+CallbackMetric('webchat_slow_consumers_dropped_total', 'Clients disconnected for not keeping up',
+               lambda: emit_stats.snapshot()['slow_consumers_dropped'], 'counter')
+CallbackMetric('webchat_sessions', 'Sessions held in memory', lambda: session_store.stats()['sessions'])
+CallbackMetric('webchat_session_bytes', 'Message bytes held by in-memory sessions',
+               lambda: session_store.stats()['bytes'])
+CallbackMetric('webchat_resume_buffers', 'Reply replay buffers held for resumption',
+               lambda: replay_store.stats()['buffers'])
+CallbackMetric('webchat_resume_buffer_bytes', 'Bytes held by reply replay buffers', lambda: replay_store.stats()['bytes'])
+CallbackMetric('webchat_admission_active', 'Upstream completions admitted and running',
+               lambda: admission.stats()['active'])
+CallbackMetric('webchat_admission_queued', 'Completions waiting for admission', lambda: admission.stats()['queued'])
+if response_cache is not None:
+    CallbackMetric('webchat_response_cache_entries', 'Responses held in the in-memory cache tier',
+                   lambda: response_cache.stats()['entries'])
+    CallbackMetric('webchat_response_cache_bytes', 'Response bytes held in the in-memory cache tier',
+                   lambda: response_cache.stats()['bytes'])
+
 def sanitize_path(path):
     """清理路径中的不可见Unicode字符"""
     # 移除所有不可见控制字符
@@ -134,12 +1044,236 @@ def sanitize_path(path):
     return cleaned_path.strip()
 
 
+# 文件读取限制：单次返回给模型的内容不超过该字节数，超出时返回开头与结尾的摘录
+READ_MAX_BYTES = int(os.getenv('WEBCHAT_READ_MAX_BYTES', '65536'))
+READ_MMAP_BYTES = 1024 * 1024  # 超过该大小的文件用 mmap 按需读取，不整体载入内存
+BINARY_SNIFF_BYTES = 8192  # 检测二进制文件时读取的开头字节数
+
+
+def _line_span(data, size, offset, limit, max_bytes=None):
+    """计算第 offset 行（从 1 开始）起 limit 行的字节范围（data 为 bytes 或 mmap）
+
+    指定 max_bytes 时最多向后扫描 max_bytes + 1 字节：结束位置超过 start + max_bytes 表示内容需要截断
+    """
+    start = 0
+    for _ in range(offset - 1):
+        newline = data.find(b'\n', start)
+        if newline < 0:
+            return size, size
+        start = newline + 1
+    stop = size if max_bytes is None else min(size, start + max_bytes + 1)
+    if limit is None:
+        return start, stop
+    end = start
+    for _ in range(limit):
+        newline = data.find(b'\n', end, stop)
+        if newline < 0:
+            return start, stop
+        end = newline + 1
+    return start, end
+
+
+# 目录列表限制与目录快照缓存
+LIST_MAX_ENTRIES = int(os.getenv('WEBCHAT_LIST_MAX_ENTRIES', '1000'))
+LIST_CACHE_SECONDS = float(os.getenv('WEBCHAT_LIST_CACHE_SECONDS', '2'))
+LIST_CACHE_MAX_DIRS = 4096
+_dir_cache = OrderedDict()  # 目录路径 -> (mtime_ns, 缓存时间, 条目, .gitignore 规则)
+_dir_cache_lock = threading.Lock()
+
+
+def _parse_gitignore(path):
+    """解析 .gitignore，返回 [(模式, 是否取反, 是否只匹配目录, 是否相对该目录锚定)]"""
+    rules = []
+    try:
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            for line in f:
+                line = line.rstrip('\n').rstrip()
+                if not line or line.startswith('#'):
+                    continue
+                negate = line.startswith('!')
+                line = line[1:] if negate else line
+                dir_only = line.endswith('/')
+                line = line.rstrip('/')
+                anchored = '/' in line
+                rules.append((line.lstrip('/'), negate, dir_only, anchored))
+    except OSError:
+        pass
+    return rules
+
+
+def _dir_snapshot(path):
+    """目录快照：[(名称, 是否目录, 大小, 是否符号链接, mtime_ns)] 与该目录 .gitignore 规则
+
+    scandir 的 DirEntry 自带类型信息，每个文件只需一次 stat 取大小；目录 mtime 未变且未过期时直接复用
+    """
+    mtime = os.stat(path).st_mtime_ns
+    now = time.monotonic()
+    with _dir_cache_lock:
+        cached = _dir_cache.get(path)
+        if cached and cached[0] == mtime and now - cached[1] < LIST_CACHE_SECONDS:
+            _dir_cache.move_to_end(path)
+            return cached[2], cached[3]
+
+    entries = []
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                is_dir = entry.is_dir()
+                stat = None if is_dir else entry.stat()
+            except OSError:
+                is_dir, stat = False, None
+            entries.append((entry.name, is_dir, stat.st_size if stat else 0, entry.is_symlink(),
+                            stat.st_mtime_ns if stat else 0))
+    entries.sort()
+    rules = _parse_gitignore(os.path.join(path, '.gitignore')) if any(e[0] == '.gitignore' for e in entries) else []
+
+    with _dir_cache_lock:
+        _dir_cache[path] = (mtime, now, entries, rules)
+        _dir_cache.move_to_end(path)
+        while len(_dir_cache) > LIST_CACHE_MAX_DIRS:
+            _dir_cache.popitem(last=False)
+    return entries, rules
+
+
+def invalidate_dir_cache(path):
+    """文件被修改后清除所在目录的快照（文件大小变化不会改变目录 mtime）"""
+    with _dir_cache_lock:
+        _dir_cache.pop(os.path.dirname(path), None)
+
+
+def _gitignored(rule_stack, rel_path, name, is_dir):
+    """按 .gitignore 规则判断是否忽略，后出现的规则优先
+
+    rule_stack 为 [(规则所在目录相对 root 的路径, 前缀, 规则)]；root 上层目录的规则以 root 相对该目录的路径为前缀
+    """
+    ignored = False
+    for base, prefix, rules in rule_stack:
+        if base and not rel_path.startswith(base + '/'):
+            continue
+        local = prefix + (rel_path[len(base) + 1:] if base else rel_path)
+        for pattern, negate, dir_only, anchored in rules:
+            if dir_only and not is_dir:
+                continue
+            if fnmatch.fnmatchcase(local if anchored else name, pattern):
+                ignored = not negate
+    return ignored
+
+
+def iter_dir_entries(root, show_hidden=False, recursive=False, max_depth=None, pattern=None,
+                     respect_gitignore=True, top=None):
+    """流式遍历目录，按 os.walk 的顺序 yield (相对 root 的路径, 是否目录, 大小, mtime_ns)
+
+    recursive 时遵循 .gitignore（包括 root 到 top 之间各上层目录的）并跳过 .git 目录；
+    pattern 为 glob，匹配名称或相对路径（只过滤输出，不影响遍历）
+    """
+    inherited = []
+    if recursive and respect_gitignore and top:
+        ancestor = os.path.dirname(root)
+        while ancestor.startswith(top) and ancestor != root:
+            rules = _parse_gitignore(os.path.join(ancestor, '.gitignore'))
+            if rules:
+                inherited.insert(0, ('', os.path.relpath(root, ancestor).replace(os.sep, '/') + '/', rules))
+            if ancestor == top:
+                break
+            ancestor = os.path.dirname(ancestor)
+    stack = [('', 0, inherited)]
+    while stack:
+        rel_dir, depth, rule_stack = stack.pop()
+        entries, rules = _dir_snapshot(os.path.join(root, rel_dir) if rel_dir else root)
+        if recursive and respect_gitignore and rules:
+            rule_stack = rule_stack + [(rel_dir, '', rules)]
+        subdirs = []
+        for name, is_dir, size, is_symlink, mtime in entries:
+            if not show_hidden and name.startswith('.'):
+                continue
+            rel_path = f"{rel_dir}/{name}" if rel_dir else name
+            if recursive and (name == '.git' or (rule_stack and _gitignored(rule_stack, rel_path, name, is_dir))):
+                continue
+            if not pattern or fnmatch.fnmatch(name, pattern) or fnmatch.fnmatch(rel_path, pattern):
+                yield rel_path, is_dir, size, mtime
+            # 不跟随符号链接目录，避免循环
+            if recursive and is_dir and not is_symlink and (max_depth is None or depth + 1 < max_depth):
+                subdirs.append((rel_path, depth + 1, rule_stack))
+        stack.extend(reversed(subdirs))
+
+
+WRITE_FSYNC = os.getenv('WEBCHAT_WRITE_FSYNC', '0') == '1'  # 写入后 fsync 文件与目录（断电安全，较慢）
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+WRITE_BATCH = os.getenv('WEBCHAT_WRITE_BATCH', '1') == '1'  # 工具循环中同一轮的写入暂存，本轮结束时一起提交
+
+_HUNK_HEADER = re.compile(r'^@@ -(\d+)(?:,\d+)? \+\d+(?:,\d+)? @@')
+_SEARCH_REPLACE_BLOCK = re.compile(r'<{5,} SEARCH\r?\n(.*?)\r?\n?={5,}\r?\n(.*?)\r?\n?>{5,} REPLACE', re.DOTALL)
+
+
+def apply_search_replace(text, blocks):
+    """依次应用 (search, replace) 替换块，search 必须在文件中恰好出现一次"""
+    for index, (search, replace) in enumerate(blocks, 1):
+        if not search:
+            raise ValueError(f"block {index}: search text is empty")
+        count = text.count(search)
+        if count == 0 and '\r\n' in text:
+            # 模型输出的 search/replace 通常使用 \n 换行
+            search, replace = search.replace('\n', '\r\n'), replace.replace('\n', '\r\n')
+            count = text.count(search)
+        if count != 1:
+            raise ValueError(f"block {index}: search text {'not found' if count == 0 else f'matches {count} times'}")
+        text = text.replace(search, replace, 1)
+    return text
+
+
+def apply_unified_diff(text, diff):
+    """应用 unified diff；按上下文与删除行定位每个 hunk（行号只作为优先查找位置），返回 (新文本, 增加行数, 删除行数)"""
+    lines = text.splitlines(keepends=True)
+    newline = '\r\n' if text.count('\r\n') * 2 > text.count('\n') else '\n'
+    hunks = []
+    added = removed = 0
+    for line in diff.splitlines():
+        header = _HUNK_HEADER.match(line)
+        if header:
+            hunks.append((int(header.group(1)), [], []))
+        elif not hunks or line.startswith(('---', '+++', '\\')):
+            continue
+        elif line.startswith('+'):
+            hunks[-1][2].append(line[1:])
+            added += 1
+        elif line.startswith('-'):
+            hunks[-1][1].append(line[1:])
+            removed += 1
+        else:
+            # 上下文行（空行可能丢失了前导空格）
+            context = line[1:] if line.startswith(' ') else line
+            hunks[-1][1].append(context)
+            hunks[-1][2].append(context)
+    if not hunks:
+        raise ValueError("no hunks found in diff")
+
+    position = 0  # 后一个 hunk 只在前一个之后查找
+    for index, (start, old, new) in enumerate(hunks, 1):
+        stripped = [line.rstrip('\r\n') for line in lines]
+        candidates = [i for i in range(position, len(lines) - len(old) + 1) if stripped[i:i + len(old)] == old]
+        if not candidates:
+            raise ValueError(f"hunk {index} (@@ -{start}) does not match the file")
+        at = min(candidates, key=lambda i: abs(i - (start - 1)))
+        replacement = [line + newline for line in new]
+        if replacement and at + len(old) == len(lines) and lines and not lines[-1].endswith('\n'):
+            # 保持原文件末尾没有换行的状态
+            replacement[-1] = replacement[-1][:-len(newline)]
+        lines[at:at + len(old)] = replacement
+        position = at + len(replacement)
+    return ''.join(lines), added, removed
+
+
 # 文件操作管理类
 class FileManager:
     def __init__(self, base_dir=None):
         """初始化文件管理器，base_dir为工作目录（默认为当前工作目录）"""
         self.base_dir = base_dir if base_dir else os.getcwd()
         self.current_dir = self.base_dir
+        self._index = None  # 首次 SEARCH_FILES 时建立
+        self._index_lock = threading.Lock()
+        self._batch = None  # 批量提交模式下暂存的写入：目标路径 -> 临时文件路径（None 表示删除）
+        self._batch_lock = threading.Lock()
         print(f"[文件管理器] 工作目录: {self.base_dir}")
 
     def _resolve_path(self, path):
@@ -162,33 +1296,91 @@ class FileManager:
         except:
             return False
 
-    def read_file(self, file_path, encoding='utf-8'):
-        """读取文件内容"""
+    def read_file(self, file_path, encoding='utf-8', offset=None, limit=None, unit='lines'):
+        """读取文件内容
+
+        offset/limit 指定读取范围：unit 为 lines 时是起始行号（从 1 开始）与行数，为 bytes 时是起始字节与字节数。
+        返回内容不超过 READ_MAX_BYTES：未指定范围的大文件返回开头与结尾的摘录，指定范围时截断并提示下一段的起点。
+        """
         try:
             resolved_path = self._resolve_path(file_path)
             
             if not self._is_safe_path(resolved_path):
                 return f"[ERROR] Path out of working directory: {resolved_path}"
             
-            if not os.path.exists(resolved_path):
+            source = self._current_source(resolved_path)
+            if source is None or not os.path.exists(source):
                 return f"[ERROR] File not found: {resolved_path}"
             
-            if os.path.isdir(resolved_path):
+            if os.path.isdir(source):
                 return f"[ERROR] Path is a directory, not a file: {resolved_path}"
             
-            with open(resolved_path, 'r', encoding=encoding) as f:
-                content = f.read()
+            with open(source, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                if b'\0' in f.read(BINARY_SNIFF_BYTES):
+                    return f"[ERROR] Binary file, not shown ({size:,} bytes): {resolved_path}"
+                f.seek(0)
+                if size >= READ_MMAP_BYTES:
+                    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                        content, note = self._read_range(data, size, offset, limit, unit, encoding)
+                else:
+                    content, note = self._read_range(f.read(), size, offset, limit, unit, encoding)
             
             # 使用更清晰的格式返回文件内容
-            return f"[FILE_CONTENT] {resolved_path}\n{'='*60}\n{content}\n{'='*60}"
+            header = f"[FILE_CONTENT] {resolved_path}" + (f" ({note})" if note else '')
+            return f"{header}\n{'='*60}\n{content}\n{'='*60}"
         
         except PermissionError:
             return f"[ERROR] No read permission: {resolved_path}"
         except UnicodeDecodeError:
             return f"[ERROR] File encoding not supported (try utf-8 or gbk): {resolved_path}"
+        except (TypeError, ValueError) as e:
+            return f"[ERROR] Invalid read range: {str(e)}"
         except Exception as e:
             return f"[ERROR] Failed to read file: {str(e)}"
 
+    @staticmethod
+    def _read_range(data, size, offset, limit, unit, encoding):
+        """按范围与大小上限取出内容，返回 (文本, 范围说明)"""
+        if unit == 'bytes':
+            start = max(int(offset or 0), 0)
+            end = min(size, start + min(int(limit), READ_MAX_BYTES) if limit is not None else start + READ_MAX_BYTES)
+            note = f"bytes {start}-{end} of {size:,}"
+            if end < size:
+                note += f", continue with offset={end}"
+            # 字节范围可能截断多字节字符
+            return data[start:end].decode(encoding, errors='replace'), note
+
+        if offset is None and limit is None:
+            if size <= READ_MAX_BYTES:
+                return data[:size].decode(encoding), None
+            # 大文件：开头与结尾各取一半，按行边界对齐
+            half = READ_MAX_BYTES // 2
+            head_end = data.rfind(b'\n', 0, half) + 1 or half
+            tail_start = data.find(b'\n', size - half) + 1 or size - half
+            omitted = tail_start - head_end
+            content = (data[:head_end].decode(encoding, errors='replace')
+                       + f"\n... [省略 {omitted:,} 字节，可用 offset/limit 读取指定行] ...\n"
+                       + data[tail_start:size].decode(encoding, errors='replace'))
+            return content, f"excerpt, {size:,} bytes"
+
+        first_line = max(int(offset or 1), 1)
+        start, end = _line_span(data, size, first_line, int(limit) if limit is not None else None, READ_MAX_BYTES)
+        line_cut = False
+        if end - start > READ_MAX_BYTES:
+            end = data.rfind(b'\n', start, start + READ_MAX_BYTES) + 1
+            if not end:
+                # 单行超过上限：在行中截断，截断处可能拆开多字节字符
+                end, line_cut = start + READ_MAX_BYTES, True
+        content = data[start:end].decode(encoding, errors='replace' if line_cut else 'strict')
+        line_count = content.count('\n') + (0 if content.endswith('\n') or not content else 1)
+        note = f"lines {first_line}-{first_line + line_count - 1}" if line_count else f"no lines at offset {first_line}"
+        if line_cut:
+            note += f", line {first_line} truncated, continue with unit=bytes offset={end}"
+        elif end < size and (limit is None or line_count < int(limit)):
+            note += f", truncated, continue with offset={first_line + line_count}"
+        return content, note
+
     def write_file(self, file_path, content, encoding='utf-8'):
         """写入文件内容（创建或覆盖）"""
         try:
@@ -205,13 +1397,7 @@ class FileManager:
             if os.path.exists(resolved_path) and os.path.isdir(resolved_path):
                 return f"[ERROR] Path is a directory, not a file: {resolved_path}. Did you mean to write a file inside this directory?"
             
-            # 确保目录存在
-            dir_path = os.path.dirname(resolved_path)
-            if dir_path and not os.path.exists(dir_path):
-                os.makedirs(dir_path, exist_ok=True)
-            
-            with open(resolved_path, 'w', encoding=encoding) as f:
-                f.write(content)
+            self._atomic_write(resolved_path, content, encoding)
             
             return f"[SUCCESS] File written successfully: {resolved_path}"
         
@@ -230,11 +1416,15 @@ class FileManager:
             if not self._is_safe_path(resolved_path):
                 return f"[ERROR] Path out of working directory: {resolved_path}"
             
-            if not os.path.exists(resolved_path):
+            source = self._current_source(resolved_path)
+            if source is None or not os.path.exists(source):
                 return f"[ERROR] File not found (append mode): {resolved_path}"
             
-            with open(resolved_path, 'a', encoding=encoding) as f:
-                f.write(content)
+            # 与写入、编辑相同走临时文件 + rename，崩溃时不会留下追加了一半的文件；
+            # 批量模式下追加后的完整内容与其他写入一起提交
+            with open(source, 'r', encoding=encoding, newline='') as f:
+                existing = f.read()
+            self._atomic_write(resolved_path, existing + content, encoding)
             
             return f"[SUCCESS] Content appended to: {resolved_path}"
         
@@ -251,13 +1441,21 @@ class FileManager:
             if not self._is_safe_path(resolved_path):
                 return f"[ERROR] Path out of working directory: {resolved_path}"
             
-            if not os.path.exists(resolved_path):
+            source = self._current_source(resolved_path)
+            if source is None or not os.path.exists(source):
                 return f"[ERROR] File not found: {resolved_path}"
             
-            if os.path.isdir(resolved_path):
+            if os.path.isdir(source):
                 return f"[ERROR] Path is a directory: {resolved_path}"
             
+            with self._batch_lock:
+                if self._batch is not None:
+                    self._discard_temp(self._batch.get(resolved_path))
+                    self._batch[resolved_path] = None
+                    return f"[SUCCESS] File deleted: {resolved_path}"
+            
             os.remove(resolved_path)
+            self._file_changed(resolved_path)
             return f"[SUCCESS] File deleted: {resolved_path}"
         
         except PermissionError:
@@ -265,8 +1463,142 @@ class FileManager:
         except Exception as e:
             return f"[ERROR] Failed to delete file: {str(e)}"
 
-    def list_files(self, dir_path='.', show_hidden=False, recursive=False):
-        """列出目录下的文件"""
+    def edit_file(self, file_path, search=None, replace='', diff=None, encoding='utf-8'):
+        """局部修改文件：search/replace 替换，或 diff（unified diff 或 SEARCH/REPLACE 块），原子写回"""
+        try:
+            resolved_path = self._resolve_path(file_path)
+            
+            if not self._is_safe_path(resolved_path):
+                return f"[ERROR] Path out of working directory: {resolved_path}"
+            
+            source = self._current_source(resolved_path)
+            if source is None or not os.path.exists(source):
+                return f"[ERROR] File not found: {resolved_path}"
+            
+            # 保留原文件的换行符
+            with open(source, 'r', encoding=encoding, newline='') as f:
+                text = f.read()
+            
+            if diff and _SEARCH_REPLACE_BLOCK.search(diff):
+                blocks = _SEARCH_REPLACE_BLOCK.findall(diff)
+                new_text = apply_search_replace(text, blocks)
+                summary = f"{len(blocks)} block(s) replaced"
+            elif diff:
+                new_text, added, removed = apply_unified_diff(text, diff)
+                summary = f"+{added} -{removed} lines"
+            elif search:
+                new_text = apply_search_replace(text, [(search, replace or '')])
+                summary = "1 block(s) replaced"
+            else:
+                return "[ERROR] EDIT_FILE needs search/replace or diff"
+            
+            self._atomic_write(resolved_path, new_text, encoding, newline='')
+            return f"[SUCCESS] File edited: {resolved_path} ({summary})"
+        
+        except ValueError as e:
+            return f"[ERROR] Edit not applied: {str(e)}. Re-read the file and retry with exact text."
+        except PermissionError:
+            return f"[ERROR] No write permission: {resolved_path}"
+        except Exception as e:
+            return f"[ERROR] Failed to edit file: {str(e)}"
+
+    def _current_source(self, resolved_path):
+        """读取时的实际来源：批量模式下已暂存的返回临时文件（暂存删除返回 None），否则为原路径"""
+        with self._batch_lock:
+            if self._batch is not None and resolved_path in self._batch:
+                return self._batch[resolved_path]
+        return resolved_path
+
+    def _atomic_write(self, resolved_path, content, encoding, newline=None):
+        """先写同目录临时文件再 rename 覆盖，崩溃时不会留下写了一半的文件；批量模式下只暂存，返回是否暂存"""
+        dir_path = os.path.dirname(resolved_path)
+        if dir_path and not os.path.exists(dir_path):
+            os.makedirs(dir_path, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=dir_path, prefix=f".{os.path.basename(resolved_path)}.", suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding=encoding, newline=newline) as f:
+                f.write(content)
+                if WRITE_FSYNC:
+                    f.flush()
+                    os.fsync(f.fileno())
+            if os.path.exists(resolved_path):
+                # 保留原文件权限（mkstemp 创建的文件为 0600）
+                os.chmod(temp_path, os.stat(resolved_path).st_mode & 0o7777)
+            else:
+                os.chmod(temp_path, 0o666 & ~_UMASK)
+            with self._batch_lock:
+                if self._batch is not None:
+                    self._discard_temp(self._batch.get(resolved_path))
+                    self._batch[resolved_path] = temp_path
+                    return True
+            os.replace(temp_path, resolved_path)
+        except BaseException:
+            self._discard_temp(temp_path)
+            raise
+        if WRITE_FSYNC:
+            self._fsync_dir(dir_path)
+        self._file_changed(resolved_path)
+        return False
+
+    @staticmethod
+    def _discard_temp(temp_path):
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+    @staticmethod
+    def _fsync_dir(dir_path):
+        """fsync 目录，使 rename 持久化（不支持的平台忽略）"""
+        try:
+            fd = os.open(dir_path or '.', os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    def begin_batch(self):
+        """开始批量提交：之后的写入、编辑、追加与删除只暂存，commit_batch 时一起落盘"""
+        with self._batch_lock:
+            if self._batch is None:
+                self._batch = {}
+
+    def commit_batch(self):
+        """提交暂存的全部修改（所有内容已写入临时文件，这里只做 rename/删除），返回 {路径: 错误信息}"""
+        with self._batch_lock:
+            batch, self._batch = self._batch or {}, None
+        errors = {}
+        for resolved_path, temp_path in batch.items():
+            try:
+                if temp_path is None:
+                    if os.path.exists(resolved_path):
+                        os.remove(resolved_path)
+                else:
+                    os.replace(temp_path, resolved_path)
+                self._file_changed(resolved_path)
+            except OSError as e:
+                self._discard_temp(temp_path)
+                errors[resolved_path] = str(e)
+        if WRITE_FSYNC:
+            for dir_path in {os.path.dirname(path) for path in batch}:
+                self._fsync_dir(dir_path)
+        return errors
+
+    def abort_batch(self):
+        """丢弃暂存的全部修改"""
+        with self._batch_lock:
+            batch, self._batch = self._batch or {}, None
+        for temp_path in batch.values():
+            self._discard_temp(temp_path)
+
+    def list_files(self, dir_path='.', show_hidden=False, recursive=False, max_depth=None, pattern=None,
+                   max_entries=None):
+        """列出目录下的文件
+
+        recursive 时遵循 .gitignore；max_depth 限制递归层数，pattern 为 glob 过滤，最多输出 max_entries 条
+        """
         try:
             resolved_path = self._resolve_path(dir_path)
             
@@ -279,41 +1611,75 @@ class FileManager:
             if not os.path.isdir(resolved_path):
                 return f"[ERROR] Path is not a directory: {resolved_path}"
             
+            max_entries = int(max_entries) if max_entries else LIST_MAX_ENTRIES
+            max_depth = int(max_depth) if max_depth else None
             result = [f"[DIR_LIST] {resolved_path}\n{'='*60}"]
-            
-            if recursive:
-                for root, dirs, files in os.walk(resolved_path):
-                    # 过滤隐藏文件
-                    if not show_hidden:
-                        dirs[:] = [d for d in dirs if not d.startswith('.')]
-                        files = [f for f in files if not f.startswith('.')]
-                    
-                    for item in sorted(dirs + files):
-                        item_path = os.path.join(root, item)
-                        rel_path = os.path.relpath(item_path, self.base_dir)
-                        item_type = 'DIR' if os.path.isdir(item_path) else 'FILE'
-                        size = os.path.getsize(item_path) if os.path.isfile(item_path) else 0
-                        size_str = f"{size:,} bytes" if os.path.isfile(item_path) else ''
-                        result.append(f"[{item_type}] [{size_str:>12}] {rel_path}")
-            else:
-                items = os.listdir(resolved_path)
-                if not show_hidden:
-                    items = [item for item in items if not item.startswith('.')]
-                
-                for item in sorted(items):
-                    item_path = os.path.join(resolved_path, item)
-                    item_type = 'DIR' if os.path.isdir(item_path) else 'FILE'
-                    size = os.path.getsize(item_path) if os.path.isfile(item_path) else 0
-                    size_str = f"{size:,} bytes" if os.path.isfile(item_path) else ''
-                    result.append(f"[{item_type}] [{size_str:>12}] {item}")
+            # 递归列表的路径相对于工作目录显示
+            prefix = os.path.relpath(resolved_path, self.base_dir) if recursive else '.'
+            count = 0
+            for rel_path, is_dir, size, _ in iter_dir_entries(resolved_path, show_hidden, recursive, max_depth, pattern,
+                                                           top=os.path.normpath(self.base_dir)):
+                if count >= max_entries:
+                    result.append(f"... [已达到 {max_entries} 条上限，可指定子目录、pattern 或 max_depth 缩小范围]")
+                    break
+                count += 1
+                item_type = 'DIR' if is_dir else 'FILE'
+                size_str = '' if is_dir else f"{size:,} bytes"
+                shown = rel_path if prefix == '.' else os.path.join(prefix, rel_path)
+                result.append(f"[{item_type}] [{size_str:>12}] {shown}")
             
             return '\n'.join(result) if len(result) > 1 else f"[DIR] {resolved_path} (empty)"
         
         except PermissionError:
             return f"[ERROR] No access permission: {resolved_path}"
+        except ValueError as e:
+            return f"[ERROR] Invalid list option: {str(e)}"
         except Exception as e:
             return f"[ERROR] Failed to list directory: {str(e)}"
 
+    def _file_changed(self, resolved_path):
+        """文件被修改：清除目录快照并通知内容索引"""
+        invalidate_dir_cache(resolved_path)
+        if self._index is not None and not os.path.isdir(resolved_path):
+            # 内容索引只包含文件，新建的目录由下次目录遍历发现其中的文件
+            self._index.mark_dirty(os.path.relpath(resolved_path, self.base_dir).replace(os.sep, '/'))
+
+    def get_index(self):
+        """获取工作目录内容索引（首次调用时创建）"""
+        if self._index is None:
+            with self._index_lock:
+                if self._index is None:
+                    base_dir = os.path.normpath(self.base_dir)
+                    self._index = WorkspaceIndex(base_dir, lambda: iter_dir_entries(base_dir, recursive=True))
+        return self._index
+
+    def warm_index(self):
+        """在后台线程建立内容索引，避免第一次 SEARCH_FILES 等待全量建立"""
+        threading.Thread(target=lambda: self.get_index().refresh(force=True), daemon=True).start()
+
+    def search_files(self, query, dir_path='.', pattern=None, regex=False, max_results=None):
+        """在工作目录内容索引中检索，返回按相关度排序、带行号片段的结果"""
+        try:
+            if not query:
+                return "[ERROR] Search query is empty"
+            resolved_path = self._resolve_path(dir_path)
+            if not self._is_safe_path(resolved_path):
+                return f"[ERROR] Path out of working directory: {resolved_path}"
+            prefix = os.path.relpath(resolved_path, self.base_dir).replace(os.sep, '/')
+            results, total = self.get_index().search(query, '' if prefix == '.' else prefix, pattern, regex,
+                                                int(max_results) if max_results else None)
+            if not results:
+                return f"[SEARCH_RESULTS] {query}: no matches"
+            lines = [f"[SEARCH_RESULTS] {query} ({total} files matched, showing {len(results)})\n{'='*60}"]
+            for rel_path, _, snippets, match_count in results:
+                lines.append(f"{rel_path} ({match_count} matches)")
+                lines.extend(f"  {line_no}: {snippet}" for line_no, snippet in snippets)
+            return '\n'.join(lines)
+        except re.error as e:
+            return f"[ERROR] Invalid regex: {str(e)}"
+        except Exception as e:
+            return f"[ERROR] Failed to search files: {str(e)}"
+
     def create_dir(self, dir_path):
         """创建目录"""
         try:
@@ -323,6 +1689,7 @@ class FileManager:
                 return f"[ERROR] Path out of working directory: {resolved_path}"
             
             os.makedirs(resolved_path, exist_ok=True)
+            self._file_changed(resolved_path)
             return f"[SUCCESS] Directory created: {resolved_path}"
         
         except PermissionError:
@@ -503,31 +1870,49 @@ def process_file_command(command, file_manager):
     
     return f"[错误] 未知命令: {command} (输入 'help' 查看帮助)", True
 
-def process_local_input(history, output_file=None, file_manager=None):
-    """
-    处理本地传入的聊天信息（支持连续对话和文件操作）
-    :param history: ConversationHistory 对象
-    :param output_file: 输出文件路径（可选）
-    :param file_manager: FileManager 对象（可选）
-    """
-    session_id = history.session_id
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    
-    print(f"\n[{current_time}] [会话ID: {session_id}] [本地模式] 对话历史: {len(history.messages)}条消息")
-    
-    # 获取当前上下文
-    context = history.get_context()
-    
-    # 检查上下文是否为空
-    if not context or len(context) == 0:
-        print(f"[{current_time}] [警告] 对话上下文为空，请先输入用户消息")
-        return history
-    
-    # 如果提供了文件管理器，添加文件操作工具说明到系统提示
-    if file_manager:
-        system_prompt = {
-            "role": "system",
-            "content": """你是一个智能助手，具备文件操作能力。你必须严格按照以下格式使用工具：
+TOOL_MODE = os.getenv('WEBCHAT_TOOL_MODE', 'native')  # native: function calling / text: [TOOL_CALL] 文本协议
+
+# 文件操作工具的 JSON Schema（OpenAI function calling 格式）
+_PATH_PARAM = {"type": "string", "description": "相对于工作目录的路径"}
+FILE_TOOLS = [
+    {"type": "function", "function": {"name": name, "description": description, "parameters": {
+        "type": "object", "properties": properties, "required": required}}}
+    for name, description, properties, required in [
+        ("READ_FILE", "读取文件内容；大文件只返回开头与结尾的摘录，可用 offset/limit 读取指定范围",
+         {"path": _PATH_PARAM,
+          "offset": {"type": "integer", "description": "起始行号（从 1 开始）；unit 为 bytes 时为起始字节"},
+          "limit": {"type": "integer", "description": "读取的行数；unit 为 bytes 时为字节数"},
+          "unit": {"type": "string", "enum": ["lines", "bytes"], "description": "范围单位，默认 lines"}},
+         ["path"]),
+        ("WRITE_FILE", "创建或覆盖文件",
+         {"path": _PATH_PARAM, "content": {"type": "string", "description": "文件内容"}}, ["path", "content"]),
+        ("APPEND_FILE", "追加内容到文件末尾",
+         {"path": _PATH_PARAM, "content": {"type": "string", "description": "追加的内容"}}, ["path", "content"]),
+        ("EDIT_FILE", "局部修改文件（比 WRITE_FILE 重写整个文件更省 token）：search/replace 替换一段原文，或提供 unified diff",
+         {"path": _PATH_PARAM,
+          "search": {"type": "string", "description": "要替换的原文，必须在文件中恰好出现一次"},
+          "replace": {"type": "string", "description": "替换后的文本"},
+          "diff": {"type": "string", "description": "unified diff（@@ 块）或多个 <<<<<<< SEARCH / ======= / >>>>>>> REPLACE 块"}},
+         ["path"]),
+        ("DELETE_FILE", "删除文件", {"path": _PATH_PARAM}, ["path"]),
+        ("LIST_FILES", "列出目录中的文件；递归列出时遵循 .gitignore",
+         {"path": {"type": "string", "description": "目录路径，默认为当前目录"},
+          "recursive": {"type": "boolean", "description": "是否递归列出子目录"},
+          "max_depth": {"type": "integer", "description": "递归的最大层数"},
+          "pattern": {"type": "string", "description": "glob 过滤，如 *.py"}}, []),
+        ("CREATE_DIR", "创建目录", {"path": _PATH_PARAM}, ["path"]),
+        ("SEARCH_FILES", "在工作目录的文件内容与路径中搜索（有索引，比逐个 LIST_FILES/READ_FILE 快得多），返回带行号的匹配片段",
+         {"query": {"type": "string", "description": "搜索的文本（不区分大小写）"},
+          "path": {"type": "string", "description": "只搜索该目录，默认为整个工作目录"},
+          "pattern": {"type": "string", "description": "文件名 glob 过滤，如 *.py"},
+          "regex": {"type": "boolean", "description": "query 是否为正则表达式"},
+          "max_results": {"type": "integer", "description": "最多返回的文件数"}}, ["query"]),
+    ]
+]
+
+NATIVE_TOOL_SYSTEM_PROMPT = "你是一个智能助手，可以调用文件操作工具完成用户的请求。只使用相对路径；需要操作文件时直接调用工具，不要只描述步骤。"
+
+TEXT_TOOL_SYSTEM_PROMPT = """你是一个智能助手，具备文件操作能力。你必须严格按照以下格式使用工具：
 
 【最重要】你必须实际执行文件操作，只使用 [TOOL_CALL] 格式！
 
@@ -539,6 +1924,7 @@ def process_local_input(history, output_file=None, file_manager=None):
 1. READ_FILE - 读取文件内容
    格式: [TOOL_CALL] READ_FILE path="文件名"
    示例: [TOOL_CALL] READ_FILE path="app.py"
+   大文件只返回开头与结尾的摘录，可指定行范围: [TOOL_CALL] READ_FILE path="app.log" offset="100" limit="50"
 
 2. WRITE_FILE - 创建或覆盖文件
    格式: [TOOL_CALL] WRITE_FILE path="文件名" content="文件内容"
@@ -555,13 +1941,23 @@ def process_local_input(history, output_file=None, file_manager=None):
    格式: [TOOL_CALL] LIST_FILES path="目录路径"
    示例: [TOOL_CALL] LIST_FILES path="."
    示例: [TOOL_CALL] LIST_FILES path="templates"
+   递归列出（遵循 .gitignore）: [TOOL_CALL] LIST_FILES path="." recursive="true" max_depth="3" pattern="*.py"
 
 6. CREATE_DIR - 创建目录
    格式: [TOOL_CALL] CREATE_DIR path="目录名"
    示例: [TOOL_CALL] CREATE_DIR path="logs"
 
+7. SEARCH_FILES - 在文件内容与路径中搜索（返回带行号的匹配片段，查找代码时优先使用）
+   格式: [TOOL_CALL] SEARCH_FILES query="搜索文本" path="目录路径" pattern="*.py"
+   示例: [TOOL_CALL] SEARCH_FILES query="def read_file"
+
+8. EDIT_FILE - 局部修改文件（只改一部分时优先使用，不要用 WRITE_FILE 重写整个文件）
+   格式: [TOOL_CALL] EDIT_FILE path="文件名" search="原文" replace="新文本"
+   示例: [TOOL_CALL] EDIT_FILE path="app.py" search="DEBUG = True" replace="DEBUG = False"
+   注意：search 必须与文件中的原文完全一致且只出现一次；也可以用 diff="unified diff 内容"
+
 【关键规则】
-- READ_FILE, WRITE_FILE, APPEND_FILE, DELETE_FILE 使用文件名（如 app.py）
+- READ_FILE, WRITE_FILE, EDIT_FILE, APPEND_FILE, DELETE_FILE 使用文件名（如 app.py）
 - LIST_FILES, CREATE_DIR 使用目录路径（如 . 或 templates）
 - 不要使用绝对路径，只使用文件名或相对路径
 - 必须执行工具调用，不要只描述或生成代码块
@@ -593,234 +1989,447 @@ def process_local_input(history, output_file=None, file_manager=None):
 
 记住：你必须执行实际的工具调用，而不是生成文本描述！
 """
-        }
-        context.insert(0, system_prompt)
-    
+
+
+_TOOL_SCHEMAS = {tool['function']['name']: tool['function']['parameters'] for tool in FILE_TOOLS}
+_JSON_SCHEMA_TYPES = {'string': str, 'integer': int, 'boolean': bool}
+
+
+def _tool_argument_error(tool_name, params):
+    """按 FILE_TOOLS 的参数定义检查参数，返回错误说明，合法时返回 None（未知工具由 execute_tool_call 报错）"""
+    schema = _TOOL_SCHEMAS.get(tool_name)
+    if schema is None:
+        return None
+    for name in schema['required']:
+        if name not in params:
+            return f"missing required parameter '{name}'"
+    for name, value in params.items():
+        spec = schema['properties'].get(name)
+        if spec is None:
+            continue
+        expected = _JSON_SCHEMA_TYPES[spec['type']]
+        if not isinstance(value, expected) or (expected is int and isinstance(value, bool)):
+            return f"parameter '{name}' must be {spec['type']}, got {json.dumps(value, ensure_ascii=False)[:50]}"
+        if 'enum' in spec and value not in spec['enum']:
+            return f"parameter '{name}' must be one of {spec['enum']}"
+    return None
+
+
+def native_tool_call(call):
+    """将上游返回的原生工具调用转换为 {'tool', 'params', 'id', 'arguments'}
+
+    参数不是合法的 JSON 对象或不符合工具定义时附带 'error'，执行时只返回错误结果，不中断本轮。
+    """
+    try:
+        params = json.loads(call['arguments'] or '{}')
+        error = None if isinstance(params, dict) else 'arguments must be a JSON object'
+    except json.JSONDecodeError as e:
+        params, error = None, f"arguments are not valid JSON: {e}"
+    if error is None:
+        # null 视为未提供（使用默认值）
+        params = {name: value for name, value in params.items() if value is not None}
+        error = _tool_argument_error(call['name'], params)
+    tool_call = {'tool': call['name'], 'params': params if error is None else {}, 'id': call['id'],
+                 'arguments': call['arguments']}
+    if error is not None:
+        tool_call['error'] = error
+    return tool_call
+
+
+def stream_local_response(context, file_manager=None, native_tools=False, usage=None):
+    """流式输出一次回复；提供 file_manager 时边接收边解析并执行工具调用
+
+    native_tools 为 True 时通过 tools 参数使用原生 function calling，否则解析 [TOOL_CALL] 文本协议。
+    usage 用于累加上游返回的 token 用量。
+    :return: (完整回复, [(tool_call, 结果)])
+    """
+    parser = ToolCallParser() if file_manager and not native_tools else None
+    scheduler = ToolScheduler(file_manager) if file_manager else None
+    tools = FILE_TOOLS if file_manager and native_tools else None
     full_response = ""
     tool_results = []
+
+    def submit_tools(tool_calls):
+        for tool_call in tool_calls:
+            print(f"\n[工具调用检测] 工具: {tool_call.get('tool')}, 参数: {tool_call.get('params', {})}")
+            scheduler.submit(tool_call)
+
+    try:
+        for chunk in stream_completion(context, 'local', tools=tools, usage=usage):
+            if isinstance(chunk, dict):
+                submit_tools([native_tool_call(chunk)])
+            elif chunk:
+                full_response += chunk
+                # 实时输出到控制台（保留换行）
+                print(chunk, end='', flush=True)
+                if parser:
+                    submit_tools(parser.feed(chunk))
+        if parser:
+            submit_tools(parser.close())
+    except BaseException:
+        # 回复中断时不留下只执行了一半的修改
+        if scheduler:
+            scheduler.abort()
+        raise
+    # 添加换行符结束流式输出
+    print()
+
+    if scheduler:
+        # 结果按调用出现的顺序反馈
+        for tool_call, result in scheduler.results():
+            tool_name = tool_call.get('tool')
+            tool_results.append((tool_call, result))
+
+            # 打印工具执行结果
+            print(f"[工具执行结果] {tool_name}:")
+            if result.startswith('[ERROR]'):
+                print(f"  ❌ {result}")
+            elif result.startswith('[SUCCESS]'):
+                print(f"  ✅ {result}")
+            elif result.startswith('[FILE_CONTENT]'):
+                print(f"  📄 {result[:100]}...")
+            elif result.startswith('[DIR_LIST]'):
+                print(f"  📁 {result[:100]}...")
+            else:
+                print(f"  {result[:200]}...")
+    return full_response, tool_results
+
+
+def process_local_input(history, output_file=None, file_manager=None):
+    """
+    处理本地传入的聊天信息（支持连续对话和文件操作）
+    :param history: ConversationHistory 对象
+    :param output_file: 输出文件路径（可选）
+    :param file_manager: FileManager 对象（可选）
+    """
+    global TOOL_MODE
+    session_id = history.session_id
+    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    
+    print(f"\n[{current_time}] [会话ID: {session_id}] [本地模式] 对话历史: {len(history.messages)}条消息")
+    
+    # 检查上下文是否为空
+    if not history.messages:
+        print(f"[{current_time}] [警告] 对话上下文为空，请先输入用户消息")
+        return history
+    
+    # 如果提供了文件管理器，添加文件操作工具说明到系统提示（每次请求都保留）
+    # 原生 function calling 模式下工具定义随 tools 参数发送，系统提示只保留简短说明
+    native_tools = file_manager is not None and TOOL_MODE == 'native'
+    if file_manager:
+        history.system_prompt = NATIVE_TOOL_SYSTEM_PROMPT if native_tools else TEXT_TOOL_SYSTEM_PROMPT
+    
+    # 获取当前上下文（超出 token 预算时可先将早期对话压缩为摘要）
+    if CONTEXT_SUMMARY:
+        history.compact()
+    context = history.get_context()
+    
+    started = time.perf_counter()
     max_tool_iterations = 10  # 限制工具迭代次数，防止死循环
     iteration_count = 0
+    usage = {}  # 本轮所有上游请求的 token 用量
     
     try:
-        # 流式输出（保留实时输出）
+        # 流式输出（保留实时输出），工具调用在流中一闭合就立即执行
         print("\n[AI回复开始]")
-        response_started = False
-        
-        for chunk in deepseek1(context):
-            if chunk:
-                response_started = True
-                full_response += chunk
-                # 实时输出到控制台（保留换行）
-                print(chunk, end='', flush=True)
+        try:
+            full_response, tool_results = stream_local_response(context, file_manager, native_tools, usage)
+        except BadRequestError as e:
+            if not native_tools or not re.search(r'tool|function', str(e), re.IGNORECASE):
+                raise
+            # 上游不支持 tools 参数（如推理模型），本进程改用文本协议
+            TOOL_MODE = 'text'
+            native_tools = False
+            log_event('native_tools_unsupported', level=logging.WARNING, session_id=session_id, error=str(e))
+            print("[提示] 上游不支持原生工具调用，改用文本协议")
+            history.system_prompt = TEXT_TOOL_SYSTEM_PROMPT
+            full_response, tool_results = stream_local_response(history.get_context(), file_manager, usage=usage)
         
         # 检查是否有响应
-        if not response_started:
+        if not full_response and not tool_results:
             print("\n[警告] API返回空响应，请检查API密钥或网络连接")
         
-        # 添加换行符结束流式输出
-        print()
-        
-        # 检查并执行文件操作工具调用
-        if file_manager and iteration_count < max_tool_iterations:
-            while iteration_count < max_tool_iterations:
-                # 查找工具调用
-                tool_calls = extract_tool_calls(full_response)
-                
-                # 调试信息
-                if tool_calls:
-                    print(f"\n[工具调用检测] 检测到 {len(tool_calls)} 个工具调用")
-                    for i, tc in enumerate(tool_calls, 1):
-                        print(f"  [{i}] 工具: {tc['tool']}, 参数: {tc['params']}")
-                
-                if not tool_calls:
-                    break
-                
-                # 执行工具调用
-                new_responses = []
-                for tool_call in tool_calls:
-                    tool_name = tool_call.get('tool')
-                    tool_params = tool_call.get('params', {})
-                    
-                    # 执行工具操作
-                    result = execute_tool_call(tool_name, tool_params, file_manager)
-                    tool_results.append(f"\n[TOOL_RESULT] {tool_name}: {result}")
-                    new_responses.append(f"[TOOL_RESULT] {tool_name}: {result}")
-
-                    # 打印工具执行结果
-                    print(f"[工具执行结果] {tool_name}:")
-                    if result.startswith('[ERROR]'):
-                        print(f"  ❌ {result}")
-                    elif result.startswith('[SUCCESS]'):
-                        print(f"  ✅ {result}")
-                    elif result.startswith('[FILE_CONTENT]'):
-                        print(f"  📄 {result[:100]}...")
-                    elif result.startswith('[DIR_LIST]'):
-                        print(f"  📁 {result[:100]}...")
-                    else:
-                        print(f"  {result[:200]}...")
-                
-                # 如果有工具调用，重新请求AI处理结果
-                if new_responses:
-                    iteration_count += 1
-                    
-                    # 添加工具结果到上下文（使用system角色标记这是工具结果）
-                    for result in new_responses:
-                        history.messages.append({"role": "system", "content": f"[TOOL_RESULT_FEEDBACK] {result}"})
-                    
-                    # 重新调用AI处理工具结果
-                    new_context = history.get_context()
-                    full_response = ""
-                    print("\n[AI继续处理...]")
-                    
-                    for chunk in deepseek1(new_context):
-                        if chunk:
-                            full_response += chunk
-                            print(chunk, end='', flush=True)
-                    print()
+        # 如果有工具调用，把结果加入上下文后重新请求AI处理
+        while tool_results:
+            iteration_count += 1
+            
+            if native_tools:
+                # 原生模式：assistant 的 tool_calls 消息后跟对应的 tool 结果消息
+                history.add_message("assistant", full_response, tool_calls=[
+                    {"id": tool_call['id'], "type": "function",
+                     "function": {"name": tool_call['tool'], "arguments": tool_call['arguments']}}
+                    for tool_call, _ in tool_results])
+                for tool_call, result in tool_results:
+                    history.add_message("tool", result, tool_call_id=tool_call['id'])
+            else:
+                # 文本协议：工具结果使用system角色标记
+                for tool_call, result in tool_results:
+                    history.add_message("system", f"[TOOL_RESULT_FEEDBACK] [TOOL_RESULT] {tool_call['tool']}: {result}")
+            
+            # 重新调用AI处理工具结果（达到迭代上限后不再执行新的工具调用）
+            print("\n[AI继续处理...]")
+            full_response, tool_results = stream_local_response(
+                history.get_context(), file_manager if iteration_count < max_tool_iterations else None, native_tools,
+                usage)
         
         # 添加AI回复到历史
         history.add_assistant_message(full_response)
         
-        # 保存对话历史（简化格式）
+        if file_manager:
+            TOOL_ITERATIONS.observe(iteration_count, model=DEEPSEEK_MODEL)
+        log_event('chat_completed',
+                  session_id=session_id,
+                  mode='local',
+                  latency_ms=round((time.perf_counter() - started) * 1000, 1),
+                  tool_iterations=iteration_count,
+                  prompt_tokens=history.last_context_tokens,
+                  completion_tokens=estimate_tokens(full_response),
+                  upstream_prompt_tokens=usage.get('prompt_tokens'),
+                  prompt_cache_hit_tokens=usage.get('prompt_cache_hit_tokens'),
+                  bodies={'response': full_response})
+        
+        # 保存对话记录（后台队列写入，JSON Lines，按大小/时间轮转）
         if output_file:
-            # 确保日志目录存在
-            log_dir = os.path.dirname(output_file)
-            if log_dir:
-                os.makedirs(log_dir, exist_ok=True)
-
-            with open(output_file, 'a', encoding='utf-8') as f:
-                current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-                # 查找最后一条用户消息和最后一条assistant消息
-                user_msg = None
-                ai_msg = None
-
-                # 从后往前查找用户消息
-                for msg in reversed(history.messages):
-                    if msg['role'] == 'user':
-                        user_msg = msg['content']
-                        break
-
-                # 从后往前查找assistant消息（排除system消息）
-                for msg in reversed(history.messages):
-                    if msg['role'] == 'assistant':
-                        ai_msg = msg['content']
-                        break
-
-                # 只写入有效的用户和AI对话
-                if user_msg and ai_msg:
-                    f.write(f"\n[{current_time}] 用户: {user_msg}")
-                    f.write(f"\n[{current_time}] AI: {ai_msg}\n")
+            # 从后往前查找最后一条用户消息
+            user_msg = None
+            for msg in reversed(history.messages):
+                if msg['role'] == 'user':
+                    user_msg = msg['content']
+                    break
 
-            print(f"\n对话日志已保存至: {output_file}")
+            # 只写入有效的用户和AI对话
+            if user_msg and full_response:
+                log_transcript(output_file, session_id, user_msg, full_response)
+                print(f"\n对话日志已保存至: {output_file}")
         
     except Exception as e:
         print(f"\n[{current_time}] [错误] {str(e)}")
+        log_event('upstream_error', level=logging.ERROR, session_id=session_id, mode='local', error=str(e))
     
     return history
 
 
+TOOL_CALL_MARKER = '[TOOL_CALL]'
+TOOL_FENCE_MARKER = '```tool:'
+_TOOL_NAME_PATTERN = re.compile(r'\s*(\w+)(\s*)')
+TOOL_HEAD_MAX_CHARS = 256  # 标记后超过该长度仍无法识别格式则视为普通文本
+
+
+# 各工具 JSON Schema 中的参数名：JSON 格式的工具调用按此保留参数（未知工具保留所有已知参数名）
+_TOOL_PARAM_NAMES = {tool['function']['name']: set(tool['function']['parameters']['properties']) for tool in FILE_TOOLS}
+_ALL_TOOL_PARAM_NAMES = set().union(*_TOOL_PARAM_NAMES.values())
+
+
+def _json_tool_call(json_text):
+    """解析 JSON 格式的工具调用，保留工具定义中的全部参数，并把 file_path 等别名映射为 path"""
+    try:
+        tool_data = json.loads(json_text)
+    except json.JSONDecodeError as e:
+        print(f"[JSON解析失败] {e}")
+        return None
+    if not isinstance(tool_data, dict):
+        return None
+    tool_name = tool_data.get('command') or tool_data.get('tool') or tool_data.get('function')
+    param_dict = tool_data.get('parameters') or tool_data.get('params') or tool_data
+    if not isinstance(param_dict, dict):
+        return None
+    names = _TOOL_PARAM_NAMES.get(tool_name, _ALL_TOOL_PARAM_NAMES)
+    # 空字符串也保留（如 replace="" 表示删除原文）
+    params = {key: value for key, value in param_dict.items() if key in names}
+    for key in ('file_path', 'path', 'directory_path'):
+        if key in param_dict:
+            params['path'] = param_dict[key]
+    return tool_name, params
+
+
+class ToolCallParser:
+    """增量解析流式回复中的工具调用（单遍扫描，线性时间）
+
+    支持的格式（每个标记只产生一个调用）：
+    1. [TOOL_CALL] TOOL_NAME param1="value1" param2="value2"   （到行尾结束）
+    2. [TOOL_CALL] TOOL_NAME(path="value", param="value")       （到引号外的右括号结束）
+    3. ```tool:TOOL_NAME\\nparam="value"\\n```
+    4. [TOOL_CALL] {"command": "TOOL_NAME", "parameters": {...}}  （到匹配的右花括号结束）
+    """
+
+    def __init__(self):
+        self._state = 'text'
+        # text 状态：可能是标记前缀的尾部；head 状态：已收到的标记后内容；line/fence 状态：可能是结束符前缀的尾部
+        self._carry = ''
+        self._marker = None
+        self._tool_name = None
+        self._parts = []   # 调用体的已接收片段
+        self._terminator = None
+        self._depth = 0    # JSON 花括号深度
+        self._quote = None
+        self._escape = False
+
+    def feed(self, chunk):
+        """输入一段流式文本，返回其中新完成的工具调用列表"""
+        calls = []
+        text = chunk
+        while text:
+            text = getattr(self, '_feed_' + self._state)(text, calls)
+        return calls
+
+    def close(self):
+        """流结束：行格式的调用到文本末尾即完成，其余未闭合的调用丢弃"""
+        calls = []
+        if self._state == 'line':
+            self._emit(calls, self._tool_name, ''.join(self._parts))
+        elif self._state == 'head' and self._marker == TOOL_CALL_MARKER:
+            match = _TOOL_NAME_PATTERN.match(self._carry)
+            if match:
+                self._emit(calls, match.group(1), self._carry[match.end():])
+        self._reset()
+        return calls
+
+    def _reset(self):
+        self._state = 'text'
+        self._carry = ''
+        self._parts = []
+
+    def _emit(self, calls, tool_name, params_str=None, params=None):
+        if params is None:
+            params = parse_params(params_str)
+        # 只添加有有效参数的工具调用（LIST_FILES 可以有空的 path，默认当前目录）
+        if tool_name and (params or tool_name == 'LIST_FILES'):
+            calls.append({'tool': tool_name, 'params': params})
+
+    def _feed_text(self, text, calls):
+        """查找下一个工具调用标记"""
+        text = self._carry + text
+        found = [(i, m) for m in (TOOL_CALL_MARKER, TOOL_FENCE_MARKER) for i in (text.find(m),) if i >= 0]
+        if not found:
+            # 保留可能是标记前缀的尾部，跨块匹配
+            keep = max(len(TOOL_CALL_MARKER), len(TOOL_FENCE_MARKER)) - 1
+            self._carry = text[-keep:]
+            return ''
+        index, marker = min(found)
+        self._state = 'head'
+        self._marker = marker
+        self._carry = ''
+        return text[index + len(marker):]
+
+    def _feed_head(self, text, calls):
+        """识别标记后的格式与工具名"""
+        head = self._carry + text
+        if self._marker == TOOL_FENCE_MARKER:
+            newline = head.find('\n')
+            if newline < 0:
+                return self._wait_head(head)
+            self._tool_name = head[:newline].strip()
+            return self._begin_body('fence', '\n```', head[newline + 1:])
+
+        stripped = head.lstrip()
+        if not stripped:
+            return self._wait_head(head)
+        if stripped[0] == '{':
+            self._depth, self._quote, self._escape = 0, None, False
+            return self._begin_body('json', None, stripped)
+        match = _TOOL_NAME_PATTERN.match(head)
+        if not match:
+            self._reset()
+            return head
+        if match.end() == len(head):
+            # 工具名或其后的空白可能还没收完
+            return self._wait_head(head)
+        self._tool_name = match.group(1)
+        rest = head[match.end():]
+        if rest[0] == '(':
+            self._quote, self._escape = None, False
+            return self._begin_body('paren', None, rest[1:])
+        if '\n' in match.group(2):
+            # 工具名后直接换行：没有参数
+            self._emit(calls, self._tool_name, '')
+            self._reset()
+            return rest
+        return self._begin_body('line', '\n', rest)
+
+    def _wait_head(self, head):
+        if len(head) > TOOL_HEAD_MAX_CHARS:
+            self._reset()
+            return head
+        self._carry = head
+        return ''
+
+    def _begin_body(self, state, terminator, text):
+        self._state = state
+        self._terminator = terminator
+        self._parts = []
+        self._carry = ''
+        return text
+
+    def _feed_line(self, text, calls):
+        return self._feed_until_terminator(text, calls)
+
+    def _feed_fence(self, text, calls):
+        return self._feed_until_terminator(text, calls)
+
+    def _feed_until_terminator(self, text, calls):
+        """只在新到达的文本（加上可能跨块的结束符前缀）中查找结束符"""
+        tail = self._carry
+        index = (tail + text).find(self._terminator)
+        if index < 0:
+            self._parts.append(text)
+            keep = len(self._terminator) - 1
+            self._carry = (tail + text)[-keep:] if keep else ''
+            return ''
+        body = ''.join(self._parts) + text
+        end = len(body) - len(text) - len(tail) + index
+        self._emit(calls, self._tool_name, body[:end])
+        self._reset()
+        return body[end + len(self._terminator):]
+
+    def _feed_paren(self, text, calls):
+        """查找引号外的右括号"""
+        for i, char in enumerate(text):
+            if self._escape:
+                self._escape = False
+            elif char == '\\':
+                self._escape = True
+            elif self._quote:
+                if char == self._quote:
+                    self._quote = None
+            elif char in '"\'':
+                self._quote = char
+            elif char == ')':
+                self._emit(calls, self._tool_name, ''.join(self._parts) + text[:i])
+                self._reset()
+                return text[i + 1:]
+        self._parts.append(text)
+        return ''
+
+    def _feed_json(self, text, calls):
+        """匹配花括号（忽略字符串内的括号）"""
+        for i, char in enumerate(text):
+            if self._escape:
+                self._escape = False
+            elif self._quote:
+                if char == '\\':
+                    self._escape = True
+                elif char == '"':
+                    self._quote = None
+            elif char == '"':
+                self._quote = char
+            elif char == '{':
+                self._depth += 1
+            elif char == '}':
+                self._depth -= 1
+                if self._depth == 0:
+                    parsed = _json_tool_call(''.join(self._parts) + text[:i + 1])
+                    if parsed:
+                        self._emit(calls, parsed[0], params=parsed[1])
+                    self._reset()
+                    return text[i + 1:]
+        self._parts.append(text)
+        return ''
+
+
 def extract_tool_calls(text):
-    """从文本中提取工具调用"""
-    import re
-    
-    tool_calls = []
-    
-    # 格式1: [TOOL_CALL] TOOL_NAME param1="value1" param2="value2"
-    pattern1 = r'\[TOOL_CALL\]\s+(\w+)\s+([^\n]*)'
-    matches1 = re.findall(pattern1, text, re.MULTILINE)
-    
-    # 格式2: [TOOL_CALL] TOOL_NAME(path="value", param="value")
-    pattern2 = r'\[TOOL_CALL\]\s+(\w+)\s*\(([^)]+)\)'
-    matches2 = re.findall(pattern2, text)
-    
-    # 格式3: ```tool:TOOL_NAME\nparam="value"\nparam="value"\n```
-    pattern3 = r'```tool:(\w+)\s*\n(.*?)\n```'
-    matches3 = re.findall(pattern3, text, re.DOTALL)
-    
-    # 格式4: [TOOL_CALL] 后面跟着JSON对象（多行支持）
-    # 先找到所有 [TOOL_CALL] 标记
-    tool_call_markers = list(re.finditer(r'\[TOOL_CALL\]', text))
-    
-    for marker in tool_call_markers:
-        start_pos = marker.end()
-        # 尝试从这个位置开始解析JSON
-        try:
-            # 跳过空白字符和换行符
-            json_start = start_pos
-            while json_start < len(text) and text[json_start] in '\n\r\t ':
-                json_start += 1
-            
-            if json_start < len(text) and text[json_start] == '{':
-                # 找到JSON对象的结束位置
-                json_text = ''
-                brace_count = 0
-                i = json_start
-                while i < len(text):
-                    char = text[i]
-                    json_text += char
-                    if char == '{':
-                        brace_count += 1
-                    elif char == '}':
-                        brace_count -= 1
-                        if brace_count == 0:
-                            break
-                    i += 1
-                
-                if brace_count == 0:
-                    import json
-                    tool_data = json.loads(json_text)
-                    tool_name = tool_data.get('command') or tool_data.get('tool') or tool_data.get('function')
-                    params = {}
-
-                    # 从parameters或直接从tool_data中提取参数
-                    param_dict = tool_data.get('parameters') or tool_data.get('params') or tool_data
-
-                    # 映射不同的参数名称
-                    if 'file_path' in param_dict:
-                        params['path'] = param_dict['file_path']
-                    if 'path' in param_dict:
-                        params['path'] = param_dict['path']
-                    if 'directory_path' in param_dict:
-                        params['path'] = param_dict['directory_path']
-                    if 'content' in param_dict:
-                        params['content'] = param_dict['content']
-
-                    # 只添加有有效工具名和参数的工具调用
-                    if tool_name and (params or tool_name == 'LIST_FILES'):
-                        tool_calls.append({'tool': tool_name, 'params': params})
-                        print(f"[JSON格式解析] 工具: {tool_name}, 参数: {params}")
-        except json.JSONDecodeError as e:
-            print(f"[JSON解析失败] {e}")
-            continue
-    
-    # 处理格式1
-    for match in matches1:
-        tool_name = match[0]
-        params_str = match[1]
-        params = parse_params(params_str)
-        # 只添加有有效参数的工具调用
-        if params or tool_name == 'LIST_FILES':  # LIST_FILES可以有空的path（默认当前目录）
-            tool_calls.append({'tool': tool_name, 'params': params})
-    
-    # 处理格式2
-    for match in matches2:
-        tool_name = match[0]
-        params_str = match[1]
-        params = parse_params(params_str)
-        # 只添加有有效参数的工具调用
-        if params or tool_name == 'LIST_FILES':
-            tool_calls.append({'tool': tool_name, 'params': params})
-    
-    # 处理格式3
-    for match in matches3:
-        tool_name = match[0]
-        params_str = match[1]
-        params = parse_params(params_str)
-        # 只添加有有效参数的工具调用
-        if params or tool_name == 'LIST_FILES':
-            tool_calls.append({'tool': tool_name, 'params': params})
-    
+    """从完整文本中提取工具调用"""
+    parser = ToolCallParser()
+    tool_calls = parser.feed(text) + parser.close()
     print(f"[工具调用提取] 共找到 {len(tool_calls)} 个有效工具调用")
     return tool_calls
 
@@ -854,7 +2463,8 @@ def execute_tool_call(tool_name, params, file_manager):
     try:
         if tool_name == 'READ_FILE':
             path = params.get('path', '')
-            return file_manager.read_file(path)
+            return file_manager.read_file(path, offset=params.get('offset'), limit=params.get('limit'),
+                                          unit=params.get('unit', 'lines'))
         
         elif tool_name == 'WRITE_FILE':
             path = params.get('path', '')
@@ -866,40 +2476,158 @@ def execute_tool_call(tool_name, params, file_manager):
             content = params.get('content', '')
             return file_manager.append_file(path, content)
         
+        elif tool_name == 'EDIT_FILE':
+            path = params.get('path', '')
+            return file_manager.edit_file(path, params.get('search'), params.get('replace', ''), params.get('diff'))
+        
         elif tool_name == 'DELETE_FILE':
             path = params.get('path', '')
             return file_manager.delete_file(path)
         
         elif tool_name == 'LIST_FILES':
             path = params.get('path', '.')
-            return file_manager.list_files(path)
+            recursive = str(params.get('recursive', '')).lower() in ('true', '1', 'yes')
+            return file_manager.list_files(path, recursive=recursive, max_depth=params.get('max_depth'),
+                                           pattern=params.get('pattern'))
         
         elif tool_name == 'CREATE_DIR':
             path = params.get('path', '')
             return file_manager.create_dir(path)
         
+        elif tool_name == 'SEARCH_FILES':
+            regex = str(params.get('regex', '')).lower() in ('true', '1', 'yes')
+            return file_manager.search_files(params.get('query', ''), params.get('path', '.'), params.get('pattern'),
+                                             regex, params.get('max_results'))
+        
         else:
             return f"[错误] 未知工具: {tool_name}"
     
     except Exception as e:
         return f"[错误] 工具执行失败: {str(e)}"
 
+
+TOOL_WORKERS = int(os.getenv('WEBCHAT_TOOL_WORKERS', '8'))
+READ_ONLY_TOOLS = {'READ_FILE', 'LIST_FILES', 'SEARCH_FILES'}
+
+
+class ToolScheduler:
+    """并行执行一轮中相互独立的工具调用
+
+    每个调用依赖于之前与它冲突的调用：作用路径相同或互为上下级目录，且至少一方会修改文件。
+    只读调用之间可以并发；对同一路径的写入、删除保持出现顺序。未知工具视为屏障，与所有调用冲突。
+    batch 为 True 时本轮的文件修改先暂存，全部调用完成后一起提交（rename），中途出错则全部丢弃。
+    """
+
+    def __init__(self, file_manager, max_workers=TOOL_WORKERS, batch=WRITE_BATCH):
+        self.file_manager = file_manager
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='tool')
+        self._submitted = []  # [(tool_call, 作用路径, 是否只读, future)]
+        self.batch = batch
+        if batch:
+            file_manager.begin_batch()
+
+    def _target_path(self, tool_call):
+        tool_name = tool_call.get('tool')
+        if tool_name not in READ_ONLY_TOOLS and tool_name not in ('WRITE_FILE', 'EDIT_FILE', 'APPEND_FILE',
+                                                                  'DELETE_FILE', 'CREATE_DIR'):
+            return None
+        default = '.' if tool_name in ('LIST_FILES', 'SEARCH_FILES') else ''
+        params = tool_call.get('params')
+        path = params.get('path', default) if isinstance(params, dict) else None
+        if not isinstance(path, str):
+            # 参数不合法：视为与所有调用冲突，由 execute_tool_call 返回错误结果
+            return None
+        return self.file_manager._resolve_path(path)
+
+    @staticmethod
+    def _paths_overlap(a, b):
+        if a is None or b is None:
+            return True
+        return a == b or a.startswith(b.rstrip(os.sep) + os.sep) or b.startswith(a.rstrip(os.sep) + os.sep)
+
+    def submit(self, tool_call):
+        """提交一个工具调用，等待与它冲突的先前调用完成后执行"""
+        path = self._target_path(tool_call)
+        read_only = tool_call.get('tool') in READ_ONLY_TOOLS
+        # 参数不合法的调用（tool_call['error']）不执行，无需等待其他调用
+        dependencies = [future for _, other_path, other_read_only, future in self._submitted
+                        if not tool_call.get('error') and not (read_only and other_read_only)
+                        and self._paths_overlap(path, other_path)]
+        # 线程池按提交顺序取任务，依赖总是先于当前调用开始执行，等待不会死锁
+        future = self._executor.submit(self._run, tool_call, dependencies)
+        self._submitted.append((tool_call, path, read_only, future))
+
+    def _run(self, tool_call, dependencies):
+        wait(dependencies)
+        tool_name = tool_call.get('tool')
+        if tool_call.get('error'):
+            result = f"[ERROR] Invalid arguments for {tool_name}: {tool_call['error']}"
+        else:
+            result = execute_tool_call(tool_name, tool_call.get('params', {}), self.file_manager)
+        TOOL_CALLS.inc(tool=tool_name)
+        return result
+
+    def results(self):
+        """按提交顺序返回 (tool_call, result)，并关闭线程池"""
+        if not self.batch:
+            try:
+                for tool_call, _, _, future in self._submitted:
+                    yield tool_call, future.result()
+            finally:
+                self._executor.shutdown(wait=True)
+            return
+
+        # 批量模式：等全部调用完成并提交后再返回结果，提交失败的调用改为报错
+        try:
+            results = [(tool_call, path, future.result()) for tool_call, path, _, future in self._submitted]
+        except BaseException:
+            self.abort()
+            raise
+        self._executor.shutdown(wait=True)
+        errors = self.file_manager.commit_batch()
+        for tool_call, path, result in results:
+            if path in errors and result.startswith('[SUCCESS]'):
+                result = f"[ERROR] Failed to commit write: {path}: {errors[path]}"
+            yield tool_call, result
+
+    def abort(self):
+        """放弃本轮：等待已提交的调用结束并丢弃暂存的修改"""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        if self.batch:
+            self.file_manager.abort_batch()
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='聊天服务器')
     parser.add_argument('--local', action='store_true', help='启用本地交互模式')
-    parser.add_argument('--output', type=str, default='webchat.log', help='对话日志输出路径')
+    parser.add_argument('--output', type=str,
+                        help='对话日志输出路径（未启用会话存储时默认 webchat.log，启用时默认不写）')
+    parser.add_argument('--session', type=str, help='继续已保存的会话（本地模式，会话ID）')
     parser.add_argument('--dir', type=str, help='指定工作目录（文件操作的基础路径）')
+    parser.add_argument('--host', type=str, default='0.0.0.0', help='Web 服务监听地址')
+    parser.add_argument('--port', type=int, default=21048, help='Web 服务监听端口')
+    parser.add_argument('--worker', action='store_true', help='作为 cluster.py 启动的后台 worker 运行')
     args = parser.parse_args()
-    
-    # 初始化对话历史
-    session_id = str(uuid.uuid4())
-    history = ConversationHistory(session_id)
+    init_session_store(maintenance=not args.worker)
     
     if args.local:
-        print(f"新建会话ID: {session_id}")
+        # 初始化对话历史：指定 --session 时从会话存储继续，历史随每条消息追加保存
+        history = None
+        if args.session and conversation_store is not None:
+            history = ConversationHistory.load_from_store(conversation_store, args.session)
+        if history is not None:
+            print(f"继续会话ID: {history.session_id}（{len(history.messages)} 条消息）")
+        else:
+            history = ConversationHistory(args.session or str(uuid.uuid4()))
+            print(f"新建会话ID: {history.session_id}")
+        if args.output is None and conversation_store is None:
+            args.output = 'webchat.log'
+        # 交互模式下控制台已显示对话内容，未指定日志文件时只输出警告和错误事件
+        if not os.getenv('WEBCHAT_LOG_FILE'):
+            get_logger().setLevel(logging.WARNING)
         
         # 初始化文件管理器（如果指定了工作目录）
         file_manager = FileManager(args.dir) if args.dir else FileManager()
+        file_manager.warm_index()
         file_mode = False  # 文件操作模式标志
         
         # 进入交互式对话循环
@@ -951,6 +2679,8 @@ if __name__ == '__main__':
                     
                 # 添加用户消息
                 history.add_user_message(user_input)
+                if conversation_store is not None and history.store is None:
+                    history.persist_to(conversation_store)
                 
                 # 处理对话（传入文件管理器以支持AI自动文件操作）
                 history = process_local_input(history, args.output, file_manager)
@@ -966,7 +2696,9 @@ if __name__ == '__main__':
         # 原有Web服务器模式
         print("服务器正在启动...")
         socketio.run(app, 
-                    host='0.0.0.0', 
-                    port=21048, 
+                    host=args.host, 
+                    port=args.port, 
                     debug=False,
-                    use_reloader=False)
\ No newline at end of file
+                    use_reloader=False,
+                    # 后台 worker 没有终端，threading 模式下需显式允许 Werkzeug 服务器
+                    allow_unsafe_werkzeug=args.worker)
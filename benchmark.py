@@ -0,0 +1,277 @@
+"""流式并发压测：对本地模拟上游测量并发流容量与逐块延迟
+
+用法:
+    python benchmark.py --streams 200
+    WEBCHAT_ASYNC_MODE=gevent python benchmark.py --streams 2000 --pool-size 2000
+    python benchmark.py --workers 4 --streams 200   # 多进程：1/2/4 个 worker，每个 worker 承载 200 个流
+"""
+import os
+
+# 与 app.py 一致：协程模式需在导入其他模块前 monkey patch
+if os.getenv('WEBCHAT_ASYNC_MODE') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+elif os.getenv('WEBCHAT_ASYNC_MODE') == 'eventlet':
+    import eventlet
+    eventlet.monkey_patch()
+
+import argparse
+import json
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, int(len(values) * pct / 100))
+    return values[index]
+
+
+def _disable_admission_limits(streams):
+    """压测流量都来自本机同一 IP，关闭按 IP / 会话的限速，并发上限不小于压测流数"""
+    os.environ.setdefault('WEBCHAT_IP_RATE', '0')
+    os.environ.setdefault('WEBCHAT_SESSION_RATE', '0')
+    os.environ.setdefault('WEBCHAT_MAX_CONCURRENT', str(streams))
+
+
+def run_stream_benchmark(args):
+    """并发执行 N 个 handle_message，统计完成数、首 token 延迟与块间延迟"""
+    # 必须先于 app 导入设置上游地址与连接池大小
+    os.environ['DEEPSEEK_BASE_URL'] = args.upstream
+    os.environ['DEEPSEEK_POOL_SIZE'] = str(args.pool_size)
+    os.environ['DEEPSEEK_POOL_KEEPALIVE'] = str(args.pool_size)
+    _disable_admission_limits(args.streams)
+    # 会话存储写入临时目录
+    os.environ.setdefault('WEBCHAT_STORE_PATH', os.path.join(tempfile.mkdtemp(prefix='webchat-bench-'), 'webchat.db'))
+    import app as webchat
+    webchat.init_session_store()
+    from deepseek_api import get_pool_stats
+
+    chunk_gaps = []
+    first_token_times = []
+    durations = []
+    errors = []
+    upstream_stream = webchat.deepseek1
+
+    def timed_deepseek1(messages, *a, **kw):
+        # 记录每个块交给 emit 的时间点
+        start = last = time.perf_counter()
+        first = True
+        for chunk in upstream_stream(messages, *a, **kw):
+            now = time.perf_counter()
+            if first:
+                first_token_times.append(now - start)
+                first = False
+            else:
+                chunk_gaps.append(now - last)
+            last = now
+            yield chunk
+        durations.append(time.perf_counter() - start)
+
+    webchat.deepseek1 = timed_deepseek1
+
+    def one_stream(index):
+        client = webchat.socketio.test_client(webchat.app)
+        try:
+            client.emit('message', {
+                'content': f'benchmark {index}',
+                'context': [{'role': 'user', 'content': f'benchmark {index}'}],
+                'session_id': f'bench-{index}',
+            })
+            for packet in client.get_received():
+                payload = packet['args'][0] if isinstance(packet['args'], list) else packet['args']
+                if payload.get('type') == 'error':
+                    errors.append(f"{index}: {payload.get('content')}")
+        except Exception as e:
+            errors.append(f"{index}: {e}")
+        finally:
+            client.disconnect()
+
+    started = time.perf_counter()
+    tasks = [webchat.socketio.start_background_task(one_stream, i) for i in range(args.streams)]
+    for task in tasks:
+        task.join()
+    elapsed = time.perf_counter() - started
+
+    print(f"异步模式: {webchat.ASYNC_MODE}")
+    print(f"并发流: {args.streams}  完成: {len(durations)}  错误: {len(errors)}  总耗时: {elapsed:.2f}s")
+    print(f"首 token 延迟: p50={percentile(first_token_times, 50) * 1000:.1f}ms "
+          f"p99={percentile(first_token_times, 99) * 1000:.1f}ms")
+    print(f"块间延迟: p50={percentile(chunk_gaps, 50) * 1000:.1f}ms "
+          f"p95={percentile(chunk_gaps, 95) * 1000:.1f}ms p99={percentile(chunk_gaps, 99) * 1000:.1f}ms")
+    print(f"连接池: {get_pool_stats()}")
+    if errors:
+        print(f"错误示例: {errors[:3]}")
+
+
+def _receive(ws, timeout):
+    """按短间隔轮询接收（simple_websocket 客户端偶尔丢失唤醒，单次长时间等待会卡到下一个心跳包）"""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        packet = ws.receive(timeout=0.5)
+        if packet is not None:
+            return packet
+    return None
+
+
+def socketio_stream(base_url, index, stats):
+    """最小 Socket.IO 客户端（Engine.IO v4 WebSocket 传输）：发送一条消息并读取到 end 事件"""
+    import simple_websocket
+    started = time.perf_counter()
+    ws = simple_websocket.Client.connect(base_url.replace('http', 'ws', 1) + '/socket.io/?EIO=4&transport=websocket')
+    try:
+        _receive(ws, 30)  # Engine.IO open 包
+        ws.send('40')  # 连接默认命名空间，收到确认后再发送事件
+        while not (_receive(ws, 30) or '').startswith('40'):
+            pass
+        ws.send('42' + json.dumps(['message', {
+            'content': f'benchmark {index}',
+            'context': [{'role': 'user', 'content': f'benchmark {index}'}],
+            'session_id': f'bench-{index}',
+        }]))
+        last = None
+        while True:
+            packet = _receive(ws, 120)
+            if packet is None:
+                raise TimeoutError('no packet within 120s')
+            if packet == '2':
+                ws.send('3')  # 心跳
+                continue
+            if not packet.startswith('42'):
+                continue
+            _, payload = json.loads(packet[2:])
+            now = time.perf_counter()
+            if payload.get('type') == 'stream':
+                if last is None:
+                    stats['first_token_times'].append(now - started)
+                else:
+                    stats['chunk_gaps'].append(now - last)
+                last = now
+            elif payload.get('type') == 'error':
+                stats['errors'].append(f"{index}: {payload.get('content')}")
+            elif payload.get('type') == 'end':
+                stats['durations'].append(now - started)
+                return
+    except Exception as e:
+        stats['errors'].append(f"{index}: {e}")
+    finally:
+        ws.close()
+
+
+def _wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"worker :{port} did not start")
+
+
+def run_cluster_benchmark(args):
+    """依次以 1、2、4…N 个 worker 运行，每个 worker 承载 --streams 个并发流，比较延迟与完成吞吐
+
+    客户端按轮询直接连接各 worker（模拟外部负载均衡），worker 间通过 cluster.py 的消息队列互联。
+    """
+    from cluster import cluster_env, spawn_workers, start_broker
+
+    counts = []
+    count = 1
+    while count < args.workers:
+        counts.append(count)
+        count *= 2
+    counts.append(args.workers)
+
+    os.environ['DEEPSEEK_BASE_URL'] = args.upstream
+    os.environ['DEEPSEEK_POOL_SIZE'] = str(args.pool_size)
+    os.environ['DEEPSEEK_POOL_KEEPALIVE'] = str(args.pool_size)
+    os.environ.setdefault('WEBCHAT_LOG_BODY', 'none')
+    _disable_admission_limits(args.streams)
+    work_dir = tempfile.mkdtemp(prefix='webchat-bench-')
+    mq_path = os.path.join(work_dir, 'mq.sock')
+    broker = start_broker(mq_path)
+    env = cluster_env(mq_path, os.path.join(work_dir, 'sessions'))
+    env.setdefault('WEBCHAT_STORE_PATH', os.path.join(work_dir, 'webchat.db'))
+    # worker 日志写入临时目录，避免刷屏
+    env['WEBCHAT_LOG_FILE'] = os.path.join(work_dir, 'webchat.jsonl')
+
+    rows = []
+    try:
+        for count in counts:
+            workers = spawn_workers(count, '127.0.0.1', args.base_port, env)
+            try:
+                for port, _ in workers:
+                    _wait_for_port(port)
+                stats = {'first_token_times': [], 'chunk_gaps': [], 'durations': [], 'errors': []}
+                total = args.streams * count
+                started = time.perf_counter()
+                threads = [threading.Thread(target=socketio_stream, daemon=True, args=(
+                    f"http://127.0.0.1:{workers[index % count][0]}", index, stats)) for index in range(total)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+                elapsed = time.perf_counter() - started
+            finally:
+                for _, process in workers:
+                    process.terminate()
+                for _, process in workers:
+                    process.wait()
+            rows.append((count, total, len(stats['durations']), len(stats['errors']), elapsed,
+                         percentile(stats['durations'], 50), percentile(stats['first_token_times'], 50),
+                         percentile(stats['chunk_gaps'], 95)))
+            print(f"workers={count} 并发流={total} 完成={len(stats['durations'])} 错误={len(stats['errors'])} "
+                  f"耗时={elapsed:.2f}s 单流时长 p50={rows[-1][5]:.2f}s "
+                  f"首token p50={rows[-1][6] * 1000:.1f}ms 块间 p95={rows[-1][7] * 1000:.1f}ms")
+            if stats['errors']:
+                print(f"  错误示例: {stats['errors'][:3]}")
+    finally:
+        broker.shutdown()
+
+    # 吞吐按单流时长中位数计算：个别连接握手卡到心跳包（约 25 秒）时不会拉低整体结果
+    base = rows[0][2] / rows[0][5] if rows and rows[0][5] else 0
+    print("\nworker 数  并发流  吞吐(流/秒)  相对 1 个 worker")
+    for count, total, done, _, _, duration, _, _ in rows:
+        throughput = done / duration if duration else 0
+        print(f"{count:>8}  {total:>6}  {throughput:>11.1f}  {throughput / base if base else 0:>6.2f}x")
+    print(f"（本机 CPU 核心数: {os.cpu_count()}，worker 数超过核心数后不会再线性增长）")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Web Chat 流式压测')
+    parser.add_argument('--streams', type=int, default=200, help='并发流数量')
+    parser.add_argument('--chunks', type=int, default=50, help='每个回复的块数')
+    parser.add_argument('--chunk-delay', type=float, default=0.02, help='模拟上游块间延迟（秒）')
+    parser.add_argument('--pool-size', type=int, default=1000, help='上游连接池大小')
+    parser.add_argument('--upstream', type=str, help='上游地址（默认自动启动 mock_upstream.py）')
+    parser.add_argument('--workers', type=int, default=0,
+                        help='多进程压测：依次以 1、2、4…N 个 worker 运行（--streams 为每个 worker 的流数）')
+    parser.add_argument('--base-port', type=int, default=21100, help='多进程压测时 worker 的起始端口')
+    args = parser.parse_args()
+
+    mock_process = None
+    if not args.upstream:
+        # 模拟上游放在独立进程，避免与被测进程争用 CPU / 事件循环
+        port = 18090
+        mock_process = subprocess.Popen([
+            sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mock_upstream.py'),
+            '--port', str(port), '--chunks', str(args.chunks), '--chunk-delay', str(args.chunk_delay),
+        ], stdout=subprocess.DEVNULL)
+        args.upstream = f"http://127.0.0.1:{port}/v1"
+        time.sleep(1)
+
+    try:
+        if args.workers:
+            run_cluster_benchmark(args)
+        else:
+            run_stream_benchmark(args)
+    finally:
+        if mock_process:
+            mock_process.terminate()
@@ -0,0 +1,121 @@
+"""结构化异步日志：JSON Lines 记录经后台队列写出，请求线程不再阻塞于 stdout/磁盘写入"""
+import atexit
+import hashlib
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import sys
+import threading
+from datetime import datetime
+
+LOG_FILE = os.getenv('WEBCHAT_LOG_FILE')  # 为空则输出到 stdout
+LOG_ROTATE = os.getenv('WEBCHAT_LOG_ROTATE', 'size')  # size: 按大小轮转 / midnight: 每天轮转
+LOG_MAX_BYTES = int(os.getenv('WEBCHAT_LOG_MAX_MB', '50')) * 1024 * 1024
+LOG_BACKUP_COUNT = int(os.getenv('WEBCHAT_LOG_BACKUPS', '7'))
+# 消息正文记录方式：full 完整记录（超长截断）/ redact 只记录长度和摘要哈希 / none 不记录
+LOG_BODY_MODE = os.getenv('WEBCHAT_LOG_BODY', 'full')
+LOG_BODY_SAMPLE_RATE = float(os.getenv('WEBCHAT_LOG_BODY_SAMPLE', '1.0'))  # 完整记录正文的采样比例
+LOG_BODY_MAX_CHARS = int(os.getenv('WEBCHAT_LOG_BODY_MAX_CHARS', '4000'))
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """每条记录输出为一行 JSON"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def _make_file_handler(path):
+    log_dir = os.path.dirname(path)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    if LOG_ROTATE == 'midnight':
+        return logging.handlers.TimedRotatingFileHandler(path, when='midnight', backupCount=LOG_BACKUP_COUNT,
+                                                         encoding='utf-8')
+    return logging.handlers.RotatingFileHandler(path, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT,
+                                                encoding='utf-8')
+
+
+_loggers = {}
+_listeners = []
+_setup_lock = threading.Lock()
+
+
+def _queued_logger(name, handler):
+    """创建经后台队列写出的 logger（调用方只做入队）"""
+    with _setup_lock:
+        if name in _loggers:
+            return _loggers[name]
+        handler.setFormatter(JsonLinesFormatter())
+        log_queue = queue.SimpleQueue()
+        logger = logging.getLogger(name)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+        logger.addHandler(logging.handlers.QueueHandler(log_queue))
+        listener = logging.handlers.QueueListener(log_queue, handler)
+        listener.start()
+        _listeners.append(listener)
+        _loggers[name] = logger
+        return logger
+
+
+def get_logger():
+    """获取应用事件日志"""
+    if 'webchat' in _loggers:
+        return _loggers['webchat']
+    handler = _make_file_handler(LOG_FILE) if LOG_FILE else logging.StreamHandler(sys.stdout)
+    return _queued_logger('webchat', handler)
+
+
+def _body_value(text, sampled):
+    """按配置处理消息正文：完整记录、截断、或只保留长度与哈希"""
+    if LOG_BODY_MODE == 'none':
+        return None
+    if LOG_BODY_MODE == 'redact' or not sampled:
+        return {'chars': len(text), 'sha256': hashlib.sha256(text.encode('utf-8')).hexdigest()[:16]}
+    if len(text) > LOG_BODY_MAX_CHARS:
+        return text[:LOG_BODY_MAX_CHARS] + f"...[截断 {len(text) - LOG_BODY_MAX_CHARS} 字符]"
+    return text
+
+
+def log_event(event, bodies=None, level=logging.INFO, **fields):
+    """记录一条结构化事件；bodies 中的消息正文按脱敏/采样配置处理"""
+    logger = get_logger()
+    if not logger.isEnabledFor(level):
+        return
+    if bodies:
+        sampled = LOG_BODY_SAMPLE_RATE >= 1 or random.random() < LOG_BODY_SAMPLE_RATE
+        for key, text in bodies.items():
+            value = _body_value(text or '', sampled)
+            if value is not None:
+                fields[key] = value
+    logger.log(level, event, extra={'fields': fields})
+
+
+def log_transcript(path, session_id, user_message, ai_message):
+    """写入对话记录（JSON Lines，完整正文，按大小/时间轮转）"""
+    name = f"webchat.transcript.{os.path.abspath(path)}"
+    logger = _loggers.get(name) or _queued_logger(name, _make_file_handler(path))
+    logger.info('transcript', extra={'fields': {
+        'session_id': session_id,
+        'user': user_message,
+        'assistant': ai_message,
+    }})
+
+
+def shutdown():
+    """刷新并停止所有后台写出线程"""
+    while _listeners:
+        _listeners.pop().stop()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,327 @@
+"""多进程部署：N 个 worker 进程 + 粘性会话代理 + 跨 worker 的 Socket.IO 消息队列
+
+用法:
+    python cluster.py --workers 4 --port 21048
+
+- 每个 worker 是一个独立的 app.py 进程（端口 base_port + i），各自使用一个 CPU 核心
+- 代理按客户端 IP 哈希把连接固定转发到同一个 worker（Socket.IO 长轮询要求粘性会话），worker 不可用时转发到下一个；
+  每个 HTTP 请求头追加 X-Forwarded-For，worker 信任该头（WEBCHAT_TRUST_PROXY=1），按 IP 限速与日志使用真实客户端地址
+- worker 之间通过消息队列转发 emit（WEBCHAT_MESSAGE_QUEUE）：unix:// 为本模块自带的 Unix socket 广播服务，
+  多机部署可换成 redis:// 等 python-socketio 支持的后端
+- 会话历史写入共享的会话存储（WEBCHAT_STORE_PATH，未启用时为共享目录），客户端被转到其他 worker 后仍能继续对话
+
+多机部署时用 nginx 等负载均衡器（ip_hash）替代内置代理，并设置 WEBCHAT_TRUST_PROXY=1。
+"""
+import argparse
+import asyncio
+import os
+import pickle
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import threading
+import time
+import zlib
+
+import socketio
+
+from conversation_store import STORE_PATH, STORE_RETENTION_DAYS, ConversationStore
+
+_HEADER = struct.Struct('!I')
+
+
+def _send_frame(sock, payload):
+    sock.sendall(_HEADER.pack(len(payload)) + payload)
+
+
+def _recv_exactly(sock, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError('message queue connection closed')
+        data += chunk
+    return bytes(data)
+
+
+def _recv_frame(sock):
+    size, = _HEADER.unpack(_recv_exactly(sock, _HEADER.size))
+    return _recv_exactly(sock, size)
+
+
+def _unix_path(url):
+    return url[len('unix://'):]
+
+
+class MessageBroker(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Unix socket 广播服务：把任一连接发来的帧转发给所有连接（本机多 worker 的消息队列）"""
+    daemon_threads = True
+
+    def __init__(self, path):
+        if os.path.exists(path):
+            os.remove(path)
+        self.clients = {}  # socket -> 发送锁
+        self.clients_lock = threading.Lock()
+        super().__init__(path, _BrokerHandler)
+
+    def broadcast(self, frame):
+        with self.clients_lock:
+            clients = list(self.clients.items())
+        for sock, lock in clients:
+            try:
+                with lock:
+                    _send_frame(sock, frame)
+            except OSError:
+                with self.clients_lock:
+                    self.clients.pop(sock, None)
+
+
+class _BrokerHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        with self.server.clients_lock:
+            self.server.clients[self.request] = threading.Lock()
+        try:
+            while True:
+                self.server.broadcast(_recv_frame(self.request))
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            with self.server.clients_lock:
+                self.server.clients.pop(self.request, None)
+
+
+def start_broker(path):
+    """在后台线程启动消息队列广播服务"""
+    broker = MessageBroker(path)
+    threading.Thread(target=broker.serve_forever, daemon=True).start()
+    return broker
+
+
+class UnixSocketManager(socketio.PubSubManager):
+    """基于 MessageBroker 的 Socket.IO 客户端管理器（url 形如 unix:///tmp/webchat-mq.sock）"""
+    name = 'unix'
+
+    def __init__(self, url, channel='flask-socketio', write_only=False, logger=None, json=None):
+        super().__init__(channel=channel, write_only=write_only, logger=logger, json=json)
+        self.path = _unix_path(url)
+        self._publisher = None
+        self._publish_lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock
+
+    def emit(self, event, data, namespace=None, room=None, skip_sid=None, callback=None, to=None, **kwargs):
+        """发给本进程上的单个客户端时直接发送，不经过消息队列（流式输出的绝大多数 emit）"""
+        room = to or room
+        if (room is not None and callback is None and not kwargs.get('ignore_queue')
+                and self.is_connected(room, namespace or '/')):
+            return super().emit(event, data, namespace=namespace, room=room, skip_sid=skip_sid, ignore_queue=True)
+        return super().emit(event, data, namespace=namespace, room=room, skip_sid=skip_sid, callback=callback,
+                            **kwargs)
+
+    def _publish(self, data):
+        frame = pickle.dumps({'channel': self.channel, 'data': data})
+        with self._publish_lock:
+            for retry in range(2):
+                try:
+                    if self._publisher is None:
+                        self._publisher = self._connect()
+                    _send_frame(self._publisher, frame)
+                    return
+                except OSError:
+                    # 广播服务重启后重连一次
+                    if self._publisher is not None:
+                        self._publisher.close()
+                    self._publisher = None
+                    if retry:
+                        raise
+
+    def _listen(self):
+        backoff = 0.1
+        while True:
+            try:
+                sock = self._connect()
+            except OSError:
+                time.sleep(backoff)
+                backoff = min(backoff * 2, 5)
+                continue
+            backoff = 0.1
+            try:
+                while True:
+                    message = pickle.loads(_recv_frame(sock))
+                    if message.get('channel') == self.channel:
+                        yield message['data']
+            except (ConnectionError, OSError):
+                sock.close()
+
+
+def queue_options(url):
+    """根据 WEBCHAT_MESSAGE_QUEUE 生成 SocketIO 的消息队列参数（为空则使用进程内管理器）"""
+    if not url:
+        return {}
+    if url.startswith('unix://'):
+        return {'client_manager': UnixSocketManager(url)}
+    return {'message_queue': url}
+
+
+def add_forwarded_for(head, client_ip):
+    """在 HTTP 请求头末尾追加客户端地址，返回 (新请求头, 请求体长度, 之后是否按原始字节转发)
+
+    已有的 X-Forwarded-For 保留在前面（worker 的 ProxyFix 只取最后一个，即本代理写入的地址）；
+    WebSocket 升级或分块传输的请求之后不再解析，剩余字节原样转发。
+    """
+    lines = head[:-4].split(b'\r\n')
+    headers = []
+    forwarded = None
+    length = 0
+    raw = False
+    for line in lines[1:]:
+        name, _, value = line.partition(b':')
+        name = name.strip().lower()
+        if name == b'x-forwarded-for':
+            forwarded = value.strip() if forwarded is None else forwarded + b', ' + value.strip()
+            continue
+        if name == b'content-length':
+            length = int(value)
+        elif name in (b'upgrade', b'transfer-encoding'):
+            raw = True
+        headers.append(line)
+    address = client_ip.encode()
+    headers.append(b'X-Forwarded-For: ' + (address if forwarded is None else forwarded + b', ' + address))
+    return b'\r\n'.join([lines[0], *headers]) + b'\r\n\r\n', length, raw
+
+
+class StickyProxy:
+    """按客户端 IP 哈希选择 worker 的 HTTP/WebSocket 代理（同一客户端的轮询与 WebSocket 请求落在同一个 worker）"""
+
+    def __init__(self, backends):
+        self.backends = backends  # [(host, port)]
+
+    async def handle(self, client_reader, client_writer):
+        peer = client_writer.get_extra_info('peername')
+        client_ip = str(peer[0]) if peer else ''
+        start = zlib.crc32(client_ip.encode()) % len(self.backends)
+        for offset in range(len(self.backends)):
+            host, port = self.backends[(start + offset) % len(self.backends)]
+            try:
+                upstream_reader, upstream_writer = await asyncio.open_connection(host, port)
+                break
+            except OSError:
+                continue  # worker 不可用，转到下一个（会话历史在共享存储中）
+        else:
+            client_writer.close()
+            return
+        await asyncio.gather(self._forward_requests(client_reader, upstream_writer, client_ip),
+                             self._pipe(upstream_reader, client_writer))
+
+    async def _forward_requests(self, reader, writer, client_ip):
+        """客户端 -> worker：逐个请求追加 X-Forwarded-For 后转发，升级为 WebSocket 后原样转发"""
+        try:
+            while True:
+                head = await reader.readuntil(b'\r\n\r\n')
+                head, length, raw = add_forwarded_for(head, client_ip)
+                writer.write(head)
+                while length > 0:
+                    data = await reader.read(min(length, 65536))
+                    if not data:
+                        raise ConnectionError('client closed during request body')
+                    writer.write(data)
+                    await writer.drain()
+                    length -= len(data)
+                await writer.drain()
+                if raw:
+                    break
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError, OSError):
+            # 客户端断开或请求头无法解析
+            writer.close()
+            return
+        await self._pipe(reader, writer)
+
+    @staticmethod
+    async def _pipe(reader, writer):
+        try:
+            while True:
+                data = await reader.read(65536)
+                if not data:
+                    break
+                writer.write(data)
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host, port):
+        server = await asyncio.start_server(self.handle, host, port, backlog=4096)
+        async with server:
+            await server.serve_forever()
+
+
+def spawn_workers(count, host, base_port, env, extra_args=()):
+    """启动 worker 进程，返回 [(port, Popen)]"""
+    app_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app.py')
+    workers = []
+    for index in range(count):
+        port = base_port + index
+        process = subprocess.Popen([sys.executable, app_path, '--host', host, '--port', str(port), '--worker',
+                                    *extra_args],
+                                   env=env)
+        workers.append((port, process))
+    return workers
+
+
+def cluster_env(mq_path, session_dir):
+    """worker 进程的环境变量：共享消息队列与会话目录，信任代理写入的 X-Forwarded-For"""
+    env = dict(os.environ)
+    env['WEBCHAT_MESSAGE_QUEUE'] = f"unix://{mq_path}"
+    env['WEBCHAT_SESSION_SHARED'] = '1'
+    env['WEBCHAT_TRUST_PROXY'] = '1'
+    env.setdefault('WEBCHAT_SESSION_SPILL_DIR', session_dir)
+    return env
+
+
+def supervise(workers, host, env):
+    """worker 异常退出后自动重启"""
+    while True:
+        time.sleep(1)
+        for index, (port, process) in enumerate(workers):
+            if process.poll() is not None:
+                print(f"worker :{port} 已退出（{process.returncode}），重新启动")
+                workers[index] = spawn_workers(1, host, port, env)[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='多进程部署 Web Chat')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='worker 进程数（默认 CPU 核心数）')
+    parser.add_argument('--host', type=str, default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=21048, help='粘性代理监听端口')
+    parser.add_argument('--base-port', type=int, help='worker 起始端口（默认 port + 1）')
+    parser.add_argument('--mq', type=str, help='消息队列 Unix socket 路径')
+    parser.add_argument('--session-dir', type=str, default='sessions', help='共享会话目录')
+    args = parser.parse_args()
+
+    base_port = args.base_port or args.port + 1
+    mq_path = args.mq or f"/tmp/webchat-{args.port}.sock"
+    start_broker(mq_path)
+    if STORE_PATH:
+        # 会话存储的升级（VACUUM）与过期清理只在主进程执行一次，worker 启动时不再同时争用数据库锁
+        store = ConversationStore(STORE_PATH)
+        if STORE_RETENTION_DAYS > 0:
+            store.compact()
+        store.close()
+    env = cluster_env(mq_path, os.path.abspath(args.session_dir))
+    workers = spawn_workers(args.workers, '127.0.0.1', base_port, env)
+    threading.Thread(target=supervise, args=(workers, '127.0.0.1', env), daemon=True).start()
+    print(f"{args.workers} 个 worker（端口 {base_port}-{base_port + args.workers - 1}），"
+          f"代理监听 {args.host}:{args.port}，消息队列 unix://{mq_path}")
+    try:
+        asyncio.run(StickyProxy([('127.0.0.1', port) for port, _ in workers]).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for _, process in workers:
+            process.terminate()
@@ -0,0 +1,262 @@
+"""会话持久化存储：SQLite（WAL）上的只追加消息日志 + 会话索引
+
+- 每条消息一行，追加一条消息只需一次 INSERT，不再整体重写会话文件
+- 按 session_id 与时间建索引，支持按时间列出会话、加载单个会话
+- compact() 按保留期删除旧会话并回收空间；export() 以 JSON Lines 批量导出
+
+多个进程（cluster.py 的 worker）可以共享同一个数据库文件。
+
+命令行:
+    python conversation_store.py sessions --db webchat.db --since 2026-01-01
+    python conversation_store.py export --db webchat.db --out sessions.jsonl
+    python conversation_store.py compact --db webchat.db --retention-days 30
+"""
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+
+STORE_PATH = os.getenv('WEBCHAT_STORE_PATH', 'webchat.db')  # 为空则不持久化（web 模式退回到内存 + 落盘目录）
+STORE_RETENTION_DAYS = float(os.getenv('WEBCHAT_STORE_RETENTION_DAYS', '0'))  # 启动时删除更早的会话，0 表示永久保留
+BUSY_TIMEOUT_MS = 5000  # 多进程同时写入时的等待时间
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS sessions ('
+    'session_id TEXT PRIMARY KEY, created REAL NOT NULL, updated REAL NOT NULL, '
+    'message_count INTEGER NOT NULL DEFAULT 0, version INTEGER NOT NULL DEFAULT 0, meta TEXT)',
+    'CREATE INDEX IF NOT EXISTS sessions_updated ON sessions (updated)',
+    'CREATE TABLE IF NOT EXISTS messages ('
+    'session_id TEXT NOT NULL, seq INTEGER NOT NULL, role TEXT NOT NULL, content TEXT, extra TEXT, '
+    'created REAL NOT NULL, PRIMARY KEY (session_id, seq)) WITHOUT ROWID',
+    'CREATE INDEX IF NOT EXISTS messages_created ON messages (created)',
+)
+_MESSAGE_FIELDS = ('role', 'content')
+
+
+def _split_message(msg):
+    """消息拆为 (role, content, 其余字段的 JSON)；tool_calls 等附加字段原样保存"""
+    extra = {key: value for key, value in msg.items() if key not in _MESSAGE_FIELDS}
+    return msg.get('role', 'user'), msg.get('content'), json.dumps(extra, ensure_ascii=False) if extra else None
+
+
+def _join_message(role, content, extra):
+    msg = {'role': role, 'content': content}
+    if extra:
+        msg.update(json.loads(extra))
+    return msg
+
+
+def _timestamp(value):
+    """datetime / ISO 字符串 / 时间戳统一为时间戳"""
+    if value is None or isinstance(value, (int, float)):
+        return value
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.timestamp()
+
+
+class ConversationStore:
+    """会话与消息的持久化存储（线程安全，写操作各自为一个事务）
+
+    每次写入都会递增会话的 version，多进程共享时据此判断内存中的会话是否已被其他进程更新。
+    """
+
+    def __init__(self, path=STORE_PATH, vacuum=True):
+        store_dir = os.path.dirname(path)
+        if store_dir:
+            os.makedirs(store_dir, exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = self._connect()
+        for statement in _SCHEMA:
+            self._conn.execute(statement)
+        if vacuum and self._conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+            # 未启用增量回收的已有数据库：_connect 中设置的 auto_vacuum 要经过一次 VACUUM 才生效；
+            # 多进程共享时只由一个进程执行（vacuum=False 的进程不升级，见 cluster.py）
+            self._conn.execute('VACUUM')
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None,
+                               timeout=BUSY_TIMEOUT_MS / 1000)
+        # 增量回收（compact() 删除会话后归还空间）必须在建库前设置，切换到 WAL 就会初始化数据库文件
+        conn.execute('PRAGMA auto_vacuum=INCREMENTAL')
+        conn.execute('PRAGMA journal_mode=WAL')
+        # WAL 模式下 NORMAL 只在检查点时 fsync，追加一条消息不必等待磁盘
+        conn.execute('PRAGMA synchronous=NORMAL')
+        return conn
+
+    def _touch_locked(self, session_id, now, added=0, meta=None):
+        """更新会话索引行（不存在则创建），返回新的 version"""
+        meta_json = json.dumps(meta, ensure_ascii=False) if meta is not None else None
+        self._conn.execute(
+            'INSERT INTO sessions (session_id, created, updated, message_count, version, meta) '
+            'VALUES (?, ?, ?, ?, 1, ?) ON CONFLICT (session_id) DO UPDATE SET '
+            'updated = excluded.updated, message_count = message_count + ?, version = version + 1, '
+            'meta = COALESCE(excluded.meta, meta)',
+            (session_id, now, now, added, meta_json, added))
+        return self._conn.execute('SELECT version FROM sessions WHERE session_id = ?', (session_id,)).fetchone()[0]
+
+    def append(self, session_id, seq, msg):
+        """追加一条消息（seq 为该消息在会话中的下标），返回会话的新 version"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('INSERT INTO messages (session_id, seq, role, content, extra, created) '
+                                   'VALUES (?, ?, ?, ?, ?, ?)', (session_id, seq, *_split_message(msg), now))
+                version = self._touch_locked(session_id, now, added=1)
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return version
+
+    def replace(self, session_id, messages, meta=None):
+        """整体替换会话的消息（新建会话或客户端重新同步完整上下文时），返回新的 version"""
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                self._conn.execute('DELETE FROM messages WHERE session_id = ?', (session_id,))
+                self._conn.executemany(
+                    'INSERT INTO messages (session_id, seq, role, content, extra, created) VALUES (?, ?, ?, ?, ?, ?)',
+                    [(session_id, seq, *_split_message(msg), now) for seq, msg in enumerate(messages)])
+                self._conn.execute('DELETE FROM sessions WHERE session_id = ?', (session_id,))
+                version = self._touch_locked(session_id, now, added=len(messages), meta=meta or {})
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return version
+
+    def truncate(self, session_id, count):
+        """只保留会话的前 count 条消息（撤回未被处理的消息），返回新的 version"""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                removed = self._conn.execute('DELETE FROM messages WHERE session_id = ? AND seq >= ?',
+                                             (session_id, count)).rowcount
+                version = self._touch_locked(session_id, time.time(), added=-removed)
+                self._conn.execute('COMMIT')
+            except BaseException:
+                self._conn.execute('ROLLBACK')
+                raise
+        return version
+
+    def update_meta(self, session_id, meta):
+        """更新会话元数据（摘要、上下文窗口起点等），返回新的 version"""
+        with self._lock:
+            return self._touch_locked(session_id, time.time(), meta=meta)
+
+    def version(self, session_id):
+        with self._lock:
+            row = self._conn.execute('SELECT version FROM sessions WHERE session_id = ?', (session_id,)).fetchone()
+        return row[0] if row else None
+
+    def load(self, session_id):
+        """返回 (消息列表, 元数据, version, 最后更新时间戳)，不存在返回 None"""
+        with self._lock:
+            row = self._conn.execute('SELECT meta, version, updated FROM sessions WHERE session_id = ?',
+                                     (session_id,)).fetchone()
+            if row is None:
+                return None
+            messages = [_join_message(*fields) for fields in self._conn.execute(
+                'SELECT role, content, extra FROM messages WHERE session_id = ? ORDER BY seq', (session_id,))]
+        meta, version, updated = row
+        return messages, json.loads(meta) if meta else {}, version, updated
+
+    def list_sessions(self, since=None, until=None, limit=100):
+        """按最后更新时间倒序列出会话：[{session_id, created, updated, message_count}]"""
+        query = 'SELECT session_id, created, updated, message_count FROM sessions WHERE updated >= ? AND updated < ? ' \
+                'ORDER BY updated DESC LIMIT ?'
+        with self._lock:
+            rows = self._conn.execute(query, (_timestamp(since) or 0, _timestamp(until) or float('inf'),
+                                              limit)).fetchall()
+        return [dict(zip(('session_id', 'created', 'updated', 'message_count'), row)) for row in rows]
+
+    def export(self, out, since=None, until=None, session_ids=None):
+        """把消息以 JSON Lines 写入 out（文件对象），按会话与顺序排列，返回导出的消息数
+
+        使用独立的只读连接逐行读取（WAL 下不阻塞写入），不会把整个数据库载入内存。
+        """
+        query = 'SELECT session_id, seq, role, content, extra, created FROM messages WHERE created >= ? AND created < ?'
+        params = [_timestamp(since) or 0, _timestamp(until) or float('inf')]
+        if session_ids:
+            query += f" AND session_id IN ({','.join('?' * len(session_ids))})"
+            params.extend(session_ids)
+        conn = self._connect()
+        count = 0
+        try:
+            for session_id, seq, role, content, extra, created in conn.execute(query + ' ORDER BY session_id, seq',
+                                                                                 params):
+                record = {'session_id': session_id, 'seq': seq, 'created': datetime.fromtimestamp(created).isoformat()}
+                record.update(_join_message(role, content, extra))
+                out.write(json.dumps(record, ensure_ascii=False) + '\n')
+                count += 1
+        finally:
+            conn.close()
+        return count
+
+    def compact(self, retention_days=STORE_RETENTION_DAYS):
+        """删除超过保留期未更新的会话，合并 WAL 并回收空闲页，返回删除的会话数"""
+        with self._lock:
+            removed = 0
+            if retention_days > 0:
+                cutoff = time.time() - retention_days * 86400
+                self._conn.execute('BEGIN IMMEDIATE')
+                try:
+                    self._conn.execute('DELETE FROM messages WHERE session_id IN '
+                                       '(SELECT session_id FROM sessions WHERE updated < ?)', (cutoff,))
+                    removed = self._conn.execute('DELETE FROM sessions WHERE updated < ?', (cutoff,)).rowcount
+                    self._conn.execute('COMMIT')
+                except BaseException:
+                    self._conn.execute('ROLLBACK')
+                    raise
+            # execute() 只执行一步（只释放一页），executescript 会执行到结束；之后再合并 WAL 才能截短数据库文件
+            self._conn.executescript('PRAGMA incremental_vacuum;')
+            self._conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        return removed
+
+    def stats(self):
+        with self._lock:
+            sessions, messages = self._conn.execute(
+                'SELECT COUNT(*), COALESCE(SUM(message_count), 0) FROM sessions').fetchone()
+        return {'sessions': sessions, 'messages': messages}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='会话存储管理')
+    parser.add_argument('command', choices=['sessions', 'export', 'compact'])
+    parser.add_argument('--db', type=str, default=STORE_PATH or 'webchat.db', help='数据库路径')
+    parser.add_argument('--since', type=str, help='起始时间（ISO 格式，如 2026-01-01）')
+    parser.add_argument('--until', type=str, help='结束时间（ISO 格式，不含）')
+    parser.add_argument('--session', action='append', help='只导出指定会话（可重复）')
+    parser.add_argument('--out', type=str, help='导出文件路径（默认输出到标准输出）')
+    parser.add_argument('--limit', type=int, default=100, help='列出的最大会话数')
+    parser.add_argument('--retention-days', type=float, default=STORE_RETENTION_DAYS, help='保留天数')
+    args = parser.parse_args()
+
+    store = ConversationStore(args.db)
+    if args.command == 'sessions':
+        for session in store.list_sessions(args.since, args.until, args.limit):
+            print(f"{session['session_id']}  {datetime.fromtimestamp(session['updated']):%Y-%m-%d %H:%M:%S}  "
+                  f"{session['message_count']} 条消息")
+    elif args.command == 'export':
+        out = open(args.out, 'w', encoding='utf-8') if args.out else sys.stdout
+        try:
+            count = store.export(out, args.since, args.until, args.session)
+        finally:
+            if args.out:
+                out.close()
+        print(f"已导出 {count} 条消息", file=sys.stderr)
+    else:
+        print(f"已删除 {store.compact(args.retention_days)} 个会话，统计: {store.stats()}")
+    store.close()
@@ -1,34 +1,238 @@
+import os
+import socket
+import threading
+import time
+
+import httpx
+import openai
 from openai import OpenAI
 
-def deepseek1(message, stream=True):
-    client = OpenAI(
-     base_url="https://api.deepseek.com/",
-     api_key="sk-xxxxxx"
-     #腾讯云
-     # base_url="https://api.lkeap.cloud.tencent.com/v1",
-     # api_key="sk-xxxxxx"
+from provider_router import (CancelToken, FirstTokenTimeout, ProviderRouter, StreamCancelled, UpstreamUnavailable,
+                             load_providers)
 
 
-    )
-    completion = client.chat.completions.create(
-        # deepseek官方 DeepSeek-V3-0324 - 推荐
-        model="deepseek-chat",
-        # deepseek官方 DeepSeek-R1-0528 - 推理模型
-        # model="deepseek-reasoner",
-        # 腾讯云
-        # model="deepseek-v3",
-        messages=message,
-        stream=stream
+# 上游配置（通过环境变量覆盖，方便切换到腾讯云或本地模拟服务）
+# 腾讯云: DEEPSEEK_BASE_URL=https://api.lkeap.cloud.tencent.com/v1 DEEPSEEK_MODEL=deepseek-v3
+# 同时使用多个上游见 provider_router.py（DEEPSEEK_PROVIDERS），未配置时以下为唯一上游
+DEEPSEEK_BASE_URL = os.getenv('DEEPSEEK_BASE_URL', 'https://api.deepseek.com/')
+DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY', 'sk-xxxxxx')
+# deepseek官方 DeepSeek-V3-0324 - 推荐；推理模型可设置为 deepseek-reasoner
+DEEPSEEK_MODEL = os.getenv('DEEPSEEK_MODEL', 'deepseek-chat')
+
+# 连接池配置
+POOL_MAX_CONNECTIONS = int(os.getenv('DEEPSEEK_POOL_SIZE', '100'))
+POOL_MAX_KEEPALIVE = int(os.getenv('DEEPSEEK_POOL_KEEPALIVE', '20'))
+POOL_KEEPALIVE_EXPIRY = float(os.getenv('DEEPSEEK_KEEPALIVE_EXPIRY', '60'))
+CONNECT_TIMEOUT = float(os.getenv('DEEPSEEK_CONNECT_TIMEOUT', '10'))
+# 块间超时：两次读取之间超过该时间没有数据即中断流（首个块的超时与重试见 provider_router.py）
+READ_TIMEOUT = float(os.getenv('DEEPSEEK_READ_TIMEOUT', '60'))
+# 流式请求末尾返回 usage（含前缀缓存命中 token 数），上游不支持 stream_options 时可关闭
+STREAM_USAGE = os.getenv('DEEPSEEK_STREAM_USAGE', '1') == '1'
+
+
+class PoolStats:
+    """上游连接池统计（复用命中/新建连接/建连耗时）"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.connect_count = 0
+        self.connect_time_total = 0.0
+        self.connect_time_max = 0.0
+
+    def record_request(self, new_connection, connect_time=0.0):
+        with self._lock:
+            if new_connection:
+                self.misses += 1
+                self.connect_count += 1
+                self.connect_time_total += connect_time
+                self.connect_time_max = max(self.connect_time_max, connect_time)
+            else:
+                self.hits += 1
+
+    def snapshot(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'connect_count': self.connect_count,
+                'connect_time_avg': self.connect_time_total / self.connect_count if self.connect_count else 0.0,
+                'connect_time_max': self.connect_time_max,
+            }
+
+
+pool_stats = PoolStats()
 
+
+def _make_tracer():
+    """为单个请求生成 httpcore trace 回调，用于区分连接复用与新建连接"""
+    state = {'connect_started': None, 'connect_time': 0.0, 'new_connection': False}
+
+    def trace(event_name, info):
+        if event_name == 'connection.connect_tcp.started':
+            state['connect_started'] = time.perf_counter()
+            state['new_connection'] = True
+        elif event_name in ('connection.connect_tcp.complete', 'connection.start_tls.complete'):
+            # 建连耗时包含 TCP 与 TLS 握手
+            if state['connect_started'] is not None:
+                state['connect_time'] = time.perf_counter() - state['connect_started']
+        elif event_name.endswith('.send_request_headers.started'):
+            pool_stats.record_request(state['new_connection'], state['connect_time'])
+
+    return trace
+
+
+def _attach_tracer(request):
+    request.extensions['trace'] = _make_tracer()
+
+
+def _make_client(provider):
+    """为一个上游创建客户端（独立的 HTTP keep-alive 连接池）"""
+    http_client = httpx.Client(
+        limits=httpx.Limits(
+            max_connections=POOL_MAX_CONNECTIONS,
+            max_keepalive_connections=POOL_MAX_KEEPALIVE,
+            keepalive_expiry=POOL_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(READ_TIMEOUT, connect=CONNECT_TIMEOUT),
+        event_hooks={'request': [_attach_tracer]},
     )
+    # 重试由 ProviderRouter 统一处理（退避、切换上游、熔断），SDK 自身不再重试
+    return OpenAI(base_url=provider.base_url, api_key=provider.api_key, http_client=http_client, max_retries=0)
+
+
+def _should_failover(exc):
+    """请求本身不合法（400/422）时换上游也无济于事，直接抛给调用方"""
+    return not isinstance(exc, (openai.BadRequestError, openai.UnprocessableEntityError))
+
+
+router = ProviderRouter(load_providers(DEEPSEEK_BASE_URL, DEEPSEEK_API_KEY, DEEPSEEK_MODEL), _make_client,
+                        should_failover=_should_failover)
+
+
+def get_client():
+    """获取首个上游的共享客户端（HTTP keep-alive 连接池）"""
+    return router.client(router.providers[0])
+
+
+def close_client():
+    """关闭所有上游客户端（进程退出或切换配置时调用）"""
+    router.close()
+
+
+def get_router_stats():
+    """返回各上游的滚动首 token 延迟、错误率与健康状态"""
+    return router.stats()
+
+
+def get_pool_stats():
+    """返回连接池统计快照"""
+    return pool_stats.snapshot()
+
+
+def _finish_tool_calls(pending, below=None):
+    """取出参数已接收完整的工具调用（按下标顺序）"""
+    for index in sorted(pending):
+        if below is not None and index >= below:
+            break
+        call = pending.pop(index)
+        yield {'id': call['id'], 'name': call['name'], 'arguments': ''.join(call['arguments'])}
+
+
+def usage_dict(usage):
+    """提取 token 用量；前缀缓存命中数兼容 DeepSeek（prompt_cache_hit_tokens）与 OpenAI（cached_tokens）字段"""
+    cache_hit = getattr(usage, 'prompt_cache_hit_tokens', None)
+    if cache_hit is None:
+        details = getattr(usage, 'prompt_tokens_details', None)
+        cache_hit = getattr(details, 'cached_tokens', None) if details else None
+    return {
+        'prompt_tokens': usage.prompt_tokens or 0,
+        'completion_tokens': usage.completion_tokens or 0,
+        'prompt_cache_hit_tokens': cache_hit or 0,
+    }
+
+
+def deepseek1(message, stream=True, tools=None, on_usage=None, cancel=None):
+    """流式请求模型，逐个 yield 文本增量
+
+    传入 tools（OpenAI function calling 格式）时，模型发起的工具调用在参数接收完整后以
+    {'id', 'name', 'arguments'} 字典的形式 yield（arguments 为 JSON 字符串）。
+    传入 on_usage 时，上游返回的 token 用量（见 usage_dict）会回调给它。
+    传入 cancel（CancelToken）时，取消后立即关闭上游连接并抛出 StreamCancelled。
+    """
+    extra = {'tools': tools} if tools else {}
+    if stream and STREAM_USAGE:
+        extra['stream_options'] = {'include_usage': True}
+
+    def open_stream(provider):
+        return router.client(provider).chat.completions.create(
+            model=provider.model,
+            messages=message,
+            stream=True,
+            **extra
+        )
+
     if stream:
-        # 返回生成器对象
-        for chunk in completion:
-            if chunk.choices[0].delta.content:
-                yield chunk.choices[0].delta.content
+        # 返回生成器对象；首个块到达前的失败由路由器切换到其他上游
+        provider, completion, chunks = router.open(open_stream, cancel=cancel)
+        if cancel is not None:
+            cancel.on_cancel(lambda: _abort_stream(completion))
+        try:
+            for item in _stream_chunks(chunks, on_usage):
+                if cancel is not None:
+                    cancel.check()
+                yield item
+            if cancel is not None:
+                cancel.check()
+        except (httpx.HTTPError, openai.APIError) as e:
+            if cancel is not None and cancel.cancelled:
+                # 取消时关闭连接导致的读取错误，不计入上游错误率
+                raise StreamCancelled(cancel.reason) from None
+            # 首个块之后的失败不再重试（已有内容发给用户），但计入该上游的错误率
+            provider.record_failure('chunk_timeout' if isinstance(e, httpx.TimeoutException) else 'stream_error')
+            raise
+        finally:
+            completion.close()
     else:
-        return completion.choices[0].message.content    
+        provider = router.candidates()[0]
+        completion = router.client(provider).chat.completions.create(model=provider.model, messages=message, **extra)
+        return completion.choices[0].message.content
+
+
+def _abort_stream(completion):
+    """从其他线程中断正在读取的流：shutdown 底层 socket 使阻塞中的读取立即返回（close 不会唤醒它）"""
+    try:
+        completion.response.extensions['network_stream'].get_extra_info('socket').shutdown(socket.SHUT_RDWR)
+    except (AttributeError, KeyError, OSError):
+        # 拿不到 socket 时退回到下一个块到达时再退出
+        pass
 
-    # print(completion.choices[0].message.content)
 
-    # return completion.choices[0].message.content
+def _stream_chunks(chunks, on_usage):
+    """将上游流式块转换为文本增量与完整的工具调用"""
+    pending = {}  # 下标 -> 正在接收参数的工具调用
+    for chunk in chunks:
+        if chunk.usage and on_usage:
+            on_usage(usage_dict(chunk.usage))
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+        if delta.content:
+            yield delta.content
+        for tool_delta in delta.tool_calls or ():
+            if tool_delta.index not in pending:
+                # 出现新的下标，说明之前的调用参数已经完整，可以先交给调用方执行
+                yield from _finish_tool_calls(pending, below=tool_delta.index)
+                pending[tool_delta.index] = {'id': '', 'name': '', 'arguments': []}
+            call = pending[tool_delta.index]
+            if tool_delta.id:
+                call['id'] = tool_delta.id
+            if tool_delta.function:
+                if tool_delta.function.name:
+                    call['name'] += tool_delta.function.name
+                if tool_delta.function.arguments:
+                    call['arguments'].append(tool_delta.function.arguments)
+    yield from _finish_tool_calls(pending)
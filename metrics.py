@@ -0,0 +1,179 @@
+"""Prometheus 文本格式指标
+
+热路径上的记录按线程分片累加：每个线程只写自己的分片，不加锁；抓取时再合并所有分片。
+"""
+import threading
+from bisect import bisect_left
+
+# 延迟类直方图默认分桶（秒）
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_registry = []
+
+
+def _format_labels(labelnames, key, extra=None):
+    pairs = list(zip(labelnames, key))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    escaped = ('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for name, value in pairs)
+    return '{' + ','.join(escaped) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    metric_type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._shards = {}  # 线程ID -> {标签值元组: 数据}
+        _registry.append(self)
+
+    def _shard(self):
+        ident = threading.get_ident()
+        shard = self._shards.get(ident)
+        if shard is None:
+            # 只有当前线程会写入该分片；线程ID复用时继续累加，数值不会丢失
+            shard = self._shards[ident] = {}
+        return shard
+
+    def _key(self, labels):
+        return tuple(labels.get(name, '') for name in self.labelnames)
+
+    def _header(self):
+        return [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+
+
+class Counter(_Metric):
+    """只增计数器"""
+    metric_type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        shard[key] = shard.get(key, 0) + amount
+
+    def values(self):
+        merged = {}
+        for shard in list(self._shards.values()):
+            for key, value in list(shard.items()):
+                merged[key] = merged.get(key, 0) + value
+        return merged
+
+    def render(self):
+        lines = self._header()
+        for key, value in sorted(self.values().items()):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}")
+        return lines
+
+
+class Gauge(Counter):
+    """可增可减的瞬时值（如活跃流数量）"""
+    metric_type = 'gauge'
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """分桶直方图（分片中保存各桶的非累积计数与总和）"""
+    metric_type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        shard = self._shard()
+        key = self._key(labels)
+        series = shard.get(key)
+        if series is None:
+            # [各桶计数..., +Inf 桶计数, 总和]
+            series = shard[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self):
+        merged = {}
+        for shard in list(self._shards.values()):
+            for key, series in list(shard.items()):
+                total = merged.setdefault(key, [0] * len(series[:-1]) + [0.0])
+                for index, value in enumerate(series):
+                    total[index] += value
+        lines = self._header()
+        for key, series in sorted(merged.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), series[:-1]):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, ('le', _format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(series[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class CallbackMetric(_Metric):
+    """抓取时调用函数取值（用于导出已有的统计快照）"""
+
+    def __init__(self, name, documentation, callback, metric_type='gauge'):
+        super().__init__(name, documentation)
+        self.callback = callback
+        self.metric_type = metric_type
+
+    def render(self):
+        return self._header() + [f"{self.name} {_format_value(self.callback())}"]
+
+
+def render_metrics():
+    """以 Prometheus 文本格式输出全部指标"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+# 对话延迟与吞吐指标
+CHAT_TTFT = Histogram('webchat_time_to_first_token_seconds', 'Time from request to first upstream token',
+                      ('model', 'mode'))
+CHAT_DURATION = Histogram('webchat_completion_duration_seconds', 'Total duration of a chat completion',
+                          ('model', 'mode'))
+CHAT_TOKENS_PER_SECOND = Histogram('webchat_tokens_per_second', 'Estimated completion tokens per second after first token',
+                                   ('model', 'mode'), buckets=(5, 10, 20, 40, 60, 80, 100, 150, 200, 400))
+CHAT_COMPLETION_TOKENS = Counter('webchat_completion_tokens_total', 'Estimated completion tokens streamed',
+                                 ('model', 'mode'))
+CHAT_PROMPT_TOKENS = Counter('webchat_prompt_tokens_total', 'Prompt tokens reported by upstream usage',
+                             ('model', 'mode'))
+CHAT_PROMPT_CACHE_HIT_TOKENS = Counter('webchat_prompt_cache_hit_tokens_total',
+                                       'Prompt tokens served from the upstream prefix cache', ('model', 'mode'))
+CHAT_ACTIVE_STREAMS = Gauge('webchat_active_streams', 'Completions currently streaming', ('mode',))
+CHAT_UPSTREAM_ERRORS = Counter('webchat_upstream_errors_total', 'Upstream errors during completion',
+                               ('model', 'mode'))
+CHAT_CANCELLED = Counter('webchat_cancelled_completions_total', 'Completions cancelled before the upstream finished',
+                         ('mode', 'reason'))
+CHAT_WASTED_TOKENS = Counter('webchat_wasted_completion_tokens_total',
+                             'Estimated completion tokens streamed for completions that were later cancelled',
+                             ('mode', 'reason'))
+TOOL_ITERATIONS = Histogram('webchat_tool_loop_iterations', 'Tool loop iterations per local-mode turn',
+                            ('model',), buckets=(0, 1, 2, 3, 5, 8, 10))
+TOOL_CALLS = Counter('webchat_tool_calls_total', 'Tool calls executed by the agent loop', ('tool',))
+CACHE_REQUESTS = Counter('webchat_response_cache_requests_total', 'Response cache lookups by result and tier',
+                         ('result', 'tier'))
+UPSTREAM_REQUESTS = Counter('webchat_upstream_requests_total', 'Upstream requests by provider and result',
+                            ('provider', 'result'))
+UPSTREAM_TTFT = Histogram('webchat_upstream_first_chunk_seconds', 'Time to first upstream chunk per provider',
+                          ('provider',))
+UPSTREAM_BREAKER_OPEN = Gauge('webchat_upstream_circuit_open', 'Whether the circuit breaker of a provider is open',
+                              ('provider',))
+ADMISSION_WAIT = Histogram('webchat_admission_wait_seconds', 'Time completions spent queued for admission')
+ADMISSION_REJECTED = Counter('webchat_admission_rejected_total', 'Completions rejected by admission control',
+                             ('reason',))
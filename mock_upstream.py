@@ -0,0 +1,141 @@
+"""本地模拟的 OpenAI 兼容上游服务（用于压测与故障注入，不调用真实 API）"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MockUpstreamHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send_chunk(self, text):
+        data = text.encode('utf-8')
+        self.wfile.write(b'%x\r\n' % len(data) + data + b'\r\n')
+        self.wfile.flush()
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _usage(self, messages, completion_tokens):
+        """模拟上游前缀缓存：与之前请求相同的最长消息前缀计为缓存命中（按 64 token 对齐）"""
+        digest = hashlib.sha256()
+        prompt_tokens = 0
+        cache_hit = 0
+        prefixes = []
+        for msg in messages:
+            digest.update(json.dumps(msg, sort_keys=True, ensure_ascii=False).encode('utf-8'))
+            prompt_tokens += len(json.dumps(msg, ensure_ascii=False)) // 4
+            key = digest.hexdigest()
+            prefixes.append(key)
+            if key in self.server.prefix_cache:
+                cache_hit = prompt_tokens
+        with self.server.prefix_lock:
+            self.server.prefix_cache.update(prefixes)
+        cache_hit = cache_hit // 64 * 64
+        return {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'total_tokens': prompt_tokens + completion_tokens,
+            'prompt_cache_hit_tokens': cache_hit,
+            'prompt_cache_miss_tokens': prompt_tokens - cache_hit,
+        }
+
+    def do_POST(self):
+        opts = self.server.options
+        length = int(self.headers.get('Content-Length', 0))
+        request_data = json.loads(self.rfile.read(length) or b'{}')
+
+        # 故障注入：按比例返回 500
+        if opts['error_rate'] and random.random() < opts['error_rate']:
+            self._send_json(500, {'error': {'message': 'mock upstream error', 'type': 'server_error'}})
+            return
+
+        model = request_data.get('model', 'mock')
+        words = [f"tok{i} " for i in range(opts['chunks'])]
+        time.sleep(opts['first_token_delay'])
+
+        usage = self._usage(request_data.get('messages', []), len(words))
+        if not request_data.get('stream'):
+            self._send_json(200, {
+                'id': 'mock', 'object': 'chat.completion', 'created': int(time.time()), 'model': model,
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ''.join(words)},
+                             'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        try:
+            for i, word in enumerate(words):
+                if i:
+                    time.sleep(opts['chunk_delay'])
+                chunk = {
+                    'id': 'mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                    'choices': [{'index': 0, 'delta': {'content': word}, 'finish_reason': None}],
+                }
+                self._send_chunk(f"data: {json.dumps(chunk)}\n\n")
+            if (request_data.get('stream_options') or {}).get('include_usage'):
+                chunk = {'id': 'mock', 'object': 'chat.completion.chunk', 'created': int(time.time()), 'model': model,
+                         'choices': [], 'usage': usage}
+                self._send_chunk(f"data: {json.dumps(chunk)}\n\n")
+            self._send_chunk("data: [DONE]\n\n")
+            self.wfile.write(b'0\r\n\r\n')
+            self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            # 客户端提前断开
+            pass
+
+
+class MockUpstreamServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # 压测时会有大量并发连接
+    request_queue_size = 4096
+
+
+def start_mock_server(host='127.0.0.1', port=0, chunks=50, first_token_delay=0.2, chunk_delay=0.02, error_rate=0.0):
+    """在后台线程启动模拟服务，返回 (server, base_url)"""
+    server = MockUpstreamServer((host, port), MockUpstreamHandler)
+    server.prefix_cache = set()
+    server.prefix_lock = threading.Lock()
+    server.options = {
+        'chunks': chunks,
+        'first_token_delay': first_token_delay,
+        'chunk_delay': chunk_delay,
+        'error_rate': error_rate,
+    }
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, f"http://{host}:{server.server_address[1]}/v1"
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='模拟 OpenAI 兼容上游服务')
+    parser.add_argument('--host', type=str, default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=18080)
+    parser.add_argument('--chunks', type=int, default=50, help='每个回复的流式块数')
+    parser.add_argument('--first-token-delay', type=float, default=0.2, help='首个 token 延迟（秒）')
+    parser.add_argument('--chunk-delay', type=float, default=0.02, help='块间延迟（秒）')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='返回 500 错误的比例')
+    args = parser.parse_args()
+
+    server, base_url = start_mock_server(args.host, args.port, args.chunks, args.first_token_delay,
+                                         args.chunk_delay, args.error_rate)
+    print(f"模拟上游已启动: {base_url}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
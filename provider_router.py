@@ -0,0 +1,397 @@
+"""多上游路由：按滚动首 token 延迟与错误率选择最快的健康上游，首 token 前失败自动重试/切换
+
+上游列表由 DEEPSEEK_PROVIDERS（JSON 数组）配置，例如:
+    [{"name": "deepseek", "base_url": "https://api.deepseek.com/", "api_key_env": "DEEPSEEK_API_KEY", "model": "deepseek-chat"},
+     {"name": "tencent", "base_url": "https://api.lkeap.cloud.tencent.com/v1", "api_key_env": "TENCENT_API_KEY", "model": "deepseek-v3"}]
+未配置时只有一个由 DEEPSEEK_BASE_URL / DEEPSEEK_API_KEY / DEEPSEEK_MODEL 组成的上游。
+
+每个上游有一个熔断器：连续失败或错误率过高时断开，冷却期内不再发送请求，之后放行一个探测请求，
+成功则恢复。所有上游都断开时直接抛出 UpstreamUnavailable，不再占用线程等待。
+"""
+import json
+import os
+import queue
+import random
+import threading
+import time
+from collections import deque
+
+from metrics import UPSTREAM_BREAKER_OPEN, UPSTREAM_REQUESTS, UPSTREAM_TTFT
+
+ROUTER_WINDOW = int(os.getenv('DEEPSEEK_ROUTER_WINDOW', '50'))  # 每个上游保留的最近请求数
+ROUTER_MAX_ERROR_RATE = float(os.getenv('DEEPSEEK_ROUTER_MAX_ERROR_RATE', '0.5'))  # 超过该错误率时熔断
+ROUTER_MIN_SAMPLES = 4  # 样本数不足时不按错误率熔断
+ROUTER_COOLDOWN_SECONDS = float(os.getenv('DEEPSEEK_ROUTER_COOLDOWN_SECONDS', '30'))  # 熔断后的冷却时间
+BREAKER_FAILURES = int(os.getenv('DEEPSEEK_BREAKER_FAILURES', '5'))  # 连续失败多少次熔断
+# 对冲请求：首 token 超过该上游 p95 延迟仍未到达时，向下一个上游再发一次，取先返回者
+HEDGE_ENABLED = os.getenv('DEEPSEEK_HEDGE', '0') == '1'
+HEDGE_MIN_DELAY = float(os.getenv('DEEPSEEK_HEDGE_MIN_DELAY', '0.5'))  # 对冲等待的下限（秒）
+FIRST_TOKEN_TIMEOUT = float(os.getenv('DEEPSEEK_FIRST_TOKEN_TIMEOUT', '60'))  # 等待首个块的超时（秒，0 不限）
+MAX_RETRIES = int(os.getenv('DEEPSEEK_MAX_RETRIES', '2'))  # 首个块到达前失败的额外尝试次数（含切换上游）
+RETRY_BACKOFF = float(os.getenv('DEEPSEEK_RETRY_BACKOFF', '0.5'))  # 退避基数（秒），按 2 的幂增长并加随机抖动
+RETRY_MAX_BACKOFF = 8.0
+
+
+class UpstreamUnavailable(Exception):
+    """所有上游都处于熔断状态"""
+
+
+class FirstTokenTimeout(TimeoutError):
+    """超时仍未收到首个块"""
+
+
+class StreamCancelled(Exception):
+    """请求被调用方取消（reason: client / disconnect / superseded 等）"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class CancelToken:
+    """协作式取消：cancel() 可在其他线程调用，设置取消标志并执行已登记的回调（如关闭上游连接）"""
+
+    def __init__(self):
+        self.reason = None
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    @property
+    def cancelled(self):
+        return self.reason is not None
+
+    def on_cancel(self, callback):
+        """登记取消时执行的回调；已取消时立即执行"""
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def cancel(self, reason='client'):
+        """取消（只有第一次生效），返回是否由本次调用取消"""
+        with self._lock:
+            if self.reason is not None:
+                return False
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        self._event.set()
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception:
+                pass
+        return True
+
+    def check(self):
+        """已取消时抛出 StreamCancelled"""
+        if self.reason is not None:
+            raise StreamCancelled(self.reason)
+
+    def wait(self, timeout):
+        """等待最多 timeout 秒，期间被取消则提前返回 True"""
+        return self._event.wait(timeout)
+
+
+def _percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+class Provider:
+    """一个 OpenAI 兼容上游及其滚动统计与熔断状态（closed / open / half_open）"""
+
+    def __init__(self, name, base_url, api_key, model, window=ROUTER_WINDOW):
+        self.name = name
+        self.base_url = base_url
+        self.api_key = api_key
+        self.model = model
+        self.client = None  # 由 ProviderRouter 按需创建
+        self._lock = threading.Lock()
+        self._ttft = deque(maxlen=window)      # 最近成功请求的首 token 延迟（秒）
+        self._outcomes = deque(maxlen=window)  # 最近请求是否成功
+        self.consecutive_failures = 0
+        self.state = 'closed'
+        self.open_until = 0.0
+        self._probing = False  # half_open 状态下是否已放行探测请求
+
+    def allow_request(self):
+        """熔断器是否放行一个请求（half_open 时只放行一个探测请求，此时返回 'probe'）"""
+        with self._lock:
+            if self.state == 'closed':
+                return True
+            if self.state == 'open' and time.monotonic() >= self.open_until:
+                self.state = 'half_open'
+                self._probing = False
+            if self.state == 'half_open' and not self._probing:
+                self._probing = True
+                return 'probe'
+            return False
+
+    def release_probe(self):
+        """探测请求被放弃（取消或对冲落败）：不计成功也不计失败，允许下一个请求重新探测"""
+        with self._lock:
+            if self.state == 'half_open':
+                self._probing = False
+
+    def record_success(self, ttft=None):
+        """请求成功（ttft 为 None 表示上游有响应但不计入延迟，如请求本身不合法）"""
+        with self._lock:
+            if ttft is not None:
+                self._ttft.append(ttft)
+            self._outcomes.append(True)
+            self.consecutive_failures = 0
+            if self.state != 'closed':
+                self.state = 'closed'
+                UPSTREAM_BREAKER_OPEN.dec(provider=self.name)
+        if ttft is not None:
+            UPSTREAM_TTFT.observe(ttft, provider=self.name)
+            UPSTREAM_REQUESTS.inc(provider=self.name, result='ok')
+
+    def record_failure(self, result='error'):
+        with self._lock:
+            self._outcomes.append(False)
+            self.consecutive_failures += 1
+            if (self.state == 'half_open' or self.consecutive_failures >= BREAKER_FAILURES
+                    or (self._error_rate_locked() > ROUTER_MAX_ERROR_RATE
+                        and len(self._outcomes) >= ROUTER_MIN_SAMPLES)):
+                self._trip_locked()
+        UPSTREAM_REQUESTS.inc(provider=self.name, result=result)
+
+    def _trip_locked(self):
+        if self.state == 'closed':
+            UPSTREAM_BREAKER_OPEN.inc(provider=self.name)
+        self.state = 'open'
+        self.open_until = time.monotonic() + ROUTER_COOLDOWN_SECONDS
+        self._probing = False
+        # 恢复后重新评估，避免旧的失败记录让上游立即再次熔断
+        self._outcomes.clear()
+        self.consecutive_failures = 0
+
+    def _error_rate_locked(self):
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def healthy(self):
+        return self.state == 'closed' or (self.state == 'open' and time.monotonic() >= self.open_until)
+
+    def latency(self):
+        """用于排序的延迟估计（最近首 token 延迟的中位数）；没有样本时为 0，优先尝试以便探测"""
+        with self._lock:
+            return _percentile(self._ttft, 50) if self._ttft else 0.0
+
+    def hedge_delay(self):
+        """对冲等待时间：最近首 token 延迟的 p95"""
+        with self._lock:
+            p95 = _percentile(self._ttft, 95) if len(self._ttft) >= ROUTER_MIN_SAMPLES else 0.0
+        return max(p95, HEDGE_MIN_DELAY)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'model': self.model,
+                'requests': len(self._outcomes),
+                'error_rate': self._error_rate_locked(),
+                'ttft_p50': _percentile(self._ttft, 50) if self._ttft else None,
+                'ttft_p95': _percentile(self._ttft, 95) if self._ttft else None,
+                'state': self.state,
+            }
+
+
+def load_providers(default_base_url, default_api_key, default_model):
+    """从 DEEPSEEK_PROVIDERS 读取上游列表，未配置时返回默认的单个上游"""
+    raw = os.getenv('DEEPSEEK_PROVIDERS')
+    if not raw:
+        return [Provider('default', default_base_url, default_api_key, default_model)]
+    providers = []
+    for index, item in enumerate(json.loads(raw)):
+        api_key = item.get('api_key') or os.getenv(item.get('api_key_env', ''), '') or default_api_key
+        providers.append(Provider(item.get('name') or f"provider{index}", item.get('base_url', default_base_url),
+                                  api_key, item.get('model', default_model)))
+    return providers
+
+
+class _Attempt:
+    """一次在后台线程中发起请求并读取首个块的尝试；被放弃后返回的流会直接关闭
+
+    调用方只在队列上等待，首个块超时后即可返回，不必等阻塞的读取结束（读取本身受块间超时约束）。
+    """
+
+    def __init__(self, provider, open_stream, results, first_token_timeout, probe=False):
+        self.provider = provider
+        self.probe = probe  # 是否为熔断器 half_open 状态下放行的探测请求
+        self.started = time.monotonic()
+        self.deadline = self.started + first_token_timeout if first_token_timeout else float('inf')
+        self.stream = None
+        self.abandoned = False
+        self._lock = threading.Lock()
+        threading.Thread(target=self._run, args=(open_stream, results), daemon=True).start()
+
+    def _run(self, open_stream, results):
+        try:
+            stream = open_stream(self.provider)
+            try:
+                iterator = iter(stream)
+                first = next(iterator, None)
+            except BaseException:
+                stream.close()
+                raise
+        except Exception as e:
+            results.put((self, time.monotonic() - self.started, None, e))
+            return
+        with self._lock:
+            if self.abandoned:
+                stream.close()
+                return
+            self.stream = stream
+        results.put((self, time.monotonic() - self.started, _prepend(first, iterator), None))
+
+    def abandon(self):
+        """放弃该尝试：已返回的流立即关闭，仍在进行的在返回时关闭；探测请求同时释放探测名额"""
+        with self._lock:
+            if self.abandoned:
+                return
+            self.abandoned = True
+            stream, self.stream = self.stream, None
+        if self.probe:
+            self.provider.release_probe()
+        if stream is not None:
+            stream.close()
+
+
+class ProviderRouter:
+    """选择上游并打开流：只在收到第一个块之前重试或切换上游，之后的错误交给调用方
+
+    open_stream(provider) 由调用方提供，发起请求并返回块迭代器（带 close() 方法）。
+    should_failover(exc) 返回 False 的错误（如请求本身不合法）直接抛出，不重试也不计入错误率。
+    """
+
+    def __init__(self, providers, client_factory, hedge=HEDGE_ENABLED, should_failover=None,
+                 max_retries=MAX_RETRIES, first_token_timeout=FIRST_TOKEN_TIMEOUT):
+        self.providers = providers
+        self.client_factory = client_factory
+        self.hedge = hedge
+        self.should_failover = should_failover or (lambda exc: True)
+        self.max_retries = max_retries
+        self.first_token_timeout = first_token_timeout
+        self._client_lock = threading.Lock()
+
+    def client(self, provider):
+        if provider.client is None:
+            with self._client_lock:
+                if provider.client is None:
+                    provider.client = self.client_factory(provider)
+        return provider.client
+
+    def close(self):
+        with self._client_lock:
+            for provider in self.providers:
+                if provider.client is not None:
+                    provider.client.close()
+                    provider.client = None
+
+    def candidates(self):
+        """按健康状态与延迟排序的上游列表"""
+        return sorted(self.providers, key=lambda p: (not p.healthy(), p.latency()))
+
+    def _pick(self, tried):
+        """选出下一个熔断器放行的上游：优先本次请求尚未尝试过的，其次按延迟；返回 (上游, 是否为探测请求)"""
+        for provider in sorted(self.candidates(), key=lambda p: p in tried):
+            allowed = provider.allow_request()
+            if allowed:
+                return provider, allowed == 'probe'
+        return None, False
+
+    def open(self, open_stream, cancel=None):
+        """返回 (provider, stream, 块迭代器)；迭代器从第一个块开始（已读出的块会重新放回）
+
+        首个块到达前失败或超时时按退避重试（多个上游时依次切换）；开启对冲时，
+        当前请求超过 p95 仍无首块会并行追加一次尝试，取最先返回者，其余关闭。
+        传入 cancel（CancelToken）时，取消后立即放弃所有尝试并抛出 StreamCancelled。
+        """
+        results = queue.Queue()
+        if cancel is not None:
+            cancel.check()
+            # 唤醒下面的等待
+            cancel.on_cancel(lambda: results.put((None, 0.0, None, None)))
+        in_flight = []
+        tried = set()
+        launches = 0
+        last_error = None
+        hedge_at = float('inf')
+        launch_next = True
+        try:
+            while True:
+                if launch_next and launches <= self.max_retries:
+                    launch_next = False
+                    if launches and not in_flight and len(tried) >= len(self.providers):
+                        # 所有上游都已失败过，退避后再试（随机抖动，避免大量请求同时重试）
+                        delay = random.uniform(0, min(RETRY_MAX_BACKOFF, RETRY_BACKOFF * 2 ** (launches - 1)))
+                        if cancel is not None:
+                            cancel.wait(delay)
+                            cancel.check()
+                        else:
+                            time.sleep(delay)
+                    provider, probe = self._pick(tried)
+                    if provider is not None:
+                        if launches:
+                            UPSTREAM_REQUESTS.inc(provider=provider.name, result='hedge' if in_flight else 'retry')
+                        in_flight.append(_Attempt(provider, open_stream, results, self.first_token_timeout, probe))
+                        tried.add(provider)
+                        launches += 1
+                        hedge_at = time.monotonic() + provider.hedge_delay() if self.hedge else float('inf')
+                if not in_flight:
+                    if last_error is None:
+                        for provider in self.providers:
+                            UPSTREAM_REQUESTS.inc(provider=provider.name, result='rejected')
+                        raise UpstreamUnavailable('all upstream providers are unavailable (circuit open)')
+                    raise last_error
+
+                wake_at = min([attempt.deadline for attempt in in_flight]
+                              + ([hedge_at] if launches <= self.max_retries else []))
+                try:
+                    attempt, elapsed, iterator, error = results.get(
+                        timeout=None if wake_at == float('inf') else max(0.0, wake_at - time.monotonic()))
+                except queue.Empty:
+                    now = time.monotonic()
+                    for attempt in [a for a in in_flight if a.deadline <= now]:
+                        # 首个块超时：计为失败（探测请求会重新熔断）并放弃该尝试
+                        in_flight.remove(attempt)
+                        attempt.provider.record_failure('timeout')
+                        attempt.abandon()
+                        last_error = FirstTokenTimeout(
+                            f"no response from {attempt.provider.name} within {self.first_token_timeout:g}s")
+                    if now >= hedge_at or not in_flight:
+                        launch_next = True
+                    continue
+
+                if attempt is None:
+                    cancel.check()
+                if attempt.abandoned:
+                    continue
+                in_flight.remove(attempt)
+                if error is None:
+                    attempt.provider.record_success(elapsed)
+                    return attempt.provider, attempt.stream, iterator
+                if not self.should_failover(error):
+                    attempt.provider.record_success()
+                    raise error
+                attempt.provider.record_failure()
+                last_error = error
+                launch_next = True
+        finally:
+            # 返回或抛出时仍在进行的尝试全部放弃
+            for attempt in in_flight:
+                attempt.abandon()
+
+    def stats(self):
+        return [provider.snapshot() for provider in self.providers]
+
+
+def _prepend(first, iterator):
+    if first is not None:
+        yield first
+    yield from iterator
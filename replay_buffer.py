@@ -0,0 +1,181 @@
+"""可续传的流式回复：每条回复保存已发送内容的环形缓冲，客户端重连后按偏移补发缺失的尾部
+
+偏移按字符（Python str 下标）计算。回复结束后缓冲保留 RESUME_TTL_SECONDS 秒供断线的客户端续传，
+所有缓冲的总内存受 RESUME_MEMORY_MB 限制，超出时先淘汰已结束的、再淘汰最早的缓冲。
+"""
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+RESUME_BUFFER_BYTES = int(os.getenv('WEBCHAT_RESUME_BUFFER_KB', '256')) * 1024  # 每条回复保留的最近内容
+RESUME_MEMORY_BUDGET = int(os.getenv('WEBCHAT_RESUME_MEMORY_MB', '32')) * 1024 * 1024
+RESUME_TTL_SECONDS = float(os.getenv('WEBCHAT_RESUME_TTL_SECONDS', '120'))  # 回复结束后保留多久
+EXPIRE_CHECK_SECONDS = 5
+
+
+class ReplayBuffer:
+    """一条回复的发送记录：最近内容的环形缓冲 + 结束事件，以及当前接收事件的客户端 sid
+
+    send/resume 都在同一把锁内完成“记录 + 发送”，续传与实时推送之间不会丢失或重复内容。
+    """
+
+    def __init__(self, store, message_id, session_id, sid, max_bytes=RESUME_BUFFER_BYTES):
+        self.store = store
+        self.message_id = message_id
+        self.session_id = session_id
+        self.sid = sid  # 客户端断开后为 None，续传时换成新连接的 sid
+        self.emit = store.emit  # emit(payload, sid)
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.chunks = deque()  # (起始偏移, 文本, 字节数)
+        self.start = 0  # 缓冲中最早内容的偏移，之前的已被丢弃
+        self.end = 0  # 已发送内容的总字符数
+        self.size_bytes = 0
+        self.final_events = []  # error / end / full 等结束事件，续传时按顺序重发
+        self.finished_at = None
+        self.evicted = False
+
+    def send_stream(self, content, n_bytes):
+        """记录并发送一段流式内容"""
+        with self.lock:
+            offset = self.end
+            self.end += len(content)
+            before = self.size_bytes
+            if not self.evicted:
+                self.chunks.append((offset, content, n_bytes))
+                self.size_bytes += n_bytes
+                while self.size_bytes > self.max_bytes and len(self.chunks) > 1:
+                    _, _, dropped = self.chunks.popleft()
+                    self.size_bytes -= dropped
+                if self.chunks:
+                    self.start = self.chunks[0][0]
+            if self.sid is not None:
+                self.emit(self._stream_payload(content, offset), self.sid)
+            delta = self.size_bytes - before
+        self.store.account(self, delta)
+
+    def send_final(self, payload):
+        """记录并发送结束类事件（error / end / full）"""
+        payload = dict(payload, message_id=self.message_id)
+        n_bytes = len((payload.get('content') or '').encode('utf-8'))
+        with self.lock:
+            if self.evicted:
+                n_bytes = 0
+            else:
+                self.final_events.append(payload)
+                self.size_bytes += n_bytes
+            if self.sid is not None:
+                self.emit(payload, self.sid)
+        self.store.account(self, n_bytes)
+
+    def _stream_payload(self, content, offset):
+        return {'type': 'stream', 'content': content, 'session_id': self.session_id,
+                'message_id': self.message_id, 'offset': offset}
+
+    def resume(self, offset, sid):
+        """把 offset 之后的内容（及已有的结束事件）发给新连接，之后的实时内容也发给它
+
+        offset 早于缓冲起点（已被丢弃或整条被淘汰）时返回 False
+        """
+        with self.lock:
+            if self.evicted or offset < self.start or offset > self.end:
+                return False
+            parts = []
+            for chunk_offset, content, _ in self.chunks:
+                if chunk_offset + len(content) > offset:
+                    parts.append(content[max(0, offset - chunk_offset):])
+            if parts:
+                self.emit(self._stream_payload(''.join(parts), offset), sid)
+            for payload in self.final_events:
+                self.emit(payload, sid)
+            self.sid = sid
+            return True
+
+    def detach(self, sid):
+        """客户端断开：之后的内容只记录不发送"""
+        with self.lock:
+            if self.sid == sid:
+                self.sid = None
+
+    def evict(self):
+        """释放缓冲内容，返回释放的字节数"""
+        with self.lock:
+            released = self.size_bytes
+            self.evicted = True
+            self.chunks.clear()
+            self.final_events = []
+            self.size_bytes = 0
+            return released
+
+
+class ReplayStore:
+    """message_id -> ReplayBuffer，按创建顺序保存，结束后按 TTL 过期并受总内存预算限制"""
+
+    def __init__(self, emit, memory_budget=RESUME_MEMORY_BUDGET, ttl=RESUME_TTL_SECONDS):
+        self.emit = emit
+        self.memory_budget = memory_budget
+        self.ttl = ttl
+        self._buffers = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self._last_expire_check = time.monotonic()
+
+    def create(self, message_id, session_id, sid):
+        buffer = ReplayBuffer(self, message_id, session_id, sid)
+        with self._lock:
+            self._buffers[message_id] = buffer
+            self._expire_locked()
+        return buffer
+
+    def get(self, message_id):
+        with self._lock:
+            self._expire_locked()
+            return self._buffers.get(message_id)
+
+    def account(self, buffer, delta):
+        """缓冲内容变化后调用，超出预算时淘汰"""
+        if not delta:
+            return
+        with self._lock:
+            if buffer.evicted:
+                # 变化之后已被淘汰，淘汰时已按实际大小扣除
+                return
+            self.total_bytes += delta
+            if self.total_bytes > self.memory_budget:
+                self._evict_over_budget_locked()
+
+    def finish(self, buffer):
+        """回复结束，开始计算 TTL"""
+        buffer.finished_at = time.monotonic()
+
+    def discard(self, buffer):
+        with self._lock:
+            if self._buffers.pop(buffer.message_id, None) is not None:
+                self.total_bytes -= buffer.evict()
+
+    def _expire_locked(self):
+        now = time.monotonic()
+        if now - self._last_expire_check < EXPIRE_CHECK_SECONDS:
+            return
+        self._last_expire_check = now
+        expired = [message_id for message_id, buffer in self._buffers.items()
+                   if buffer.finished_at is not None and now - buffer.finished_at > self.ttl]
+        for message_id in expired:
+            self.total_bytes -= self._buffers.pop(message_id).evict()
+
+    def _evict_over_budget_locked(self):
+        # 先淘汰已结束的，再淘汰最早的进行中回复（其后续内容只发送不记录）
+        for finished_only in (True, False):
+            for message_id, buffer in list(self._buffers.items()):
+                if self.total_bytes <= self.memory_budget:
+                    return
+                if finished_only and buffer.finished_at is None:
+                    continue
+                self.total_bytes -= buffer.evict()
+                if buffer.finished_at is not None:
+                    del self._buffers[message_id]
+
+    def stats(self):
+        with self._lock:
+            return {'buffers': len(self._buffers), 'bytes': self.total_bytes}
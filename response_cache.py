@@ -0,0 +1,170 @@
+"""回复缓存：相同模型 + 相同（规范化后）上下文直接复用上次的完整回复
+
+内存层为 LRU + TTL，可选 SQLite 磁盘层（进程重启后仍可命中）。默认关闭。
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metrics import CACHE_REQUESTS
+
+CACHE_ENABLED = os.getenv('WEBCHAT_RESPONSE_CACHE', '0') == '1'
+CACHE_TTL_SECONDS = int(os.getenv('WEBCHAT_CACHE_TTL_SECONDS', '3600'))
+CACHE_MAX_ENTRIES = int(os.getenv('WEBCHAT_CACHE_MAX_ENTRIES', '1000'))
+CACHE_MEMORY_BUDGET = int(os.getenv('WEBCHAT_CACHE_MEMORY_MB', '32')) * 1024 * 1024
+CACHE_SQLITE_PATH = os.getenv('WEBCHAT_CACHE_SQLITE')  # 为空则只使用内存层
+CACHE_DISK_BUDGET = int(os.getenv('WEBCHAT_CACHE_DISK_MB', '256')) * 1024 * 1024
+
+
+def normalize_messages(messages):
+    """只保留角色与内容，统一换行并去除首尾空白，避免无关差异导致未命中"""
+    return [
+        {'role': str(m.get('role', '')).strip().lower(),
+         'content': (m.get('content') or '').replace('\r\n', '\n').strip()}
+        for m in messages
+    ]
+
+
+def cache_key(model, messages):
+    payload = json.dumps([model, normalize_messages(messages)], ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class SqliteCacheTier:
+    """磁盘层：按最近访问时间淘汰，总大小不超过预算"""
+
+    def __init__(self, path, ttl=CACHE_TTL_SECONDS, disk_budget=CACHE_DISK_BUDGET):
+        cache_dir = os.path.dirname(path)
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+        self.ttl = ttl
+        self.disk_budget = disk_budget
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS responses ('
+                           'key TEXT PRIMARY KEY, response TEXT NOT NULL, size INTEGER NOT NULL, '
+                           'created REAL NOT NULL, accessed REAL NOT NULL)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)')
+        self.total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._conn.execute('SELECT response, size, created FROM responses WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            response, size, created = row
+            if now - created > self.ttl:
+                self._conn.execute('DELETE FROM responses WHERE key = ?', (key,))
+                self.total_bytes -= size
+                return None
+            self._conn.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            return response
+
+    def put(self, key, response):
+        now = time.time()
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            old = self._conn.execute('SELECT size FROM responses WHERE key = ?', (key,)).fetchone()
+            self._conn.execute('INSERT OR REPLACE INTO responses (key, response, size, created, accessed) '
+                               'VALUES (?, ?, ?, ?, ?)', (key, response, size, now, now))
+            self.total_bytes += size - (old[0] if old else 0)
+            if self.total_bytes > self.disk_budget:
+                self._evict_locked()
+
+    def _evict_locked(self):
+        """先清理过期项，再按最近访问时间淘汰到预算的 90%"""
+        self._conn.execute('DELETE FROM responses WHERE created < ?', (time.time() - self.ttl,))
+        target = self.disk_budget * 0.9
+        total = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        if total > target:
+            cutoff = None
+            for accessed, size in self._conn.execute('SELECT accessed, size FROM responses ORDER BY accessed'):
+                total -= size
+                cutoff = accessed
+                if total <= target:
+                    break
+            self._conn.execute('DELETE FROM responses WHERE accessed <= ?', (cutoff,))
+        self.total_bytes = self._conn.execute('SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ResponseCache:
+    """两级回复缓存：内存 LRU（条数 + 字节上限）+ 可选 SQLite"""
+
+    def __init__(self, ttl=CACHE_TTL_SECONDS, max_entries=CACHE_MAX_ENTRIES, memory_budget=CACHE_MEMORY_BUDGET,
+                 sqlite_path=CACHE_SQLITE_PATH):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.memory_budget = memory_budget
+        self._entries = OrderedDict()  # key -> (response, created, size)
+        self.total_bytes = 0
+        self._lock = threading.Lock()
+        self.disk = SqliteCacheTier(sqlite_path, ttl) if sqlite_path else None
+
+    def get(self, model, messages):
+        """返回缓存的回复，未命中返回 None"""
+        key = cache_key(model, messages)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if now - entry[1] <= self.ttl:
+                    self._entries.move_to_end(key)
+                    CACHE_REQUESTS.inc(result='hit', tier='memory')
+                    return entry[0]
+                self._pop_locked(key)
+
+        if self.disk is not None:
+            response = self.disk.get(key)
+            if response is not None:
+                # 磁盘命中后提升到内存层
+                self._put_memory(key, response, now)
+                CACHE_REQUESTS.inc(result='hit', tier='disk')
+                return response
+        CACHE_REQUESTS.inc(result='miss', tier='')
+        return None
+
+    def put(self, model, messages, response):
+        key = cache_key(model, messages)
+        self._put_memory(key, response, time.time())
+        if self.disk is not None:
+            self.disk.put(key, response)
+
+    def _put_memory(self, key, response, created):
+        size = len(response.encode('utf-8'))
+        if size > self.memory_budget:
+            return
+        with self._lock:
+            self._pop_locked(key)
+            self._entries[key] = (response, created, size)
+            self.total_bytes += size
+            while len(self._entries) > self.max_entries or self.total_bytes > self.memory_budget:
+                self._pop_locked(next(iter(self._entries)))
+
+    def _pop_locked(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry[2]
+
+    def stats(self):
+        hits = sum(v for (result, _), v in CACHE_REQUESTS.values().items() if result == 'hit')
+        misses = sum(v for (result, _), v in CACHE_REQUESTS.values().items() if result == 'miss')
+        with self._lock:
+            entries, total_bytes = len(self._entries), self.total_bytes
+        return {
+            'entries': entries,
+            'bytes': total_bytes,
+            'disk_bytes': self.disk.total_bytes if self.disk else 0,
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+        }
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# 模块都在仓库根目录（平铺结构）
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 测试不使用默认的会话存储文件，需要时各自在 tmp_path 中创建
+os.environ['WEBCHAT_STORE_PATH'] = ''
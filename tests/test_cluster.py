@@ -0,0 +1,57 @@
+import asyncio
+
+from cluster import StickyProxy, add_forwarded_for, cluster_env
+
+
+def test_add_forwarded_for_appends_client_address():
+    head = b'POST /socket.io/?EIO=4 HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\n'
+    new_head, length, raw = add_forwarded_for(head, '203.0.113.7')
+    assert new_head == (b'POST /socket.io/?EIO=4 HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n'
+                        b'X-Forwarded-For: 203.0.113.7\r\n\r\n')
+    assert (length, raw) == (5, False)
+
+
+def test_add_forwarded_for_keeps_existing_chain():
+    head = b'GET / HTTP/1.1\r\nX-Forwarded-For: 10.0.0.1\r\nUpgrade: websocket\r\n\r\n'
+    new_head, length, raw = add_forwarded_for(head, '203.0.113.7')
+    assert new_head.endswith(b'X-Forwarded-For: 10.0.0.1, 203.0.113.7\r\n\r\n')
+    assert new_head.count(b'X-Forwarded-For') == 1
+    assert (length, raw) == (0, True)
+
+
+def test_cluster_env_trusts_proxy_header():
+    assert cluster_env('/tmp/mq.sock', '/tmp/sessions')['WEBCHAT_TRUST_PROXY'] == '1'
+
+
+def test_proxy_tags_every_keep_alive_request_then_relays_raw_bytes():
+    received = bytearray()
+
+    async def backend(reader, writer):
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+            received.extend(data)
+        writer.close()
+
+    async def run():
+        server = await asyncio.start_server(backend, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        proxy = await asyncio.start_server(StickyProxy([('127.0.0.1', port)]).handle, '127.0.0.1', 0)
+        reader, writer = await asyncio.open_connection('127.0.0.1', proxy.sockets[0].getsockname()[1])
+        writer.write(b'POST /a HTTP/1.1\r\nContent-Length: 4\r\n\r\nbody'
+                     b'GET /b HTTP/1.1\r\nUpgrade: websocket\r\n\r\n'
+                     b'GET /not-a-request HTTP/1.1\r\n\r\n')
+        await writer.drain()
+        writer.close()
+        for _ in range(100):
+            if received.endswith(b'\r\n\r\n') and b'not-a-request' in received:
+                break
+            await asyncio.sleep(0.01)
+        proxy.close()
+        server.close()
+
+    asyncio.run(run())
+    assert bytes(received) == (b'POST /a HTTP/1.1\r\nContent-Length: 4\r\nX-Forwarded-For: 127.0.0.1\r\n\r\nbody'
+                               b'GET /b HTTP/1.1\r\nUpgrade: websocket\r\nX-Forwarded-For: 127.0.0.1\r\n\r\n'
+                               b'GET /not-a-request HTTP/1.1\r\n\r\n')
@@ -0,0 +1,85 @@
+import contextlib
+
+import pytest
+
+import app
+from admission import AdmissionRejected
+
+LONG_CONTEXT = [{'role': 'user' if index % 2 == 0 else 'assistant', 'content': f"message {index} " + 'x' * 400}
+                for index in range(40)] + [{'role': 'user', 'content': 'latest question'}]
+
+
+class FakeAdmission:
+    def __init__(self, reject=False):
+        self.reject = reject
+        self.admitted = 0
+
+    @contextlib.contextmanager
+    def admit(self, session_id, client_ip=None, on_queued=None, weight=1, cancel=None):
+        if self.reject:
+            raise AdmissionRejected('rate_limited', retry_after=2)
+        self.admitted += 1
+        yield
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    """启用上下文摘要的 Web 会话，上游替换为记录请求的假实现"""
+    monkeypatch.setattr(app, 'CONTEXT_SUMMARY', True)
+    monkeypatch.setattr(app, 'CONTEXT_MAX_TOKENS', 2000)
+    monkeypatch.setattr(app, 'session_store', app.SessionStore(shared=False))
+    calls = []
+
+    def fake_deepseek1(messages, tools=None, on_usage=None, cancel=None):
+        calls.append({'messages': messages, 'cancel': cancel})
+        summary = messages[0]['content'].startswith('将以下对话压缩为简洁的摘要')
+        if summary and chat.cancel_summary:
+            cancel.cancel('client')
+        cancel.check()
+        yield 'summary text' if summary else 'answer'
+
+    monkeypatch.setattr(app, 'deepseek1', fake_deepseek1)
+    chat.calls = calls
+    chat.cancel_summary = False
+    return chat
+
+
+def send(session_id):
+    client = app.socketio.test_client(app.app)
+    try:
+        client.emit('message', {'content': 'latest question', 'context': LONG_CONTEXT, 'session_id': session_id})
+        return [packet['args'][0] if isinstance(packet['args'], list) else packet['args']
+                for packet in client.get_received()]
+    finally:
+        client.disconnect()
+
+
+def test_summary_shares_the_admission_slot_and_cancel_token(chat, monkeypatch):
+    admission = FakeAdmission()
+    monkeypatch.setattr(app, 'admission', admission)
+    events = send('summary-ok')
+    assert [event['type'] for event in events if event['type'] in ('error', 'full')] == ['full']
+    assert len(chat.calls) == 2
+    assert chat.calls[0]['cancel'] is chat.calls[1]['cancel'] is not None
+    assert admission.admitted == 1
+    history = app.session_store.get('summary-ok')
+    assert history.summary == 'summary text'
+
+
+def test_rejected_summary_does_not_call_upstream(chat, monkeypatch):
+    monkeypatch.setattr(app, 'admission', FakeAdmission(reject=True))
+    events = send('summary-rejected')
+    assert [event.get('reason') for event in events if event['type'] == 'error'] == ['rate_limited']
+    assert chat.calls == []
+    history = app.session_store.get('summary-rejected')
+    assert history.summary is None
+    assert history.messages[-1]['role'] == 'assistant'
+
+
+def test_cancel_during_summary_skips_the_reply(chat, monkeypatch):
+    monkeypatch.setattr(app, 'admission', FakeAdmission())
+    chat.cancel_summary = True
+    events = send('summary-cancelled')
+    assert len(chat.calls) == 1
+    assert [event['type'] for event in events if event['type'] == 'error'] == []
+    assert app.session_store.get('summary-cancelled').summary is None
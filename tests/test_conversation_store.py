@@ -0,0 +1,80 @@
+import io
+import json
+import os
+import sqlite3
+import subprocess
+import sys
+
+from conversation_store import ConversationStore
+
+
+def test_new_database_uses_incremental_auto_vacuum(tmp_path):
+    store = ConversationStore(str(tmp_path / 'webchat.db'))
+    assert store._conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    assert store._conn.execute('PRAGMA journal_mode').fetchone()[0] == 'wal'
+
+
+def test_existing_database_is_switched_to_incremental_auto_vacuum(tmp_path):
+    path = str(tmp_path / 'webchat.db')
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE t (x)')
+    conn.close()
+    store = ConversationStore(path)
+    assert store._conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+
+def test_compact_reclaims_pages_of_deleted_sessions(tmp_path):
+    store = ConversationStore(str(tmp_path / 'webchat.db'))
+    for index in range(200):
+        store.append(f"s{index}", 0, {'role': 'user', 'content': 'x' * 2000})
+    store.compact(0)
+    before = store._conn.execute('PRAGMA page_count').fetchone()[0]
+    store._conn.execute('UPDATE sessions SET updated = 0')
+    assert store.compact(1) == 200
+    assert store._conn.execute('PRAGMA page_count').fetchone()[0] < before / 4
+    assert store.stats() == {'sessions': 0, 'messages': 0}
+
+
+def test_append_load_and_export(tmp_path):
+    store = ConversationStore(str(tmp_path / 'webchat.db'))
+    store.replace('s1', [{'role': 'user', 'content': '你好'}], {'window_start': 0})
+    version = store.append('s1', 1, {'role': 'assistant', 'content': '', 'tool_calls': [{'id': 'c1'}]})
+    messages, meta, loaded_version, _ = store.load('s1')
+    assert messages[1] == {'role': 'assistant', 'content': '', 'tool_calls': [{'id': 'c1'}]}
+    assert meta == {'window_start': 0} and loaded_version == version
+    out = io.StringIO()
+    assert store.export(out) == 2
+    assert [json.loads(line)['seq'] for line in out.getvalue().splitlines()] == [0, 1]
+
+
+def test_truncate_drops_trailing_messages(tmp_path):
+    store = ConversationStore(str(tmp_path / 'webchat.db'))
+    store.append('s1', 0, {'role': 'user', 'content': 'hi'})
+    store.append('s1', 1, {'role': 'assistant', 'content': 'hello'})
+    store.append('s1', 2, {'role': 'user', 'content': 'again'})
+    version = store.truncate('s1', 2)
+    messages, _, loaded_version, _ = store.load('s1')
+    assert [msg['content'] for msg in messages] == ['hi', 'hello']
+    assert loaded_version == version
+    assert store._conn.execute("SELECT message_count FROM sessions WHERE session_id = 's1'").fetchone()[0] == 2
+
+
+def test_store_opened_without_vacuum_leaves_existing_database_alone(tmp_path):
+    path = str(tmp_path / 'webchat.db')
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE t (x)')
+    conn.close()
+    store = ConversationStore(path, vacuum=False)
+    assert store._conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 0
+    store.append('s1', 0, {'role': 'user', 'content': 'hi'})
+    assert store.load('s1')[0] == [{'role': 'user', 'content': 'hi'}]
+
+
+def test_importing_app_does_not_create_the_database(tmp_path):
+    env = {key: value for key, value in os.environ.items() if key != 'WEBCHAT_STORE_PATH'}
+    env['PYTHONPATH'] = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run([sys.executable, '-c', 'import app'], cwd=tmp_path, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    assert not (tmp_path / 'webchat.db').exists()
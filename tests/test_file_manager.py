@@ -0,0 +1,51 @@
+import os
+
+from app import FileManager
+
+
+def test_append_file_replaces_the_file_atomically(tmp_path, monkeypatch):
+    target = tmp_path / 'notes.txt'
+    target.write_text('first\n')
+    os.chmod(target, 0o640)
+    replaced = []
+    real_replace = os.replace
+    monkeypatch.setattr(os, 'replace', lambda src, dst: (replaced.append(dst), real_replace(src, dst)))
+    manager = FileManager(str(tmp_path))
+    assert manager.append_file('notes.txt', 'second\n').startswith('[SUCCESS]')
+    assert target.read_text() == 'first\nsecond\n'
+    assert replaced == [str(target)]
+    assert os.stat(target).st_mode & 0o777 == 0o640
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.tmp')] == []
+
+
+def test_append_file_in_batch_is_committed_with_the_batch(tmp_path):
+    target = tmp_path / 'notes.txt'
+    target.write_text('first\n')
+    manager = FileManager(str(tmp_path))
+    manager.begin_batch()
+    manager.append_file('notes.txt', 'second\n')
+    manager.append_file('notes.txt', 'third\n')
+    assert target.read_text() == 'first\n'
+    assert manager.commit_batch() == {}
+    assert target.read_text() == 'first\nsecond\nthird\n'
+
+
+def test_created_directory_is_not_indexed_as_a_file(tmp_path):
+    (tmp_path / 'notes.txt').write_text('hello\n')
+    manager = FileManager(str(tmp_path))
+    index = manager.get_index()
+    index.refresh(force=True)
+    assert manager.create_dir('reports2026').startswith('[SUCCESS]')
+    index.refresh()
+    assert 'reports2026' not in index._files
+    assert manager.search_files('reports2026').endswith('no matches')
+
+
+def test_dirty_directory_is_skipped_by_fast_refresh(tmp_path):
+    manager = FileManager(str(tmp_path))
+    index = manager.get_index()
+    index.refresh(force=True)
+    (tmp_path / 'sub').mkdir()
+    index.mark_dirty('sub')
+    assert index.refresh() == (0, 0)
+    assert 'sub' not in index._files
@@ -0,0 +1,92 @@
+import threading
+import time
+
+import pytest
+
+import provider_router
+from provider_router import CancelToken, Provider, ProviderRouter, StreamCancelled
+
+
+class GatedStream:
+    """首个块要等 gate 打开才返回的假上游流"""
+
+    def __init__(self, gate, chunks=('hello',)):
+        self.gate = gate
+        self.chunks = chunks
+        self.closed = False
+
+    def __iter__(self):
+        self.gate.wait(5)
+        yield from self.chunks
+
+    def close(self):
+        self.closed = True
+
+
+def half_open_provider(name):
+    provider = Provider(name, 'http://upstream', 'key', 'model')
+    provider.state = 'open'
+    provider.open_until = time.monotonic() - 1  # 冷却期已过，下一个请求即为探测
+    return provider
+
+
+def make_router(providers, **kwargs):
+    kwargs.setdefault('max_retries', 0)
+    kwargs.setdefault('first_token_timeout', 0)
+    return ProviderRouter(providers, client_factory=lambda provider: None, **kwargs)
+
+
+def test_cancelled_probe_releases_half_open_slot():
+    provider = half_open_provider('a')
+    gate = threading.Event()
+    cancel = CancelToken()
+    errors = []
+
+    def run():
+        try:
+            make_router([provider]).open(lambda p: GatedStream(gate), cancel=cancel)
+        except StreamCancelled as e:
+            errors.append(e)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    time.sleep(0.1)
+    assert provider.state == 'half_open' and not provider.allow_request()
+    cancel.cancel('client')
+    thread.join(2)
+    gate.set()
+    assert errors and errors[0].reason == 'client'
+    # 探测名额已释放：下一个请求可以再次探测
+    assert provider.allow_request() == 'probe'
+
+
+def test_hedge_losing_probe_releases_half_open_slot(monkeypatch):
+    monkeypatch.setattr(provider_router, 'HEDGE_MIN_DELAY', 0.05)
+    fast = Provider('fast', 'http://upstream', 'key', 'model')
+    probe = half_open_provider('probe')
+    gates = {'fast': threading.Event(), 'probe': threading.Event()}
+    launched = []
+
+    def open_stream(provider):
+        launched.append(provider.name)
+        if len(launched) == 2:
+            # 对冲请求已发出（落在 half_open 的上游上），让原请求先返回
+            gates['fast'].set()
+        return GatedStream(gates[provider.name])
+
+    router = make_router([fast, probe], hedge=True, max_retries=1)
+    winner, stream, iterator = router.open(open_stream)
+    assert winner is fast and next(iterator) == 'hello'
+    assert launched == ['fast', 'probe']
+    gates['probe'].set()
+    assert probe.state == 'half_open'
+    assert probe.allow_request() == 'probe'
+
+
+def test_timed_out_probe_trips_breaker_again():
+    provider = half_open_provider('a')
+    gate = threading.Event()
+    with pytest.raises(provider_router.FirstTokenTimeout):
+        make_router([provider], first_token_timeout=0.05).open(lambda p: GatedStream(gate))
+    gate.set()
+    assert provider.state == 'open' and not provider.allow_request()
@@ -0,0 +1,28 @@
+import app
+from app import _line_span
+
+
+def test_line_span_stops_scanning_after_max_bytes():
+    data = b'line\n' * 100000
+    assert _line_span(data, len(data), 1, None, 100) == (0, 101)
+    assert _line_span(data, len(data), 1, 10 ** 9, 100) == (0, 101)
+    assert _line_span(data, len(data), 3, 2, 100) == (10, 20)
+    assert _line_span(data, len(data), 99999, None, 100) == (499990, 500000)
+
+
+def test_read_range_without_limit_truncates_at_line_boundary(monkeypatch):
+    monkeypatch.setattr(app, 'READ_MAX_BYTES', 64)
+    data = b''.join(b'%02d\n' % i for i in range(100))
+    content, note = app.FileManager._read_range(data, len(data), 1, None, 'lines', 'utf-8')
+    assert content == ''.join('%02d\n' % i for i in range(21))
+    assert note == 'lines 1-21, truncated, continue with offset=22'
+
+
+def test_read_file_cuts_long_non_ascii_line_without_decode_error(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, 'READ_MAX_BYTES', 1000)
+    line = '中' * 40000
+    (tmp_path / 'f.txt').write_text(f"first\n{line}\nlast\n", encoding='utf-8')
+    result = app.FileManager(str(tmp_path)).read_file('f.txt', offset=2, limit=1)
+    assert not result.startswith('[ERROR]')
+    assert '中' * 333 in result
+    assert 'line 2 truncated, continue with unit=bytes offset=1006' in result
@@ -0,0 +1,48 @@
+import time
+
+import app
+
+
+class RecordingReply:
+    session_id = 's1'
+    sid = None
+
+    def __init__(self):
+        self.frames = []
+
+    def send_stream(self, content, n_bytes):
+        self.frames.append((time.monotonic(), content))
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return predicate()
+
+
+def test_trailing_delta_is_flushed_when_upstream_pauses():
+    reply = RecordingReply()
+    emitter = app.StreamEmitter(reply)
+    started = time.monotonic()
+    assert emitter.push('first')  # 首个增量立即发送
+    assert emitter.push(' second')  # 窗口内：先缓存
+    assert [content for _, content in reply.frames] == ['first']
+    # 之后上游暂停，没有新的增量触发发送
+    assert wait_for(lambda: len(reply.frames) == 2)
+    sent_at, content = reply.frames[1]
+    assert content == ' second'
+    assert sent_at - started < app.STREAM_FLUSH_INTERVAL + 0.2
+
+
+def test_deltas_within_window_are_coalesced_into_one_frame():
+    reply = RecordingReply()
+    emitter = app.StreamEmitter(reply)
+    emitter.push('a')
+    for chunk in 'bcdef':
+        emitter.push(chunk)
+    assert wait_for(lambda: len(reply.frames) == 2)
+    time.sleep(app.STREAM_FLUSH_INTERVAL * 2)
+    assert [content for _, content in reply.frames] == ['a', 'bcdef']
+    emitter.flush()  # 已全部发送，不再产生空帧
+    assert len(reply.frames) == 2
@@ -0,0 +1,48 @@
+import json
+
+import pytest
+
+from app import ToolCallParser
+
+
+def parse(text, chunk_size=None):
+    parser = ToolCallParser()
+    if chunk_size is None:
+        return parser.feed(text) + parser.close()
+    calls = []
+    for start in range(0, len(text), chunk_size):
+        calls += parser.feed(text[start:start + chunk_size])
+    return calls + parser.close()
+
+
+def json_call(command, **parameters):
+    return '[TOOL_CALL] ' + json.dumps({'command': command, 'parameters': parameters}, ensure_ascii=False)
+
+
+@pytest.mark.parametrize('command, parameters', [
+    ('READ_FILE', {'path': 'big.log', 'offset': 100, 'limit': 20, 'unit': 'lines'}),
+    ('WRITE_FILE', {'path': 'a.txt', 'content': '{"nested": "}"}\n'}),
+    ('APPEND_FILE', {'path': 'a.txt', 'content': 'tail\n'}),
+    ('EDIT_FILE', {'path': 'a.py', 'search': 'old()', 'replace': ''}),
+    ('EDIT_FILE', {'path': 'a.py', 'diff': '@@ -1 +1 @@\n-a\n+b\n'}),
+    ('DELETE_FILE', {'path': 'a.txt'}),
+    ('LIST_FILES', {'path': 'src', 'recursive': True, 'max_depth': 2, 'pattern': '*.py'}),
+    ('CREATE_DIR', {'path': 'build'}),
+    ('SEARCH_FILES', {'query': 'TODO', 'path': 'src', 'pattern': '*.py', 'regex': False, 'max_results': 5}),
+])
+def test_json_format_keeps_every_schema_parameter(command, parameters):
+    text = f"先看一下。{json_call(command, **parameters)}然后继续。"
+    assert parse(text) == [{'tool': command, 'params': parameters}]
+    assert parse(text, chunk_size=3) == [{'tool': command, 'params': parameters}]
+
+
+def test_json_format_search_files_without_path():
+    assert parse(json_call('SEARCH_FILES', query='ToolCallParser')) == [
+        {'tool': 'SEARCH_FILES', 'params': {'query': 'ToolCallParser'}}]
+
+
+def test_json_format_maps_path_aliases_and_drops_unknown_keys():
+    text = '[TOOL_CALL] {"tool": "READ_FILE", "file_path": "a.txt", "limit": 5, "reason": "check"}'
+    assert parse(text) == [{'tool': 'READ_FILE', 'params': {'path': 'a.txt', 'limit': 5}}]
+    text = '[TOOL_CALL] {"command": "LIST_FILES", "params": {"directory_path": "src", "recursive": true}}'
+    assert parse(text) == [{'tool': 'LIST_FILES', 'params': {'path': 'src', 'recursive': True}}]
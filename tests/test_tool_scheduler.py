@@ -0,0 +1,40 @@
+import pytest
+
+from app import FileManager, ToolScheduler, native_tool_call
+
+
+@pytest.mark.parametrize('params', [{'path': None}, {'path': 42}, ['a.txt'], None])
+@pytest.mark.parametrize('batch', [True, False])
+def test_malformed_path_returns_error_result(tmp_path, params, batch):
+    (tmp_path / 'a.txt').write_text('hello\n')
+    scheduler = ToolScheduler(FileManager(str(tmp_path)), batch=batch)
+    scheduler.submit({'tool': 'READ_FILE', 'params': params})
+    scheduler.submit({'tool': 'READ_FILE', 'params': {'path': 'a.txt'}})
+    results = [result for _, result in scheduler.results()]
+    assert results[0].startswith(('[ERROR]', '[错误]'))
+    assert 'hello' in results[1]
+
+
+@pytest.mark.parametrize('arguments, error', [
+    ('{"path": null}', "missing required parameter 'path'"),
+    ('{"path": 42}', "parameter 'path' must be string"),
+    ('{"path": "a.txt", "limit": "ten"}', "parameter 'limit' must be integer"),
+    ('{"path": "a.txt", "unit": "pages"}', "parameter 'unit' must be one of"),
+    ('["a.txt"]', 'arguments must be a JSON object'),
+    ('{"path": ', 'arguments are not valid JSON'),
+])
+def test_native_tool_call_with_invalid_arguments_returns_error_result(tmp_path, arguments, error):
+    (tmp_path / 'a.txt').write_text('hello\n')
+    scheduler = ToolScheduler(FileManager(str(tmp_path)))
+    scheduler.submit(native_tool_call({'name': 'READ_FILE', 'arguments': arguments, 'id': 'call_1'}))
+    scheduler.submit(native_tool_call({'name': 'READ_FILE', 'arguments': '{"path": "a.txt"}', 'id': 'call_2'}))
+    (first, bad), (_, good) = scheduler.results()
+    assert first['id'] == 'call_1' and first['arguments'] == arguments
+    assert bad.startswith('[ERROR] Invalid arguments for READ_FILE: ' + error)
+    assert 'hello' in good
+
+
+def test_native_tool_call_treats_null_optional_arguments_as_absent():
+    tool_call = native_tool_call({'name': 'LIST_FILES', 'arguments': '{"path": null, "recursive": true}', 'id': 'c'})
+    assert 'error' not in tool_call
+    assert tool_call['params'] == {'recursive': True}
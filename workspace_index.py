@@ -0,0 +1,173 @@
+"""工作目录内容索引：三元组（trigram）倒排索引 + 路径元数据，供 SEARCH_FILES 工具检索
+
+索引在首次搜索时建立，之后每次搜索前按文件 mtime 增量更新（最多每 INDEX_REFRESH_SECONDS 秒遍历一次目录）。
+"""
+import fnmatch
+import os
+import re
+import stat
+import threading
+import time
+
+INDEX_MAX_FILE_BYTES = int(os.getenv('WEBCHAT_INDEX_MAX_FILE_BYTES', str(1024 * 1024)))  # 超过该大小的文件不索引
+INDEX_REFRESH_SECONDS = float(os.getenv('WEBCHAT_INDEX_REFRESH_SECONDS', '2'))
+SEARCH_MAX_RESULTS = int(os.getenv('WEBCHAT_SEARCH_MAX_RESULTS', '20'))  # 最多返回的文件数
+SNIPPETS_PER_FILE = 3
+SNIPPET_MAX_CHARS = 160
+
+
+def _trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+class WorkspaceIndex:
+    """工作目录的内容索引
+
+    walker 为无参函数，返回 (相对路径, 是否目录, 大小, mtime_ns) 迭代器（由 FileManager 提供，遵循 .gitignore）
+    """
+
+    def __init__(self, base_dir, walker):
+        self.base_dir = base_dir
+        self.walker = walker
+        self._files = {}     # 相对路径 -> (mtime_ns, 大小, 三元组集合)
+        self._postings = {}  # 三元组 -> 相对路径集合
+        self._lock = threading.Lock()
+        self._last_refresh = None
+        self._dirty = set()  # 已知被修改、下次搜索前需要重新索引的文件
+
+    def mark_dirty(self, rel_path):
+        """文件被工具修改后调用，下次搜索前重新索引（不等目录遍历间隔）"""
+        with self._lock:
+            self._dirty.add(rel_path)
+
+    def _read_text(self, rel_path):
+        """读取文本文件内容（小写前的原文）；二进制文件返回 None"""
+        try:
+            with open(os.path.join(self.base_dir, rel_path), 'rb') as f:
+                data = f.read(INDEX_MAX_FILE_BYTES + 1)
+        except OSError:
+            return None
+        if len(data) > INDEX_MAX_FILE_BYTES or b'\0' in data[:8192]:
+            return None
+        return data.decode('utf-8', errors='replace')
+
+    def _index_file_locked(self, rel_path, mtime, size):
+        self._remove_file_locked(rel_path)
+        text = self._read_text(rel_path)
+        grams = _trigrams(text.lower()) if text is not None else set()
+        # 路径本身也参与索引，便于按文件名搜索
+        grams |= _trigrams(rel_path.lower())
+        self._files[rel_path] = (mtime, size, grams)
+        for gram in grams:
+            self._postings.setdefault(gram, set()).add(rel_path)
+
+    def _remove_file_locked(self, rel_path):
+        entry = self._files.pop(rel_path, None)
+        if entry is None:
+            return
+        for gram in entry[2]:
+            paths = self._postings.get(gram)
+            if paths is not None:
+                paths.discard(rel_path)
+                if not paths:
+                    del self._postings[gram]
+
+    def refresh(self, force=False):
+        """按 mtime 增量更新索引，返回 (新增/更新文件数, 删除文件数)"""
+        with self._lock:
+            now = time.monotonic()
+            if not force and self._last_refresh is not None and now - self._last_refresh < INDEX_REFRESH_SECONDS:
+                # 只处理已知被修改的文件
+                updated = 0
+                for rel_path in self._dirty:
+                    try:
+                        st = os.stat(os.path.join(self.base_dir, rel_path))
+                    except OSError:
+                        st = None
+                    if st is None or not stat.S_ISREG(st.st_mode):
+                        # 已删除，或不是普通文件（如 CREATE_DIR 新建的目录）：只索引普通文件
+                        self._remove_file_locked(rel_path)
+                        continue
+                    self._index_file_locked(rel_path, st.st_mtime_ns, st.st_size)
+                    updated += 1
+                self._dirty.clear()
+                return updated, 0
+
+            seen = set()
+            updated = 0
+            for rel_path, is_dir, size, mtime in self.walker():
+                if is_dir:
+                    continue
+                seen.add(rel_path)
+                entry = self._files.get(rel_path)
+                if entry is None or entry[0] != mtime or entry[1] != size or rel_path in self._dirty:
+                    self._index_file_locked(rel_path, mtime, size)
+                    updated += 1
+            removed = [rel_path for rel_path in self._files if rel_path not in seen]
+            for rel_path in removed:
+                self._remove_file_locked(rel_path)
+            self._dirty.clear()
+            self._last_refresh = now
+            return updated, len(removed)
+
+    def _candidates(self, query, regex):
+        """用三元组倒排表缩小候选文件范围（正则或过短的查询无法缩小，返回全部文件）"""
+        with self._lock:
+            if regex or len(query) < 3:
+                return list(self._files)
+            postings = sorted((self._postings.get(gram, set()) for gram in _trigrams(query.lower())), key=len)
+            if not postings or not postings[0]:
+                return []
+            result = set(postings[0])
+            for paths in postings[1:]:
+                result &= paths
+                if not result:
+                    break
+            return list(result)
+
+    def search(self, query, path_prefix='', pattern=None, regex=False, max_results=None):
+        """检索文件内容与路径，返回按相关度排序的 [(相对路径, 得分, [(行号, 片段)])]"""
+        self.refresh()
+        max_results = max_results or SEARCH_MAX_RESULTS
+        matcher = re.compile(query if regex else re.escape(query), re.IGNORECASE)
+        results = []
+        for rel_path in self._candidates(query, regex):
+            if path_prefix and not (rel_path == path_prefix or rel_path.startswith(path_prefix + '/')):
+                continue
+            if pattern and not (fnmatch.fnmatch(os.path.basename(rel_path), pattern)
+                                or fnmatch.fnmatch(rel_path, pattern)):
+                continue
+            path_hit = matcher.search(rel_path) is not None
+            text = self._read_text(rel_path)
+            snippets = []
+            match_count = 0
+            if text is not None:
+                for line_no, line in enumerate(text.splitlines(), 1):
+                    match = matcher.search(line)
+                    if not match:
+                        continue
+                    match_count += 1
+                    if len(snippets) < SNIPPETS_PER_FILE:
+                        snippets.append((line_no, self._trim(line, match.start(), match.end())))
+            if not match_count and not path_hit:
+                continue
+            # 路径命中优先，其次是匹配行数（对数衰减，避免大文件淹没结果）
+            score = (10 if path_hit else 0) + sum(1 / (i + 1) for i in range(match_count)) + 1 / (1 + rel_path.count('/'))
+            results.append((rel_path, score, snippets, match_count))
+        results.sort(key=lambda item: (-item[1], item[0]))
+        return results[:max_results], len(results)
+
+    @staticmethod
+    def _trim(line, start, end):
+        """截取匹配位置附近的片段"""
+        line = line.strip('\r')
+        if len(line) <= SNIPPET_MAX_CHARS:
+            return line.strip()
+        half = (SNIPPET_MAX_CHARS - (end - start)) // 2
+        left = max(0, start - max(half, 0))
+        right = min(len(line), left + SNIPPET_MAX_CHARS)
+        return ('...' if left else '') + line[left:right].strip() + ('...' if right < len(line) else '')
+
+    def stats(self):
+        with self._lock:
+            return {'files': len(self._files), 'trigrams': len(self._postings)}